@@ -0,0 +1,63 @@
+''' Benchmark clean_blooddata against the previous inference-based implementation.
+
+Run from the repository root:  python benchmarks/bench_clean.py [n_visits ...]
+'''
+# Libraries
+import os
+import sys
+import time
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from data_processing import clean_blooddata, move_column_inplace
+from legacy import bloodjson_to_df
+from synthetic_data import make_blood_json
+
+def legacy_clean_blooddata(blood_df):
+    ''' Previous implementation: inferred datetime formats, components based minutes,
+    object dtype for every text column and a merge for the deviation reasons'''
+    blood_df.drop(['Baseline Visit', '6-Wks Post-Op', '3-Mo Post-Op'], axis=1, inplace=True)
+    move_column_inplace(blood_df, 'Visit', 2)
+    numeric_cols = ['bscp_aliq_cnt','bscp_protocol_dev','bscp_protocol_dev_reason']
+    blood_df[numeric_cols] = blood_df[numeric_cols].apply(pd.to_numeric,errors='coerce')
+    datetime_cols = ['bscp_time_blood_draw','bscp_aliquot_freezer_time','bscp_time_centrifuge']
+    blood_df[datetime_cols] = blood_df[datetime_cols].apply(pd.to_datetime,errors='coerce')
+    blood_df['time_to_freezer'] = blood_df['bscp_aliquot_freezer_time'] - blood_df['bscp_time_blood_draw']
+    blood_df['time_to_freezer_minutes'] = blood_df['time_to_freezer'].dt.components['hours']*60 + blood_df['time_to_freezer'].dt.components['minutes']
+    blood_df['time_to_centrifuge'] = blood_df['bscp_time_centrifuge'] - blood_df['bscp_time_blood_draw']
+    blood_df['time_to_centrifuge_minutes'] = blood_df['time_to_centrifuge'].dt.components['hours']*60 + blood_df['time_to_centrifuge'].dt.components['minutes']
+    blood_df['time_values_check'] = (blood_df['time_to_centrifuge_minutes'] < blood_df['time_to_freezer_minutes'] ) & (blood_df['time_to_centrifuge_minutes'] <= 30) & (blood_df['time_to_freezer_minutes'] <= 60)
+    blood_df['Site'] = 'MCC' + blood_df['MCC'].astype(str) + ': ' + blood_df['screening_site']
+    deviation_dict = {1:'Unable to obtain blood sample -technical reason',
+                      2: 'Unable to obtain blood sample -patient related',
+                      3: 'Sample handling/processing error'}
+    deviation_df = pd.DataFrame.from_dict(deviation_dict, orient='index')
+    deviation_df.reset_index(inplace=True)
+    deviation_df.columns = ['bscp_protocol_dev_reason','Deviation Reason']
+    blood_df = blood_df.merge(deviation_df, on='bscp_protocol_dev_reason', how='left')
+    rename_dict = {'index':'ID', 'screening_site':'Screening Site', 'bscp_deg_of_hemolysis':'Hemolysis'}
+    return blood_df.rename(columns=rename_dict)
+
+def best_of(fn, make_input, repeat=3):
+    times = []
+    for _ in range(repeat):
+        df = make_input()
+        start = time.perf_counter()
+        result = fn(df)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def memory_mb(df):
+    return df.memory_usage(deep=True).sum() / 1e6
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [1000, 10000, 100000, 300000]
+    print('{:>10} {:>12} {:>10} {:>8} {:>12} {:>10} {:>8}'.format(
+        'visits', 'legacy (s)', 'new (s)', 'speedup', 'legacy (MB)', 'new (MB)', 'ratio'))
+    for n in sizes:
+        blood_df = bloodjson_to_df(make_blood_json(n, n_mcc=2, sites_per_mcc=3), [1, 2])
+        legacy_time, legacy_df = best_of(legacy_clean_blooddata, blood_df.copy)
+        new_time, new_df = best_of(clean_blooddata, blood_df.copy)
+        print('{:>10} {:12.3f} {:10.3f} {:7.1f}x {:12.1f} {:10.1f} {:7.1f}x'.format(
+            len(new_df), legacy_time, new_time, legacy_time / new_time,
+            memory_mb(legacy_df), memory_mb(new_df), memory_mb(legacy_df) / memory_mb(new_df)))
@@ -0,0 +1,82 @@
+''' Benchmark the aggregate cube against grouping the rows of each site for every view.
+
+Legacy: for 'all' and each site, the cross-join hemolysis grid, count_deviations and the
+per-metric groupby / merge functions of bench_metrics on the site's rows.  Cube: build_aggregate_cube once, then the same
+views looked up for 'all' and each site.  Both give the same counts.
+
+Run from the repository root:  python benchmarks/bench_cube.py [n_visits ...]
+'''
+# Libraries
+import os
+import sys
+import time
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from data_processing import (clean_blooddata, missing_blood_draws, get_deviations, site_metrics, timing_metrics,
+                             build_aggregate_cube, hemolysis_counts, deviation_counts, cube_site_metrics)
+from synthetic_data import make_blood_json
+from legacy import bloodjson_to_df, count_deviations
+from bench_metrics import legacy_metrics, check_same as check_same_metrics
+
+# Previous implementation of count_hemolysis_records: a dense grid from two cross joins
+# and an outer merge
+def legacy_hemolysis(df):
+    hem_df = df[['ID', 'MCC', 'Screening Site', 'Visit','Hemolysis']].dropna(subset=['Hemolysis'])
+    hem_df['Hemolysis'] = hem_df['Hemolysis'].str.replace('.','0.',regex=True)
+    hem_count = hem_df.groupby(by = ['MCC','Screening Site', 'Visit','Hemolysis'], observed=True).count().sort_index().reset_index().rename(columns={'ID':'count'})
+    sites_df = hem_df[['MCC','Screening Site']].drop_duplicates().sort_values(by=['MCC','Screening Site']).reset_index(drop=True)
+    hem_degrees = pd.DataFrame({'Hemolysis':hem_df['Hemolysis'].unique()})
+    visits = pd.DataFrame({'Visit':hem_df['Visit'].unique()})
+    hem_degrees = sites_df.merge(hem_degrees, how='cross').merge(visits, how='cross')
+    hem_degrees = hem_degrees.merge(hem_count,how='outer', on=['MCC','Screening Site','Hemolysis', 'Visit'])
+    return hem_degrees.fillna(0)
+
+def site_views(report_df):
+    ''' 'all' and each site with its rows'''
+    yield 'all', report_df
+    for site, site_df in report_df.groupby('Site', observed=True):
+        yield site, site_df
+
+def legacy_views(report_df):
+    views = {}
+    for site, site_df in site_views(report_df):
+        blood_drawn = missing_blood_draws(site_df)[0]
+        views[site] = (legacy_hemolysis(site_df), count_deviations(get_deviations(site_df)), legacy_metrics(blood_drawn))
+    return views
+
+def cube_views(cube, sites):
+    return {site: (hemolysis_counts(cube, site), deviation_counts(cube, site),
+                   cube_site_metrics(cube, site_metrics + timing_metrics, site))
+            for site in ['all'] + sites}
+
+def check_same(legacy, views):
+    for site, (legacy_hem, legacy_dev, legacy_site_metrics) in legacy.items():
+        hem, dev, metrics_df = views[site]
+        key = ['MCC', 'Screening Site', 'Hemolysis', 'Visit']
+        legacy_hem = legacy_hem.astype({col: str for col in key}).sort_values(by=key).reset_index(drop=True)
+        hem = hem.astype({col: str for col in key}).sort_values(by=key).reset_index(drop=True)
+        pd.testing.assert_frame_equal(legacy_hem, hem, check_dtype=False)
+        pd.testing.assert_frame_equal(legacy_dev.astype(str), dev.astype(str))
+        check_same_metrics(legacy_site_metrics, metrics_df)
+
+def best_of(fn, *args, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [1000, 10000, 100000, 300000]
+    print('{:>10} {:>6} {:>12} {:>10} {:>11} {:>8}'.format('records', 'sites', 'legacy (s)', 'build (s)', 'lookup (s)', 'speedup'))
+    for n in sizes:
+        report_df = clean_blooddata(bloodjson_to_df(make_blood_json(n, n_mcc=2, sites_per_mcc=3), [1, 2]))
+        sites = sorted(report_df['Site'].unique())
+        legacy_time, legacy = best_of(legacy_views, report_df)
+        build_time, cube = best_of(build_aggregate_cube, report_df)
+        lookup_time, views = best_of(cube_views, cube, sites)
+        check_same(legacy, views)
+        print('{:>10} {:>6} {:12.4f} {:10.4f} {:11.4f} {:7.1f}x'.format(
+            len(report_df), len(sites), legacy_time, build_time, lookup_time, legacy_time / (build_time + lookup_time)))
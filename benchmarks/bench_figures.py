@@ -0,0 +1,93 @@
+''' Micro-benchmark: figure build time of the report tabs against the number of sites,
+plotly express versus the figure dicts of make_figures, and the serialized size of the
+timing histograms (raw points with px, pre-binned counts with make_figures).
+
+Run from the repository root:  python benchmarks/bench_figures.py [n_sites ...]
+'''
+# Libraries
+import os
+import sys
+import time
+import json
+import plotly
+import plotly.express as px
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from data_processing import (clean_blooddata, missing_blood_draws,
+                             build_aggregate_cube, cube_site_metrics, get_metric, site_metrics, timing_metrics)
+from make_figures import bar_figure, facet_bar_figure, facet_histogram_figure, stacked_bar_figure
+from synthetic_data import make_blood_json
+from legacy import bloodjson_to_df, count_hemolysis_records
+
+time_cols = ['time_to_centrifuge_minutes', 'time_to_freezer_minutes']
+
+def figure_inputs(n_sites, visits_per_site=500):
+    report_df = clean_blooddata(bloodjson_to_df(
+        make_blood_json(n_sites * visits_per_site, n_mcc=2, sites_per_mcc=max(1, n_sites // 2)), [1, 2]))
+    blood_drawn = missing_blood_draws(report_df)[0]
+    metrics_df = cube_site_metrics(build_aggregate_cube(report_df), site_metrics + timing_metrics)
+    hists = {col: blood_drawn[blood_drawn[col] < 200].sort_values(by=['Site']) for col in time_cols}
+    return metrics_df, hists, count_hemolysis_records(report_df)
+
+# Previous implementation: plotly express for every figure, one hemolysis figure per site
+def px_figures(metrics_df, hists, hem_degrees):
+    figs = []
+    for metric in site_metrics:
+        fig = px.bar(get_metric(metrics_df, metric['metric']), x='Visit', y='Percent', color='Site', barmode='group')
+        fig.update_xaxes(categoryorder='category descending')
+        figs.append(fig)
+    for metric in timing_metrics:
+        df = get_metric(metrics_df, metric['metric']).sort_values(by=['Site'])
+        fig = px.bar(df, x='Visit', y='Percent', facet_col='Site', barmode='group', color='Site')
+        fig.update_xaxes(categoryorder='category descending', title='')
+        figs.append(fig)
+    for col, hist_df in hists.items():
+        figs.append(px.histogram(hist_df, x=col, facet_col='Site', color='Site'))
+    for site in hem_degrees['Screening Site'].unique():
+        fig = px.bar(hem_degrees[hem_degrees['Screening Site'] == site], x='Hemolysis', y='count', color='Visit', title=site, barmode='group')
+        fig.update_xaxes(categoryorder='category ascending')
+        figs.append(fig)
+    return figs
+
+def dict_figures(metrics_df, hists, hem_degrees, hemolysis_subplots=False):
+    figs = []
+    for metric in site_metrics:
+        figs.append(bar_figure(get_metric(metrics_df, metric['metric']), 'Visit', 'Percent', 'Site', categoryorder='category descending'))
+    for metric in timing_metrics:
+        df = get_metric(metrics_df, metric['metric']).sort_values(by=['Site'])
+        figs.append(facet_bar_figure(df, 'Visit', 'Percent', 'Site', categoryorder='category descending', x_title=''))
+    for col, hist_df in hists.items():
+        figs.append(facet_histogram_figure(hist_df, col, 'Site'))
+    if hemolysis_subplots:
+        figs.append(stacked_bar_figure(hem_degrees, 'Hemolysis', 'count', 'Visit', 'Screening Site', categoryorder='category ascending'))
+    else:
+        for site in hem_degrees['Screening Site'].unique():
+            figs.append(bar_figure(hem_degrees[hem_degrees['Screening Site'] == site], 'Hemolysis', 'count', 'Visit',
+                                   title=site, categoryorder='category ascending'))
+    return figs
+
+def histogram_kb(figs):
+    ''' Serialized size of the histogram figures (figures 8 and 9 of a figure set)'''
+    return sum(len(json.dumps(fig if isinstance(fig, dict) else fig.to_plotly_json(), cls=plotly.utils.PlotlyJSONEncoder))
+               for fig in figs[len(site_metrics) + len(timing_metrics):][:len(time_cols)]) / 1e3
+
+def best_of(fn, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+if __name__ == '__main__':
+    site_counts = [int(s) for s in sys.argv[1:]] or [2, 4, 8, 16, 32]
+    print('{:>6} {:>10} {:>10} {:>14} {:>8} {:>16} {:>18}'.format(
+        'sites', 'px (s)', 'dicts (s)', 'subplots (s)', 'speedup', 'px hist (kB)', 'dicts hist (kB)'))
+    for n_sites in site_counts:
+        inputs = figure_inputs(n_sites)
+        px_time = best_of(lambda: px_figures(*inputs))
+        dict_time = best_of(lambda: dict_figures(*inputs))
+        subplot_time = best_of(lambda: dict_figures(*inputs, hemolysis_subplots=True))
+        print('{:>6} {:10.3f} {:10.3f} {:14.3f} {:7.1f}x {:16.1f} {:18.1f}'.format(
+            n_sites, px_time, dict_time, subplot_time, px_time / dict_time,
+            histogram_kb(px_figures(*inputs)), histogram_kb(dict_figures(*inputs))))
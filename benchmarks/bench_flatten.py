@@ -0,0 +1,59 @@
+''' Benchmark bloodjson_to_df against the previous concat-in-a-loop implementation.
+
+Run from the repository root:  python benchmarks/bench_flatten.py
+'''
+# Libraries
+import os
+import sys
+import time
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from legacy import bloodjson_to_df, dict_to_col
+from synthetic_data import make_blood_json
+
+def legacy_bloodjson_to_df(json, mcc_list):
+    ''' Previous implementation: concat one frame per (mcc, visit) onto a growing frame'''
+    df = pd.DataFrame()
+    dict_cols = ['Baseline Visit', '6-Wks Post-Op', '3-Mo Post-Op']
+    for mcc in mcc_list:
+        if mcc in json.keys():
+            m = json[mcc]
+        if str(mcc) in json.keys():
+            mcc=str(mcc)
+            m = json[mcc]
+        if m:
+            mdf = pd.DataFrame.from_dict(m, orient='index')
+            mdf.dropna(subset=['screening_site'], inplace=True)
+            mdf.reset_index(inplace=True)
+            mdf['MCC'] = mcc
+            for c in dict_cols:
+                if c in mdf.columns:
+                    col_df = dict_to_col(mdf, ['index','MCC','screening_site'], c,'Visit')
+                    df = pd.concat([df, col_df])
+                    df.reset_index(inplace=True, drop=True)
+    return df
+
+def best_of(fn, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [1000, 10000, 50000, 100000, 200000]
+    print('{:>10} {:>8} {:>12} {:>12} {:>10}'.format('visits', 'mccs', 'legacy (s)', 'new (s)', 'us/row'))
+    for n in sizes:
+        for n_mcc in [2, 8]:
+            blood_json = make_blood_json(n, n_mcc=n_mcc, sites_per_mcc=1)
+            mcc_list = list(range(1, n_mcc + 1))
+            new_time, new_df = best_of(lambda: bloodjson_to_df(blood_json, mcc_list))
+            if n <= 100000:
+                legacy_time, legacy_df = best_of(lambda: legacy_bloodjson_to_df(blood_json, mcc_list))
+                pd.testing.assert_frame_equal(new_df, legacy_df)
+                legacy = '{:12.3f}'.format(legacy_time)
+            else:
+                legacy = '{:>12}'.format('-')
+            print('{:>10} {:>8} {} {:12.3f} {:10.2f}'.format(len(new_df), n_mcc, legacy, new_time, 1e6 * new_time / len(new_df)))
@@ -0,0 +1,68 @@
+''' Benchmark weekly trends read from the aggregate history store against recomputing them
+from the saved snapshot of every week.
+
+Snapshots: load each week's saved snapshot file and look its metrics up in its cube.
+History: read the history store and compute the same trends.  Sizes are the bytes on
+disk each approach reads.
+
+Run from the repository root:  python benchmarks/bench_history.py [n_visits ...]
+'''
+# Libraries
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from data_processing import clean_blooddata, cube_site_metrics, site_metrics, timing_metrics
+from data_snapshots import make_snapshot, save_snapshot, list_snapshot_entries, load_snapshot_file
+from aggregate_history import (append_history, history_files, read_history_files, weekly_history,
+                               metric_trend, hemolysis_trend)
+from synthetic_data import make_blood_json
+from legacy import bloodjson_to_df
+
+WEEKS = 52
+METRICS = site_metrics + timing_metrics
+
+def write_weeks(n_visits, snapshot_dir, history_dir):
+    start = datetime(2021, 6, 7)
+    for week in range(WEEKS):
+        blood_json = make_blood_json(n_visits, n_mcc=2, sites_per_mcc=3, seed=week)
+        report_df = clean_blooddata(bloodjson_to_df(blood_json, [1, 2]))
+        snapshot = make_snapshot(report_df, 'archive', loaded_at=start + timedelta(days=7 * week))
+        save_snapshot(snapshot, snapshot_dir, 'blood', keep=WEEKS)
+        append_history(snapshot, 'blood', history_dir)
+
+def snapshot_trends(snapshot_dir):
+    trends = []
+    for entry in list_snapshot_entries(snapshot_dir, 'blood'):
+        snapshot = load_snapshot_file(snapshot_dir, entry)
+        metrics_df = cube_site_metrics(snapshot['cube'], METRICS)
+        trends.append(metrics_df.assign(Week=entry['report_date']))
+    return pd.concat(trends)
+
+def history_trends(history_dir):
+    weekly = weekly_history(read_history_files(history_files('blood', history_dir)))
+    return [metric_trend(weekly, metric['metric']) for metric in METRICS] + [hemolysis_trend(weekly)]
+
+def disk_bytes(directory):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, names in os.walk(directory) for name in names)
+
+def timed_run(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [1000, 10000]
+    print('{:>8} {:>6} {:>14} {:>13} {:>14} {:>13}'.format(
+        'visits', 'weeks', 'snapshots (s)', 'snapshots KB', 'history (s)', 'history KB'))
+    for n_visits in sizes:
+        with tempfile.TemporaryDirectory() as snapshot_dir, tempfile.TemporaryDirectory() as history_dir:
+            write_weeks(n_visits, snapshot_dir, history_dir)
+            snapshot_time, _ = timed_run(snapshot_trends, snapshot_dir)
+            history_time, _ = timed_run(history_trends, history_dir)
+            print('{:>8} {:>6} {:14.3f} {:13.0f} {:14.3f} {:13.1f}'.format(
+                n_visits, WEEKS, snapshot_time, disk_bytes(snapshot_dir) / 1e3, history_time, disk_bytes(history_dir) / 1e3))
@@ -0,0 +1,56 @@
+''' Benchmark the streaming ingest (read_blood_file + blood_visits_to_df) against loading the
+whole report with json.load and flattening it with bloodjson_to_df.  Reports time and peak
+memory (tracemalloc, so the times are slower than usual) next to the size of the file and
+of the flattened dataframe.
+
+Run from the repository root:  python benchmarks/bench_ingest.py [n_visits ...]
+'''
+# Libraries
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from data_processing import read_blood_file, blood_visits_to_df
+from legacy import load_data_file, bloodjson_to_df, bloodjson_row_hashes
+from synthetic_data import write_blood_json
+
+MCC_LIST = [1, 2]
+
+def dict_ingest(file_path, filename):
+    blood_json = load_data_file(file_path, filename)
+    blood_df = bloodjson_to_df(blood_json, MCC_LIST)
+    row_hashes = bloodjson_row_hashes(blood_json, MCC_LIST)
+    return blood_df.drop(columns=['Baseline Visit', '6-Wks Post-Op', '3-Mo Post-Op'], errors='ignore'), row_hashes
+
+def stream_ingest(file_path, filename):
+    return blood_visits_to_df(read_blood_file(file_path, filename, MCC_LIST), MCC_LIST)
+
+def measure(fn, *args):
+    ''' (seconds, peak bytes, result) of one traced run'''
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, result
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [10000, 100000, 300000]
+    print('{:>8} {:>9} {:>9} {:>10} {:>10} {:>10} {:>10}'.format(
+        'visits', 'file MB', 'frame MB', 'dict (s)', 'dict MB', 'stream (s)', 'stream MB'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n in sizes:
+            write_blood_json(os.path.join(tmp_dir, 'blood.json'), n, n_mcc=2, sites_per_mcc=3)
+            file_mb = os.path.getsize(os.path.join(tmp_dir, 'blood.json')) / 1e6
+            dict_time, dict_peak, (dict_df, dict_hashes) = measure(dict_ingest, tmp_dir, 'blood.json')
+            stream_time, stream_peak, (stream_df, stream_hashes) = measure(stream_ingest, tmp_dir, 'blood.json')
+            pd.testing.assert_frame_equal(stream_df, dict_df)
+            pd.testing.assert_series_equal(stream_hashes, dict_hashes)
+            frame_mb = stream_df.memory_usage(deep=True).sum() / 1e6
+            print('{:>8} {:9.1f} {:9.1f} {:10.2f} {:10.1f} {:10.2f} {:10.1f}'.format(
+                len(stream_df), file_mb, frame_mb, dict_time, dict_peak / 1e6, stream_time, stream_peak / 1e6))
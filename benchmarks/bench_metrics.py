@@ -0,0 +1,94 @@
+''' Benchmark the site metrics of the aggregate cube against the per-metric groupby / merge
+functions they replaced.
+
+Run from the repository root:  python benchmarks/bench_metrics.py [n_visits ...]
+'''
+# Libraries
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from data_processing import (clean_blooddata, missing_blood_draws,
+                             build_aggregate_cube, cube_site_metrics, get_metric, site_metrics, timing_metrics)
+from synthetic_data import make_blood_json
+from legacy import bloodjson_to_df
+
+# Previous implementation: every function recounts the Site x Visit denominator, counts its
+# numerator with a second groupby and merges the two
+def legacy_metric_obtained(blood_drawn_df, metric_col):
+    blood_site_count = blood_drawn_df.groupby(['Site','Visit'], observed=True)['ID'].count().sort_index().rename('Count').reset_index()
+    cols = ['ID', 'Site', 'Visit'] + [metric_col]
+    df = blood_drawn_df[cols]
+    df = df[~df[metric_col].isna()]
+    df_count = df.groupby(['Site','Visit'], observed=True)['ID'].count().sort_index().rename('Metric Count').reset_index()
+    df_total = blood_site_count.merge(df_count, how='left', on=['Site','Visit']).fillna(0)
+    df_total['Percent'] = 100 * (df_total['Count'] - df_total['Metric Count']) / df_total['Count']
+    return df_total
+
+def legacy_aliquot_obtained(blood_drawn_df, threshold):
+    blood_site_count = blood_drawn_df.groupby(['Site','Visit'], observed=True)['ID'].count().sort_index().rename('Count').reset_index()
+    cols = ['ID', 'Site', 'Visit','bscp_aliq_cnt']
+    df = blood_drawn_df[cols].copy()
+    df['bscp_aliq_cnt'] = df['bscp_aliq_cnt'].fillna(0)
+    df['Threshold'] = df['bscp_aliq_cnt'] >= threshold
+    df_count = df[~df['Threshold']].groupby(['Site','Visit'], observed=True)['ID'].count().sort_index().rename('Below Threshold').reset_index()
+    df_total = blood_site_count.merge(df_count, how='left', on=['Site','Visit']).fillna(0)
+    df_total['Percent'] = 100 * (df_total['Count'] - df_total['Below Threshold']) / df_total['Count']
+    return df_total
+
+def legacy_pass_threshold(blood_drawn_df, metric_col, metric_threshold, fail_over = True):
+    df = blood_drawn_df[~blood_drawn_df[metric_col].isna()]
+    df_count = df.groupby(['Site','Visit'], observed=True)['ID'].count().sort_index().rename('Count').reset_index()
+    if fail_over:
+        fail_df = df[df[metric_col] >= metric_threshold]
+    else:
+        fail_df = df[df[metric_col] <= metric_threshold]
+    fail_df_count = fail_df.groupby(['Site','Visit'], observed=True)['ID'].count().sort_index().rename('Fail').reset_index()
+    count_total = df_count.merge(fail_df_count, how='left', on=['Site','Visit']).fillna(0)
+    count_total['Percent'] = 100 * (count_total['Count'] - count_total['Fail']) / count_total['Count']
+    return count_total
+
+def legacy_metrics(blood_drawn):
+    ''' What make_site and make_timing computed before, keyed by metric name'''
+    return {
+        'Count': blood_drawn.groupby(['Site','Visit'], observed=True)['ID'].count().sort_index().rename('Count').reset_index(),
+        'Pax Obtained': legacy_metric_obtained(blood_drawn, 'bscp_paxg_aliq_na'),
+        'Buffy Obtained': legacy_metric_obtained(blood_drawn, 'bscp_buffycoat_na'),
+        'Aliquots >= 5': legacy_aliquot_obtained(blood_drawn, 5),
+        'Aliquots >= 1': legacy_aliquot_obtained(blood_drawn, 1),
+        'Centrifuge < 30 min': legacy_pass_threshold(blood_drawn, 'time_to_centrifuge_minutes', 30),
+        'Freezer < 60 min': legacy_pass_threshold(blood_drawn, 'time_to_freezer_minutes', 60),
+    }
+
+def new_metrics(blood_drawn):
+    return cube_site_metrics(build_aggregate_cube(blood_drawn), site_metrics + timing_metrics)
+
+def check_same(legacy, metrics_df):
+    for metric, legacy_df in legacy.items():
+        new_df = get_metric(metrics_df, metric)
+        value = 'Percent' if 'Percent' in legacy_df.columns else 'Count'
+        assert list(new_df['Site'].astype(str)) == list(legacy_df['Site'].astype(str)), metric
+        assert list(new_df['Visit'].astype(str)) == list(legacy_df['Visit'].astype(str)), metric
+        np.testing.assert_allclose(new_df[value].values, legacy_df[value].values, err_msg=metric)
+
+def best_of(fn, arg, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(arg)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [1000, 10000, 100000, 300000]
+    print('{:>10} {:>12} {:>10} {:>8}'.format('draws', 'legacy (s)', 'new (s)', 'speedup'))
+    for n in sizes:
+        report_df = clean_blooddata(bloodjson_to_df(make_blood_json(n, n_mcc=2, sites_per_mcc=3), [1, 2]))
+        blood_drawn = missing_blood_draws(report_df)[0]
+        legacy_time, legacy = best_of(legacy_metrics, blood_drawn)
+        new_time, metrics_df = best_of(new_metrics, blood_drawn)
+        check_same(legacy, metrics_df)
+        print('{:>10} {:12.4f} {:10.4f} {:7.1f}x'.format(len(blood_drawn), legacy_time, new_time, legacy_time / new_time))
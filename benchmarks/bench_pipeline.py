@@ -0,0 +1,82 @@
+''' Benchmark the ingest pipeline for a growing number of MCCs, with the report files served
+by a local HTTP server.
+
+Serial: download every MCC file one after the other, flatten and clean the whole report
+(the single-report ingest).  Cold: run_pipeline on an empty cache.  Warm: a second run in
+the same process (304s, nothing cleaned).  Shared: a run with this process's stage state
+dropped, as in another worker or dashboard (304s, cleaned frames read from the cache).
+
+Run from the repository root:  python benchmarks/bench_pipeline.py [n_mcc ...]
+'''
+# Libraries
+import os
+import sys
+import json
+import tempfile
+import threading
+import time
+import functools
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import report_pipeline
+from data_processing import get_session, read_blood_stream, blood_visits_to_df, clean_blooddata
+from synthetic_data import make_blood_json
+
+VISITS_PER_MCC = 20000
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def serve(directory):
+    ''' Serve directory on a free local port, returning the server'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def write_mcc_files(directory, n_mcc):
+    os.makedirs(os.path.join(directory, 'blood'), exist_ok=True)
+    blood_json = make_blood_json(VISITS_PER_MCC * n_mcc, n_mcc=n_mcc, sites_per_mcc=2)
+    for mcc, records in blood_json.items():
+        with open(os.path.join(directory, 'blood', 'blood-{}-latest.json'.format(mcc)), 'w') as json_file:
+            json.dump(records, json_file)
+
+def serial_ingest(file_url_root, mcc_list):
+    session = get_session()
+    mcc_visits = {}
+    for mcc in mcc_list:
+        with session.get(report_pipeline.report_file_url(file_url_root, 'blood', mcc), stream=True) as r:
+            mcc_visits[str(mcc)] = read_blood_stream(r.iter_content(1 << 16))
+    return clean_blooddata(blood_visits_to_df(mcc_visits, mcc_list)[0])
+
+def timed_run(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [1, 2, 4, 8]
+    print('{:>5} {:>8} {:>11} {:>9} {:>9} {:>10}'.format('MCCs', 'rows', 'serial (s)', 'cold (s)', 'warm (s)', 'shared (s)'))
+    for n_mcc in sizes:
+        with tempfile.TemporaryDirectory() as serve_dir, tempfile.TemporaryDirectory() as cache_dir:
+            write_mcc_files(serve_dir, n_mcc)
+            server = serve(serve_dir)
+            file_url_root = 'http://127.0.0.1:{}'.format(server.server_address[1])
+            mcc_list = list(range(1, n_mcc + 1))
+            def run(previous=None):
+                results = report_pipeline.run_pipeline(['blood'], mcc_list, file_url_root, None, False,
+                                                       previous, cache_dir=cache_dir)
+                result = results['blood']
+                report_pipeline.remember_stages('blood', result, 'bench')
+                return {'version': 'bench', 'report_df': result['report_df']}
+            serial_time, serial_df = timed_run(lambda: serial_ingest(file_url_root, mcc_list))
+            report_pipeline._stage_state.clear()
+            cold_time, previous = timed_run(run)
+            warm_time, _ = timed_run(lambda: run({'blood': previous}))
+            report_pipeline._stage_state.clear()
+            shared_time, shared = timed_run(run)
+            assert len(shared['report_df']) == len(serial_df)
+            server.shutdown()
+        print('{:>5} {:>8} {:11.3f} {:9.3f} {:9.3f} {:10.3f}'.format(
+            n_mcc, len(serial_df), serial_time, cold_time, warm_time, shared_time))
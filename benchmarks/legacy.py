@@ -0,0 +1,148 @@
+# Libraries
+import os
+import sys
+import json
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from data_processing import (_is_missing, _flatten_dict, visit_row_hash, build_aggregate_cube,
+                             hemolysis_counts)
+
+# ----------------------------------------------------------------------------
+# EARLIER IMPLEMENTATIONS
+# ----------------------------------------------------------------------------
+
+# Functions the app no longer uses: loading the whole report into dicts before flattening
+# it (replaced by the streaming ingest) and counting from the rows (replaced by the
+# aggregate cube).  The benchmarks time the app against them, and use bloodjson_to_df to
+# flatten the synthetic payloads of synthetic_data.
+
+def load_data_file(ASSETS_PATH, filename):
+    with open(os.path.join(ASSETS_PATH, filename )) as json_file:
+        data_json = json.load(json_file)
+    return data_json
+
+def dict_to_col(df, index_cols, dict_col, new_col_name = 'category', add_col_as_category=True):
+    ''' Take a dataframe with index columns and a column containing a dictionary and convert
+    the dictionary json into separate columns'''
+    new_df = df[index_cols +[dict_col]].copy()
+    new_df.dropna(subset=[dict_col], inplace=True)
+    new_df.reset_index(inplace=True, drop=True)
+    if add_col_as_category:
+        new_df[new_col_name] = dict_col
+    new_df = pd.concat([new_df, pd.json_normalize(new_df[dict_col])], axis=1)
+    return new_df
+
+def bloodjson_to_df(json, mcc_list):
+    ''' Flatten {mcc: {record_id: {visit: {field: value}}}} into one row per record visit.
+    The records are walked once, values are collected into column buffers and the
+    dataframe is built in a single allocation at the end.'''
+    dict_cols = ['Baseline Visit', '6-Wks Post-Op', '3-Mo Post-Op']
+    index_cols = ['index', 'MCC', 'screening_site']
+
+    # Rows are grouped by (mcc, visit) in that order, with records in file order within
+    # each group, so collect each visit's rows separately while walking the records.
+    segments = []
+    for mcc in mcc_list:
+        if str(mcc) in json.keys():
+            mcc = str(mcc)
+        m = json.get(mcc)
+        if not m:
+            continue
+        visit_rows = {c: [] for c in dict_cols}
+        visit_seen = {c: False for c in dict_cols}
+        for record_id, record in m.items():
+            for c in dict_cols:
+                if c in record:
+                    visit_seen[c] = True
+            site = record.get('screening_site')
+            if _is_missing(site):
+                continue
+            for c in dict_cols:
+                visit = record.get(c)
+                if not _is_missing(visit):
+                    visit_rows[c].append((record_id, site, visit))
+        for c in dict_cols:
+            if visit_seen[c]:
+                segments.append((mcc, c, visit_rows[c]))
+
+    if not segments:
+        return pd.DataFrame()
+
+    # Column buffers hold (row positions, values); columns keep first seen order
+    columns = {}
+    n_rows = 0
+    for mcc, c, rows in segments:
+        start = n_rows
+        n_rows = start + len(rows)
+        segment_values = (
+            ('index', [row[0] for row in rows]),
+            ('MCC', [mcc] * len(rows)),
+            ('screening_site', [row[1] for row in rows]),
+            (c, [row[2] for row in rows]),
+            ('Visit', [c] * len(rows)),
+        )
+        for col, values in segment_values:
+            buffer = columns.setdefault(col, ([], []))
+            buffer[0].extend(range(start, n_rows))
+            buffer[1].extend(values)
+        for position, (record_id, site, visit) in enumerate(rows, start):
+            for col, value in visit.items():
+                if isinstance(value, dict):
+                    for flat_col, flat_value in _flatten_dict(value, col + '.'):
+                        buffer = columns.setdefault(flat_col, ([], []))
+                        buffer[0].append(position)
+                        buffer[1].append(flat_value)
+                    continue
+                buffer = columns.get(col)
+                if buffer is None:
+                    buffer = columns[col] = ([], [])
+                buffer[0].append(position)
+                buffer[1].append(value)
+
+    data = {}
+    for col, (positions, values) in columns.items():
+        if col in dict_cols:
+            # Visit dictionaries stay as objects, as in the original visit columns
+            column = np.full(n_rows, np.nan, dtype=object)
+            column[positions] = values
+            data[col] = pd.Series(column, dtype=object)
+        else:
+            column = [np.nan] * n_rows
+            for position, value in zip(positions, values):
+                column[position] = value
+            data[col] = column
+    return pd.DataFrame(data, columns=list(columns))
+
+def bloodjson_row_hashes(blood_json, mcc_list):
+    ''' Fingerprint of each row bloodjson_to_df makes from blood_json, in the same row order,
+    indexed by an 'mcc|record ID|visit' key.  Uses Python's hash, so fingerprints can only be
+    compared within one process.'''
+    dict_cols = ['Baseline Visit', '6-Wks Post-Op', '3-Mo Post-Op']
+    keys = []
+    hashes = []
+    for mcc in mcc_list:
+        if str(mcc) in blood_json.keys():
+            mcc = str(mcc)
+        m = blood_json.get(mcc)
+        if not m:
+            continue
+        prefix = '{}|'.format(mcc)
+        for c in dict_cols:
+            suffix = '|' + c
+            for record_id, record in m.items():
+                site = record.get('screening_site')
+                visit = record.get(c)
+                if _is_missing(site) or _is_missing(visit):
+                    continue
+                keys.append(prefix + str(record_id) + suffix)
+                hashes.append(visit_row_hash(site, visit))
+    return pd.Series(hashes, index=pd.Index(keys, dtype=object), dtype='int64')
+
+def count_hemolysis_records(df):
+    return hemolysis_counts(build_aggregate_cube(df, metrics=['Hemolysis']))
+
+def count_deviations(deviations_df):
+    dev_count = deviations_df.groupby(['Site','Visit','Deviation Reason'], observed=True)['ID'].count().sort_index().rename('count').reset_index()
+    return dev_count
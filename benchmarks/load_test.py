@@ -0,0 +1,452 @@
+''' Load test of the dashboard as it is deployed: gunicorn --preload with several workers,
+against a local stand-in for the api.a2cps.org files endpoint.
+
+The stand-in serves synthetic blood-[mcc]-latest.json files (with Last-Modified, so the
+pipeline's conditional requests get 304s) and the app is booted against it through
+FILE_URL_ROOT, with its snapshot, history, pipeline cache, export and metrics directories in
+a temporary directory.  Virtual users then replay the requests the browser makes:
+
+    page load     GET /, /_dash-layout and /_dash-dependencies, then the first tab's
+                  content (and the site figures when CLIENTSIDE_SITE_SWITCH is on)
+    tab           switch to a random tab
+    site switch   go through every site and back to 'all': the tab's content, or with
+                  CLIENTSIDE_SITE_SWITCH each of the tab's server datatables
+
+The callbacks and their inputs are read from /_dash-dependencies, so the traffic follows
+the app's configuration.  Static assets are left out, as browsers cache them.
+
+Reports p50 / p95 / p99 latency by request, throughput and the peak and final resident
+memory of each worker, for each worker count given.  The users are threads of this
+process on the same machine as the app, so compare runs made on the same machine.
+
+Run from the repository root:
+    python benchmarks/load_test.py                                  # 4 workers, 16 users, 60 s
+    python benchmarks/load_test.py --workers 1 4 16 --users 32 --duration 120
+    CLIENTSIDE_SITE_SWITCH=true python benchmarks/load_test.py --out clientside.json
+
+Other settings of the app (TAB_CACHE_SIZE, HEMOLYSIS_SUBPLOTS, ...) are passed on from the
+environment.
+'''
+# Libraries
+import argparse
+import functools
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import requests
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+SRC_PATH = os.path.join(BENCHMARK_PATH, '..', 'src')
+from synthetic_data import make_blood_json
+
+# ----------------------------------------------------------------------------
+# STAND-IN REPORT API
+# ----------------------------------------------------------------------------
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def serve(directory):
+    ''' Serve directory on a free local port, returning the server'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def write_report_files(directory, n_visits, n_mcc, sites_per_mcc):
+    ''' Write the synthetic report files as reports/blood/blood-[mcc]-latest.json, returning
+    the MCCs'''
+    os.makedirs(os.path.join(directory, 'reports', 'blood'), exist_ok=True)
+    blood_json = make_blood_json(n_visits, n_mcc=n_mcc, sites_per_mcc=sites_per_mcc)
+    for mcc, records in blood_json.items():
+        with open(os.path.join(directory, 'reports', 'blood', 'blood-{}-latest.json'.format(mcc)), 'w') as json_file:
+            json.dump(records, json_file)
+    return list(blood_json)
+
+# ----------------------------------------------------------------------------
+# APP UNDER GUNICORN
+# ----------------------------------------------------------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_app(workers, port, file_url_root, mcc_list, work_dir, startup_timeout):
+    ''' Boot app:server the way the Dockerfile does and wait until it answers'''
+    env = dict(os.environ)
+    env.update({
+        'FILE_URL_ROOT': file_url_root,
+        'REPORT': 'blood',
+        'MCC_LIST': ','.join(str(mcc) for mcc in mcc_list),
+        'DATA_REFRESH_INTERVAL': env.get('DATA_REFRESH_INTERVAL', '0'),
+        'PYTHONUNBUFFERED': 'TRUE',
+    })
+    for name in ['SNAPSHOT_DIR', 'HISTORY_DIR', 'PIPELINE_CACHE_DIR', 'EXPORT_DIR', 'METRICS_DIR']:
+        env[name] = os.path.join(work_dir, name.lower())
+        os.makedirs(env[name], exist_ok=True)
+    log = open(os.path.join(work_dir, 'gunicorn.log'), 'wb')
+    command = [sys.executable, '-m', 'gunicorn', '--preload', '-w', str(workers),
+               '-b', '127.0.0.1:{}'.format(port), '-t', '200', 'app:server']
+    process = subprocess.Popen(command, cwd=SRC_PATH, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = 'http://127.0.0.1:{}/'.format(port)
+    deadline = time.perf_counter() + startup_timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            if requests.get(base_url + '_dash-layout', timeout=5).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    stop_app(process)
+    with open(log.name, errors='replace') as log_file:
+        print(log_file.read()[-3000:])
+    raise RuntimeError('The app did not start within {} s'.format(startup_timeout))
+
+def stop_app(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+# ----------------------------------------------------------------------------
+# WORKER MEMORY
+# ----------------------------------------------------------------------------
+
+def child_pids(pid):
+    ''' Pids of the processes whose parent is pid (the gunicorn workers)'''
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as stat:
+                # pid (comm) state ppid ..., comm may contain spaces
+                if int(stat.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    children.append(int(name))
+        except (OSError, ValueError, IndexError):
+            pass
+    return children
+
+def rss_bytes(pid):
+    try:
+        with open('/proc/{}/statm'.format(pid)) as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class RssSampler(object):
+    ''' Samples the resident memory of the gunicorn master and its workers in the background,
+    keeping the peak and last value of each'''
+    def __init__(self, master_pid, interval=0.5):
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peak = {}
+        self.last = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        for pid in [self.master_pid] + child_pids(self.master_pid):
+            rss = rss_bytes(pid)
+            if rss is not None:
+                self.last[pid] = rss
+                self.peak[pid] = max(rss, self.peak.get(pid, 0))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+# ----------------------------------------------------------------------------
+# DASH TRAFFIC
+# ----------------------------------------------------------------------------
+
+def find_components(node, match):
+    ''' Props of the components in a layout or callback response for which match(props) is true'''
+    if isinstance(node, dict):
+        props = node.get('props')
+        if isinstance(props, dict) and match(props):
+            yield props
+        for value in node.values():
+            yield from find_components(value, match)
+    elif isinstance(node, list):
+        for value in node:
+            yield from find_components(value, match)
+
+def has_id(component_id):
+    return lambda props: props.get('id') == component_id
+
+def is_server_datatable(props):
+    return isinstance(props.get('id'), dict) and props['id'].get('type') == 'server-datatable'
+
+def dependency_id(dep_id, index=None):
+    ''' The id of a callback dependency, with the MATCH of a pattern id filled in with index'''
+    if not dep_id.startswith('{'):
+        return dep_id
+    return {key: index if value == ['MATCH'] else value for key, value in json.loads(dep_id).items()}
+
+def id_name(component_id):
+    return component_id['type'] if isinstance(component_id, dict) else component_id
+
+def prop_id(component_id, prop):
+    if isinstance(component_id, dict):
+        component_id = json.dumps(component_id, sort_keys=True, separators=(',', ':'))
+    return '{}.{}'.format(component_id, prop)
+
+def callback_body(dependency, values, changed, index=None):
+    ''' Request body of a callback as the Dash renderer sends it.  values maps (component
+    name, property) to the value, with the type of a pattern id as its name.'''
+    def items(deps):
+        items = []
+        for dep in deps:
+            component_id = dependency_id(dep['id'], index)
+            items.append({'id': component_id, 'property': dep['property'],
+                          'value': values.get((id_name(component_id), dep['property']))})
+        return items
+    output = dependency['output']
+    outputs = []
+    for part in output.strip('.').split('...'):
+        dep_id, prop = part.rsplit('.', 1)
+        outputs.append({'id': dependency_id(dep_id, index), 'property': prop})
+    changed_ids = [prop_id(dependency_id(dep['id'], index), dep['property'])
+                   for dep in dependency['inputs'] if (id_name(dependency_id(dep['id'])), dep['property']) in changed]
+    return {'output': output, 'outputs': outputs if output.startswith('..') else outputs[0],
+            'inputs': items(dependency['inputs']), 'state': items(dependency['state']),
+            'changedPropIds': changed_ids}
+
+class AppModel(object):
+    ''' What the virtual users need to know of the app: its callbacks, the snapshot version
+    and sites of the page, its tabs, and the server datatables of each tab'''
+    def __init__(self, base_url):
+        layout = requests.get(base_url + '_dash-layout', timeout=60).json()
+        dependencies = requests.get(base_url + '_dash-dependencies', timeout=60).json()
+        server_callbacks = [dep for dep in dependencies if not dep.get('clientside_function')]
+        self.tab_callback = next(dep for dep in server_callbacks if dep['output'] == 'tab_content.children')
+        self.site_figures_callback = next((dep for dep in server_callbacks if dep['output'] == 'store-site-figures.data'), None)
+        self.datatable_callback = next((dep for dep in server_callbacks if 'server-datatable' in dep['output']), None)
+        self.tab_reads_site = any(dep['id'] == 'dropdown-site' for dep in self.tab_callback['inputs'])
+        self.store = next(find_components(layout, has_id('store-latest')))['data']
+        self.sites = [option['value'] for option in next(find_components(layout, has_id('dropdown-site')))['options']]
+        tabs = next(find_components(layout, has_id('tabs_tables')))
+        self.first_tab = tabs['value']
+        self.tabs = [tab['value'] for tab in find_components(tabs['children'], lambda props: 'value' in props)]
+        self.datatables = {}
+
+    def values(self, site, tab):
+        return {('dropdown-site', 'value'): site, ('tabs_tables', 'value'): tab, ('store-latest', 'data'): self.store}
+
+    def remember_datatables(self, tab, response_text):
+        ''' Server datatables (index, props) of a tab's content'''
+        if tab not in self.datatables and 'server-datatable' in response_text:
+            self.datatables[tab] = [(props['id']['index'], props) for props in
+                                    find_components(json.loads(response_text), is_server_datatable)]
+        return self.datatables.get(tab, [])
+
+class VirtualUser(object):
+    def __init__(self, base_url, model, timings, rng, think):
+        self.base_url = base_url
+        self.model = model
+        self.timings = timings
+        self.rng = rng
+        self.think = think
+        self.session = requests.Session()
+
+    def request(self, kind, method, path, **kwargs):
+        if self.think:
+            time.sleep(self.rng.uniform(0, 2 * self.think))
+        start = time.perf_counter()
+        try:
+            r = self.session.request(method, self.base_url + path, timeout=300, **kwargs)
+            status, text = r.status_code, r.text
+        except requests.RequestException:
+            status, text = 'error', ''
+        self.timings.append((kind, time.perf_counter() - start, status))
+        return text
+
+    def callback(self, kind, dependency, values, changed, index=None):
+        return self.request(kind, 'POST', '_dash-update-component',
+                            json=callback_body(dependency, values, changed, index))
+
+    def show_tab(self, kind, site, tab, changed):
+        text = self.callback(kind, self.model.tab_callback, self.model.values(site, tab), changed)
+        return self.model.remember_datatables(tab, text)
+
+    def switch_site(self, site, tab, datatables):
+        model = self.model
+        if model.tab_reads_site:
+            self.show_tab('site switch', site, tab, {('dropdown-site', 'value')})
+            return
+        for index, props in datatables:
+            values = model.values(site, tab)
+            values.update({('server-datatable', prop): props.get(prop) for prop in ['page_size', 'sort_by', 'filter_query']})
+            values[('server-datatable', 'page_current')] = 0
+            values[('server-datatable', 'id')] = props['id']
+            self.callback('site switch (table)', model.datatable_callback, values, {('dropdown-site', 'value')}, index)
+
+    def run_session(self):
+        model = self.model
+        for path in ['', '_dash-layout', '_dash-dependencies']:
+            self.request('page load', 'GET', path)
+        if model.site_figures_callback is not None:
+            self.callback('site figures', model.site_figures_callback, model.values('all', model.first_tab),
+                          {('store-latest', 'data')})
+        datatables = self.show_tab('page load (tab)', 'all', model.first_tab, {('tabs_tables', 'value')})
+        tab = self.rng.choice(model.tabs)
+        if tab != model.first_tab:
+            datatables = self.show_tab('tab', 'all', tab, {('tabs_tables', 'value')})
+        sites = [site for site in model.sites if site != 'all']
+        self.rng.shuffle(sites)
+        for site in sites + ['all']:
+            self.switch_site(site, tab, datatables)
+
+def run_load(base_url, model, users, duration, think, seed):
+    ''' Run users virtual users for duration seconds.  Returns the (kind, seconds, status)
+    of every request, the sessions finished and the elapsed seconds.'''
+    timings = []
+    sessions = []
+    deadline = time.perf_counter() + duration
+    def run_user(i):
+        user = VirtualUser(base_url, model, timings, random.Random(seed + i), think)
+        while time.perf_counter() < deadline:
+            user.run_session()
+            sessions.append(i)
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run_user, args=(i,)) for i in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, len(sessions), time.perf_counter() - start
+
+# ----------------------------------------------------------------------------
+# REPORT
+# ----------------------------------------------------------------------------
+
+def is_error(status):
+    return status == 'error' or status >= 400
+
+def latency_stats(seconds):
+    ms = 1000 * np.asarray(seconds)
+    return {'count': len(ms), 'p50': np.percentile(ms, 50), 'p95': np.percentile(ms, 95),
+            'p99': np.percentile(ms, 99), 'max': ms.max()}
+
+def summarize(workers, users, timings, sessions, elapsed, sampler):
+    kinds = []
+    for kind, seconds, status in timings:
+        if kind not in kinds:
+            kinds.append(kind)
+    requests_by_kind = {}
+    for kind in kinds + ['all']:
+        rows = [(seconds, status) for k, seconds, status in timings if kind in ('all', k)]
+        stats = latency_stats([seconds for seconds, status in rows])
+        stats['errors'] = sum(is_error(status) for seconds, status in rows)
+        requests_by_kind[kind] = stats
+    master = sampler.master_pid
+    return {
+        'workers': workers, 'users': users, 'seconds': elapsed, 'sessions': sessions,
+        'requests_per_second': len(timings) / elapsed, 'requests': requests_by_kind,
+        'rss': {'master': {'peak': sampler.peak.get(master), 'last': sampler.last.get(master)},
+                'workers': {str(pid): {'peak': sampler.peak[pid], 'last': sampler.last.get(pid)}
+                            for pid in sorted(sampler.peak) if pid != master}},
+    }
+
+def megabytes(n):
+    return '{:.0f}'.format(n / 1e6) if n else '-'
+
+def print_summary(summary):
+    print('\n{workers} workers, {users} users, {seconds:.0f} s: {sessions} sessions, '
+          '{rps:.1f} requests/s'.format(rps=summary['requests_per_second'], **summary))
+    print('{:<22} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'request', 'count', 'errors', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'max (ms)'))
+    for kind, stats in summary['requests'].items():
+        print('{:<22} {:>7} {:>7} {:9.1f} {:9.1f} {:9.1f} {:9.1f}'.format(
+            kind, stats['count'], stats['errors'], stats['p50'], stats['p95'], stats['p99'], stats['max']))
+    print('{:<22} {:>14} {:>14}'.format('process', 'peak RSS (MB)', 'last RSS (MB)'))
+    rss = summary['rss']
+    print('{:<22} {:>14} {:>14}'.format('master', megabytes(rss['master']['peak']), megabytes(rss['master']['last'])))
+    for pid, worker in rss['workers'].items():
+        print('{:<22} {:>14} {:>14}'.format('worker ' + pid, megabytes(worker['peak']), megabytes(worker['last'])))
+
+def print_comparison(summaries):
+    print('\n{:>8} {:>6} {:>11} {:>9} {:>9} {:>9} {:>7} {:>21}'.format(
+        'workers', 'users', 'requests/s', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'errors', 'workers peak RSS (MB)'))
+    for summary in summaries:
+        stats = summary['requests']['all']
+        worker_rss = sum(worker['peak'] for worker in summary['rss']['workers'].values())
+        print('{:>8} {:>6} {:11.1f} {:9.1f} {:9.1f} {:9.1f} {:>7} {:>21}'.format(
+            summary['workers'], summary['users'], summary['requests_per_second'],
+            stats['p50'], stats['p95'], stats['p99'], stats['errors'], megabytes(worker_rss)))
+
+# ----------------------------------------------------------------------------
+# RUN
+# ----------------------------------------------------------------------------
+
+def run_config(workers, args, file_url_root, mcc_list):
+    with tempfile.TemporaryDirectory(prefix='load-test-') as work_dir:
+        process, base_url = start_app(workers, free_port(), file_url_root, mcc_list, work_dir, args.startup_timeout)
+        try:
+            model = AppModel(base_url)
+            if args.warmup > 0:
+                run_load(base_url, model, args.users, args.warmup, args.think, args.seed)
+            with RssSampler(process.pid) as sampler:
+                timings, sessions, elapsed = run_load(base_url, model, args.users, args.duration, args.think,
+                                                      args.seed + 1000)
+        finally:
+            stop_app(process)
+    return summarize(workers, args.users, timings, sessions, elapsed, sampler)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the dashboard under gunicorn against a stand-in report API.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[4], help='gunicorn worker counts to test (default 4)')
+    parser.add_argument('--users', type=int, default=16, help='concurrent virtual users (default 16)')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of load per worker count (default 60)')
+    parser.add_argument('--warmup', type=float, default=0,
+                        help='seconds of load before the measured run, to fill the caches (default 0)')
+    parser.add_argument('--think', type=float, default=0,
+                        help='mean seconds a user waits before each request (default 0, back to back)')
+    parser.add_argument('--visits', type=int, default=10000, help='participant-visits in the report (default 10000)')
+    parser.add_argument('--mcc', type=int, default=2, help='MCCs served by the stand-in API (default 2)')
+    parser.add_argument('--sites-per-mcc', type=int, default=3, help='screening sites per MCC (default 3)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the users\' tab and site choices (default 0)')
+    parser.add_argument('--startup-timeout', type=float, default=300, help='seconds to wait for the app (default 300)')
+    parser.add_argument('--out', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='report-api-') as serve_dir:
+        mcc_list = write_report_files(serve_dir, args.visits, args.mcc, args.sites_per_mcc)
+        server = serve(serve_dir)
+        file_url_root = 'http://127.0.0.1:{}/reports'.format(server.server_address[1])
+        summaries = []
+        for workers in args.workers:
+            summaries.append(run_config(workers, args, file_url_root, mcc_list))
+            print_summary(summaries[-1])
+        server.shutdown()
+    if len(summaries) > 1:
+        print_comparison(summaries)
+    if args.out:
+        with open(args.out, 'w') as out_file:
+            json.dump(summaries, out_file, indent=2, default=float)
@@ -0,0 +1,166 @@
+''' Benchmark suite for the ingest-to-render pipeline on synthetic payloads.
+
+Times each stage (read_blood_file, blood_visits_to_df, clean_blooddata, build_aggregate_cube, each make_* tab builder
+and the set_report_data request end to end, cold and cached) at several scales, and compares
+the times with the saved baselines in benchmarks/baselines.json.  A stage slower than its
+baseline by more than the threshold is reported as a regression and the run exits with 1.
+
+Run from the repository root:
+    python benchmarks/run_suite.py                      # compare with the baselines
+    python benchmarks/run_suite.py --save-baseline      # record new baselines
+    python benchmarks/run_suite.py --sizes 1000 500000 --threshold 0.25
+
+Baselines depend on the machine: record them on the machine the suite is run on.
+'''
+# Libraries
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+SRC_PATH = os.path.join(BENCHMARK_PATH, '..', 'src')
+BASELINE_FILE = os.path.join(BENCHMARK_PATH, 'baselines.json')
+sys.path.insert(0, SRC_PATH)
+
+# Keep the app from refreshing in the background or writing snapshots, history, pipeline
+# cache, export or metrics files into the repository while it is timed, and point the report
+# downloads at a closed local port so the app builds its first snapshot from the bundled
+# local file instead of fetching from TACC
+_bench_dir = tempfile.mkdtemp(prefix='bench-app-')
+for _name in ['SNAPSHOT_DIR', 'HISTORY_DIR', 'PIPELINE_CACHE_DIR', 'EXPORT_DIR', 'METRICS_DIR']:
+    os.environ.setdefault(_name, os.path.join(_bench_dir, _name.lower()))
+    os.makedirs(os.environ[_name], exist_ok=True)
+os.environ.setdefault('DATA_REFRESH_INTERVAL', '0')
+os.environ.setdefault('FETCH_RETRIES', '0')
+os.environ.setdefault('FILE_URL_ROOT', 'http://127.0.0.1:9/reports')
+
+from synthetic_data import write_blood_json
+
+# ----------------------------------------------------------------------------
+# STAGES
+# ----------------------------------------------------------------------------
+
+def best_of(fn, repeat, setup=None):
+    ''' Fastest of repeat runs of fn(setup()), and the last result'''
+    times = []
+    result = None
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        result = fn(arg) if setup else fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def tab_request(site, tab, version):
+    return {'output': 'tab_content.children',
+            'outputs': {'id': 'tab_content', 'property': 'children'},
+            'inputs': [{'id': 'dropdown-site', 'property': 'value', 'value': site},
+                       {'id': 'tabs_tables', 'property': 'value', 'value': tab},
+                       {'id': 'store-latest', 'property': 'data', 'value': {'version': version}}],
+            'changedPropIds': ['tabs_tables.value']}
+
+def clear_app_caches(app):
+    for cache in [app.tab_cache, app.datatable_cache, app.site_context_cache, app.response_cache]:
+        cache.clear()
+
+def run_size(app, n_visits, n_sites, missing_rate, repeat):
+    ''' {stage: seconds} for one payload size'''
+    import data_processing
+    import data_snapshots
+    times = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_blood_json(os.path.join(tmp_dir, 'blood.json'), n_visits, n_mcc=2,
+                         sites_per_mcc=max(1, n_sites // 2), missing_rate=missing_rate)
+        times['read_blood_file'], mcc_visits = best_of(lambda: data_processing.read_blood_file(tmp_dir, 'blood.json', [1, 2]), repeat)
+
+    times['blood_visits_to_df'], (blood_df, row_hashes) = best_of(lambda: data_processing.blood_visits_to_df(mcc_visits, [1, 2]), repeat)
+    times['clean_blooddata'], report_df = best_of(data_processing.clean_blooddata, repeat, setup=blood_df.copy)
+    times['build_aggregate_cube'], _ = best_of(lambda: data_processing.build_aggregate_cube(report_df), repeat)
+
+    snapshot = data_snapshots.make_snapshot(report_df, 'synthetic')
+    context = data_snapshots.make_site_context(snapshot, 'all')
+    for tab, label, builder in app.content_tabs_list:
+        times[builder.__name__], _ = best_of(lambda: builder(context), repeat)
+
+    # End to end through the Flask app: a cold request renders, encodes and compresses,
+    # a repeated one is served from the response cache
+    app.set_current_snapshot(snapshot)
+    client = app.app.server.test_client()
+    headers = {'Accept-Encoding': 'gzip, br'}
+    def request_all_tabs(_=None):
+        for tab, label, builder in app.content_tabs_list:
+            response = client.post('/_dash-update-component', json=tab_request('all', tab, snapshot['version']), headers=headers)
+            assert response.status_code == 200, response.data[:200]
+    times['set_report_data (cold)'], _ = best_of(request_all_tabs, repeat, setup=lambda: clear_app_caches(app))
+    times['set_report_data (cached)'], _ = best_of(request_all_tabs, repeat)
+    return times
+
+# ----------------------------------------------------------------------------
+# BASELINES
+# ----------------------------------------------------------------------------
+
+def read_baselines():
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE) as baseline_file:
+        return json.load(baseline_file)
+
+def write_baselines(baselines):
+    with open(BASELINE_FILE, 'w') as baseline_file:
+        json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write('\n')
+
+def compare(times, baseline, threshold, min_seconds):
+    ''' (stage, seconds, baseline seconds, status) rows.  Stages faster than min_seconds
+    are too noisy to flag.'''
+    rows = []
+    for stage, seconds in times.items():
+        base = baseline.get(stage)
+        if base is None:
+            status = 'new'
+        elif seconds > base * (1 + threshold) and seconds > min_seconds:
+            status = 'REGRESSION'
+        else:
+            status = 'ok'
+        rows.append((stage, seconds, base, status))
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the ingest-to-render pipeline.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='participant-visits per run (default 1000 10000 100000)')
+    parser.add_argument('--sites', type=int, default=6, help='screening sites (default 6)')
+    parser.add_argument('--missing-rate', type=float, default=0.05, help='share of missing values (default 0.05)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the fastest is kept (default 3)')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='allowed slowdown over the baseline, 0.5 = 50%% (default 0.5)')
+    parser.add_argument('--min-seconds', type=float, default=0.01,
+                        help='stages faster than this are never flagged (default 0.01)')
+    parser.add_argument('--save-baseline', action='store_true', help='save these times as the new baselines')
+    args = parser.parse_args()
+
+    import app
+    baselines = read_baselines()
+    regressions = 0
+    for n_visits in args.sizes:
+        key = '{}x{}'.format(n_visits, args.sites)
+        times = run_size(app, n_visits, args.sites, args.missing_rate, args.repeat)
+        print('\n{} participant-visits, {} sites'.format(n_visits, args.sites))
+        print('{:<28} {:>10} {:>12} {:>8}  {}'.format('stage', 'time (s)', 'baseline (s)', 'ratio', 'status'))
+        for stage, seconds, base, status in compare(times, baselines.get(key, {}), args.threshold, args.min_seconds):
+            print('{:<28} {:10.4f} {:>12} {:>8}  {}'.format(
+                stage, seconds, '-' if base is None else '{:.4f}'.format(base),
+                '-' if base is None else '{:.2f}'.format(seconds / base), status))
+            regressions += status == 'REGRESSION'
+        if args.save_baseline:
+            baselines[key] = times
+
+    if args.save_baseline:
+        write_baselines(baselines)
+        print('\nSaved baselines to ' + BASELINE_FILE)
+    elif regressions:
+        print('\n{} stage(s) slower than their baseline by more than {:.0%}'.format(regressions, args.threshold))
+        sys.exit(1)
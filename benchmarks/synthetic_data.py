@@ -0,0 +1,86 @@
+# Libraries
+import argparse
+import json
+import random
+from datetime import datetime, timedelta
+
+# ----------------------------------------------------------------------------
+# SYNTHETIC BLOOD REPORT PAYLOADS
+# ----------------------------------------------------------------------------
+
+VISITS = ['Baseline Visit', '6-Wks Post-Op', '3-Mo Post-Op']
+HEMOLYSIS_DEGREES = ['0', '.25', '.5', '1', '2']
+SITE_NAMES = ['Rush', 'UChicago', 'NorthShore', 'UMichigan', 'Wayne State', 'Spectrum', 'Corewell', 'Endeavor']
+
+def make_visit(rng, draw_time, missing_rate):
+    ''' One visit dictionary with string values, as the report API sends them'''
+    visit = {'bscp_protocol_dev': '0'}
+    if rng.random() < missing_rate:
+        # Missing blood draw: only a few fields are filled in
+        visit['bscp_aliq_cnt'] = '0'
+        return visit
+    centrifuge_time = draw_time + timedelta(minutes=rng.randint(5, 45))
+    freezer_time = centrifuge_time + timedelta(minutes=rng.randint(3, 40))
+    fields = {
+        'bscp_aliq_cnt': str(rng.choice([8, 8, 8, 6, 5, 4, 1])),
+        'bscp_time_blood_draw': draw_time.strftime('%Y-%m-%d %H:%M'),
+        'bscp_time_centrifuge': centrifuge_time.strftime('%Y-%m-%d %H:%M'),
+        'bscp_aliquot_freezer_time': freezer_time.strftime('%Y-%m-%d %H:%M'),
+        'bscp_deg_of_hemolysis': rng.choice(HEMOLYSIS_DEGREES),
+    }
+    for col, value in fields.items():
+        if rng.random() >= missing_rate:
+            visit[col] = value
+    if rng.random() < 0.1:
+        visit['bscp_protocol_dev'] = '1'
+        visit['bscp_protocol_dev_reason'] = str(rng.randint(1, 3))
+    for flag_col in ['bscp_sample_obtained', 'bscp_buffycoat_na', 'bscp_lav1_not_obt', 'bscp_paxg_aliq_na']:
+        if rng.random() < 0.03:
+            visit[flag_col] = '1'
+    if rng.random() < 0.15:
+        visit['bscp_comments'] = 'Synthetic comment.'
+    return visit
+
+def make_blood_json(n_visits, n_mcc=2, sites_per_mcc=2, missing_rate=0.05, seed=0):
+    ''' Build a {mcc: {record_id: {visit: {field: value}}}} payload with about n_visits
+    participant-visits spread over n_mcc * sites_per_mcc screening sites'''
+    rng = random.Random(seed)
+    start = datetime(2021, 3, 1, 8, 0)
+    blood_json = {}
+    visits_per_record = 2
+    n_records = max(1, n_visits // visits_per_record)
+    site_names = SITE_NAMES + ['Site ' + str(i) for i in range(len(SITE_NAMES), n_mcc * sites_per_mcc)]
+    for mcc in range(1, n_mcc + 1):
+        sites = site_names[(mcc - 1) * sites_per_mcc:mcc * sites_per_mcc]
+        records = {}
+        for i in range(n_records // n_mcc):
+            record = {'screening_site': rng.choice(sites)}
+            draw_time = start + timedelta(days=rng.randint(0, 500), minutes=rng.randint(0, 480))
+            n = rng.choice([1, 2, 3])
+            for v, visit_name in enumerate(VISITS[:n]):
+                record[visit_name] = make_visit(rng, draw_time + timedelta(weeks=6 * v), missing_rate)
+            if rng.random() < 0.02:
+                # Records without a screening site are dropped by the ingest
+                record.pop('screening_site')
+            records[str(mcc * 10000 + i)] = record
+        blood_json[str(mcc)] = records
+    return blood_json
+
+def write_blood_json(file_path, n_visits, **kwargs):
+    ''' Write a synthetic payload to file_path, in the format of assets/blood_dict.json'''
+    blood_json = make_blood_json(n_visits, **kwargs)
+    with open(file_path, 'w') as json_file:
+        json.dump(blood_json, json_file)
+    return blood_json
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic blood report payload.')
+    parser.add_argument('out', help='output json file')
+    parser.add_argument('--visits', type=int, default=10000, help='participant-visits (default 10000)')
+    parser.add_argument('--mcc', type=int, default=2, help='number of MCCs (default 2)')
+    parser.add_argument('--sites-per-mcc', type=int, default=3, help='screening sites per MCC (default 3)')
+    parser.add_argument('--missing-rate', type=float, default=0.05, help='share of missing values (default 0.05)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_blood_json(args.out, args.visits, n_mcc=args.mcc, sites_per_mcc=args.sites_per_mcc,
+                     missing_rate=args.missing_rate, seed=args.seed)
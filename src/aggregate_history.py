@@ -0,0 +1,244 @@
+# Libraries
+import os
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+from config_settings import *
+from data_processing import *
+from data_cache import *
+from data_snapshots import *
+
+# ----------------------------------------------------------------------------
+# HISTORY ROWS
+# ----------------------------------------------------------------------------
+
+# Each report date adds a point: the non-zero cells of the aggregate cube of the snapshot
+# current that day for these metrics, summed to (Site, Visit, Level): Pass / Fail counts
+# of the site and timing metrics and record counts by degree of hemolysis.  Days the data
+# didn't change add a point of the same snapshot, so the trends have no gaps.  That is a
+# few hundred rows per point, so a year of weekly points is read in kilobytes instead of
+# loading 52 report files.
+HISTORY_METRICS = [metric['metric'] for metric in site_metrics + timing_metrics] + ['Hemolysis']
+HISTORY_KEYS = ['report_date', 'loaded_at', 'version', 'Site', 'Visit', 'Metric', 'Level']
+
+def history_rows(snapshot, report_date=None, loaded_at=None):
+    ''' The snapshot's aggregates as the history rows of a point, by default of its own
+    report date and load time'''
+    counts = cube_counts(snapshot['cube'], HISTORY_METRICS)
+    counts = counts[counts['count'] > 0]
+    rows = pd.DataFrame({
+        'report_date': report_date or snapshot['report_date'],
+        'loaded_at': (loaded_at or snapshot['loaded_at']).isoformat(timespec='seconds'),
+        'version': snapshot['version'],
+        'Site': counts['Site'].values,
+        'Visit': counts['Visit'].values,
+        'Metric': counts['Metric'].values,
+        'Level': counts['Level'].astype(str).values,
+        'count': counts['count'].values.astype(np.int32),
+    })
+    return compact_history(rows)
+
+def compact_history(history):
+    ''' history with its repeated text columns stored as categoricals'''
+    for col in HISTORY_KEYS:
+        history[col] = history[col].astype('category')
+    return history.reset_index(drop=True)
+
+# ----------------------------------------------------------------------------
+# HISTORY STORE
+# ----------------------------------------------------------------------------
+
+# One directory per report of Arrow IPC (feather) files.  Each point is appended as a file
+# of its rows, and once there are more than HISTORY_COMPACT_SEGMENTS files they are merged
+# into one.  Files are never changed once written, so readers need no lock; a reader
+# listing the files during a merge skips the points it has already read.  A point is a
+# (report date, version): a report date whose data changed later in the day has a point
+# for each version, and readers keep the last one loaded.
+
+def history_path(report, history_dir=HISTORY_DIR):
+    return os.path.join(history_dir, report)
+
+def history_files(report, history_dir=HISTORY_DIR):
+    ''' Files of the report's history store, oldest first'''
+    store_dir = history_path(report, history_dir)
+    try:
+        names = [name for name in os.listdir(store_dir) if name.endswith('.arrow')]
+    except OSError:
+        return []
+    return [os.path.join(store_dir, name) for name in sorted(names)]
+
+def point_ids(history):
+    ''' 'report date|version' of each history row'''
+    return history['report_date'].astype(str) + '|' + history['version'].astype(str)
+
+def latest_points(history):
+    ''' Rows of the last point loaded on each report date'''
+    loaded_at = history['loaded_at'].astype(str)
+    last_loaded = loaded_at.groupby(history['report_date'].astype(str).values).transform('max')
+    return history[(loaded_at == last_loaded).values]
+
+def read_history_files(paths):
+    ''' Rows of the history files, the last point of each report date once'''
+    parts = []
+    seen = set()
+    for path in paths:
+        try:
+            part = feather.read_feather(path)
+        except (OSError, ValueError) as e:
+            print('Could not read history file', path, e)
+            continue
+        ids = point_ids(part)
+        points = set(ids.unique())
+        if points & seen:
+            part = part[~ids.isin(seen).values]
+        seen |= points
+        parts.append(part.astype({col: object for col in HISTORY_KEYS}))
+    if not parts:
+        return compact_history(pd.DataFrame({col: [] for col in HISTORY_KEYS + ['count']}).astype({'count': np.int32}))
+    return compact_history(latest_points(pd.concat(parts, ignore_index=True)))
+
+def write_history_file(history, path):
+    tmp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    feather.write_feather(history, tmp_path)
+    os.replace(tmp_path, path)
+
+def stored_points(paths):
+    ''' (report date, version) of the points in the history files'''
+    points = set()
+    for path in paths:
+        try:
+            table = feather.read_table(path, columns=['report_date', 'version'])
+        except (OSError, ValueError):
+            continue
+        points |= set(zip(table.column('report_date').to_pylist(), table.column('version').to_pylist()))
+    return points
+
+def compact_history_files(report, history_dir=HISTORY_DIR):
+    ''' Merge the report's history files into one, with rows in report date order.  Call
+    with the store's lock held.'''
+    paths = history_files(report, history_dir)
+    if len(paths) < 2:
+        return
+    history = read_history_files(paths)
+    history = history.sort_values(by=['report_date', 'loaded_at'], kind='mergesort')
+    name = 'history-{}-{}.arrow'.format(history['report_date'].iloc[-1],
+                                        hashlib.sha1(''.join(paths).encode('utf-8')).hexdigest()[:8])
+    write_history_file(compact_history(history), os.path.join(history_path(report, history_dir), name))
+    for path in paths:
+        if os.path.basename(path) != name:
+            os.remove(path)
+
+def append_history(snapshot, report, history_dir=HISTORY_DIR, compact_after=HISTORY_COMPACT_SEGMENTS,
+                   report_date=None, loaded_at=None):
+    ''' Add the snapshot's aggregates to the report's history store as the point of
+    report_date (by default the snapshot's own, see history_rows), unless the store has
+    that point already.  Returns True when rows were added.'''
+    report_date = report_date or snapshot['report_date']
+    try:
+        with file_lock(os.path.join(history_path(report, history_dir), '.lock')):
+            paths = history_files(report, history_dir)
+            if (report_date, snapshot['version']) in stored_points(paths):
+                return False
+            name = 'segment-{}-{}.arrow'.format(report_date, snapshot['version'])
+            write_history_file(history_rows(snapshot, report_date, loaded_at),
+                               os.path.join(history_path(report, history_dir), name))
+            if len(paths) + 1 > compact_after:
+                compact_history_files(report, history_dir)
+    except Exception as e:
+        print('Could not add snapshot to the history:', e)
+        return False
+    return True
+
+def backfill_history(snapshot_dir, report, history_dir=HISTORY_DIR):
+    ''' Add the points of the report's saved snapshots, on their report dates, that the
+    history store doesn't have yet, e.g. those ingested from the report archive'''
+    points = stored_points(history_files(report, history_dir))
+    added = 0
+    for entry in reversed(list_snapshot_entries(snapshot_dir, report)):
+        if (entry.get('report_date', entry['loaded_at'][:10]), entry['version']) in points:
+            continue
+        try:
+            snapshot = load_snapshot_file(snapshot_dir, entry)
+        except Exception as e:
+            print('Could not load snapshot', entry['file'], e)
+            continue
+        added += append_history(snapshot, report, history_dir)
+    return added
+
+# Histories read by this worker, by the files they were read from
+history_cache = LRUCache(4)
+
+def history_key(report, history_dir=HISTORY_DIR):
+    ''' The files of the report's history store, which change with every point added, for
+    keying anything built from the history'''
+    return tuple(history_files(report, history_dir))
+
+def read_history(report, history_dir=HISTORY_DIR):
+    ''' All rows of the report's history store'''
+    key = history_key(report, history_dir)
+    return history_cache.get_or_build(key, lambda: read_history_files(list(key)))
+
+# ----------------------------------------------------------------------------
+# TRENDS
+# ----------------------------------------------------------------------------
+
+def history_until(history, version, report_date):
+    ''' The last report date of a snapshot's data: its report date, or the last later one
+    with a point of the same version, added while the data didn't change'''
+    dates = history.loc[(history['version'].astype(str) == version).values, 'report_date'].astype(str)
+    return max([report_date] + list(dates.unique()))
+
+def weekly_history(history, until=None):
+    ''' Rows of the last point of each week (weeks start on Monday), up to the report date
+    until, with the week's first day in a Week column.  history has one point per report
+    date (see read_history_files).'''
+    report_dates = history['report_date'].astype(str)
+    if until is not None:
+        history = history[(report_dates <= until).values]
+        report_dates = report_dates[(report_dates <= until).values]
+    dates = pd.Series(report_dates.unique(), dtype=object)
+    if dates.empty:
+        return history.assign(Week=pd.Series([], dtype=object))
+    parsed = pd.to_datetime(dates)
+    points = pd.DataFrame({'report_date': dates,
+                           'Week': (parsed - pd.to_timedelta(parsed.dt.weekday, unit='D')).dt.strftime('%Y-%m-%d')})
+    latest = points.sort_values(by='report_date').drop_duplicates(subset=['Week'], keep='last')
+    weeks = latest.set_index('report_date')['Week']
+    in_week = report_dates.isin(weeks.index).values
+    weekly = history[in_week]
+    return weekly.assign(Week=report_dates[in_week].map(weeks).values)
+
+def trend_group(site):
+    ''' Trends of all sites compare the sites, trends of one site its visits'''
+    return 'Site' if site == 'all' else 'Visit'
+
+def metric_trend(weekly, metric, site='all'):
+    ''' Count, Fail and Percent (of counted samples that pass) of a Pass / Fail metric by
+    week and site, or by week and visit for one site'''
+    group = trend_group(site)
+    rows = weekly[(weekly['Metric'] == metric).values]
+    if site != 'all':
+        rows = rows[(rows['Site'] == site).values]
+    rows = rows.assign(Fail=np.where(rows['Level'] == 'Fail', rows['count'], 0))
+    trend = rows.groupby(['Week', group], observed=True)[['count', 'Fail']].sum().reset_index()
+    trend = trend.rename(columns={'count': 'Count'})
+    trend[group] = trend[group].astype(str)
+    trend['Percent'] = 100 * (trend['Count'] - trend['Fail']) / trend['Count']
+    return trend.sort_values(by=[group, 'Week']).reset_index(drop=True)
+
+def hemolysis_trend(weekly, site='all'):
+    ''' Records by week and degree of hemolysis, with the Percent of the week's rated
+    records, for all sites or one'''
+    rows = weekly[(weekly['Metric'] == 'Hemolysis').values]
+    if site != 'all':
+        rows = rows[(rows['Site'] == site).values]
+    trend = rows.groupby(['Week', 'Level'], observed=True)['count'].sum().reset_index()
+    trend = trend.rename(columns={'Level': 'Hemolysis'})
+    trend['Hemolysis'] = trend['Hemolysis'].astype(str)
+    trend['Percent'] = 100 * trend['count'] / trend.groupby('Week')['count'].transform('sum')
+    degree_order = {degree: i for i, degree in enumerate(ordered_levels(trend['Hemolysis']))}
+    trend['order'] = trend['Hemolysis'].map(degree_order)
+    return trend.sort_values(by=['order', 'Week']).drop(columns='order').reset_index(drop=True)
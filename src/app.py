@@ -8,38 +8,68 @@ import dash_html_components as html
 import dash_bootstrap_components as dbc
 import dash_table as dt
 import dash_daq as daq
-from dash.dependencies import Input, Output, State, ALL, MATCH
+from dash.dependencies import Input, Output, State, ALL, MATCH, ClientsideFunction
 from dash.exceptions import PreventUpdate
+import flask
+import time
+import os
+from datetime import datetime
 
 # import local modules
 from config_settings import *
 from data_processing import *
+from data_snapshots import *
+from report_pipeline import *
+from aggregate_history import *
+from data_cache import *
+from response_cache import *
+from instrumentation import *
+from exports import *
 from make_components import *
 from styling import *
 
 # ----------------------------------------------------------------------------
 # Parameters
 # ----------------------------------------------------------------------------
-file_url_root ='https://api.a2cps.org/files/v2/download/public/system/a2cps.storage.community/reports'
-report = 'blood'
-mcc_list=[1,2]
-local_datafile = 'blood_dict.json'
+file_url_root = FILE_URL_ROOT
+report = REPORT
+if report not in report_definitions:
+    raise ValueError('Unknown report {!r}: set REPORT to one of {}'.format(report, ', '.join(sorted(report_definitions))))
+mcc_list = MCC_LIST
+fetch_options = {'timeout': (FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT), 'retries': FETCH_RETRIES}
 
-data_load = load_latest_data(file_url_root, report, mcc_list)
-if data_load:
-    blood_dict = data_load
-    file_source = 'TACC files'
-else:
-    blood_dict = load_data_file(ASSETS_PATH, local_datafile)
-    file_source = 'local files'
-blood_df = bloodjson_to_df(blood_dict, mcc_list)
+def build_report_snapshot(local_fallback=True, previous=None):
+    results = run_pipeline([report], mcc_list, file_url_root, ASSETS_PATH, local_fallback,
+                           {report: previous} if previous is not None else None, **fetch_options)
+    snapshot = make_pipeline_snapshot(results.get(report), previous)
+    if snapshot is not None:
+        remember_stages(report, results[report], snapshot['version'])
+        # Every load from TACC adds today's point to the history the trend tabs read, also
+        # when the data didn't change
+        if results[report]['source'] == 'TACC files':
+            loaded_at = datetime.now()
+            append_history(snapshot, report, report_date=loaded_at.strftime('%Y-%m-%d'), loaded_at=loaded_at)
+    return snapshot
 
-report_df = clean_blooddata(blood_df)
-report_dict = report_df.to_dict('records')
+# Save every snapshot fetched from TACC so the next start (and the other workers) can skip
+# the ingest
+@on_snapshot_change
+def save_report_snapshot(old_snapshot, new_snapshot):
+    if new_snapshot['source'] == 'TACC files' and 'file' not in new_snapshot:
+        save_snapshot(new_snapshot, SNAPSHOT_DIR, report)
 
-sites = list(report_df.sort_values(by=['Site'])['Site'].unique())
+# Add any new dated report files from the archive to the saved snapshots, and saved
+# snapshots missing from the history to it
+ingest_report_archive(REPORT_ARCHIVE_DIR, report, mcc_list, SNAPSHOT_DIR)
+backfill_history(SNAPSHOT_DIR, report)
 
-source = 'Data Source: ' + file_source
+# Start from the last saved snapshot if there is one and refresh it straight away in the
+# background.  Otherwise build the first snapshot at import so the app starts with data.
+saved_snapshot = load_latest_snapshot_file(SNAPSHOT_DIR, report)
+if saved_snapshot is not None:
+    set_current_snapshot(saved_snapshot)
+else:
+    set_current_snapshot(build_report_snapshot())
 
 # ----------------------------------------------------------------------------
 # APP Settings
@@ -58,60 +88,139 @@ app = dash.Dash(__name__,
 # Page component Parts
 # ----------------------------------------------------------------------------
 
-header = html.Div([
-    dcc.Store(id='store-latest',
-        data = report_dict
-    ),
-    dbc.Row([
-        dbc.Col([html.H1('A2CPS Blood Draw Report'), html.H5(source)],width=8),
-        dbc.Col([html.Div([
-            html.H5('Report Date:'),
-            dcc.Dropdown(
-                id='dropdown-date',
-                options=[
-                    {'label': 'latest', 'value': 'latest'}
-                ],
-                value='latest',
-            ),
-        ])],width=2),
-        dbc.Col([html.Div([
-            html.H5('Site:'),
-            dcc.Dropdown(
-                id='dropdown-site',
-                options=[{'label': 'All Sites', 'value': 'all'}] + [{'label': k, 'value': k} for k in sites],
-                value='all',
-            ),
-        ])],width=2),
-    ]),
-])
-
-def make_content_tabs(report_df):
-    content_tabs = html.Div([
-        dcc.Tabs(id='tabs_tables', children=[
-            dcc.Tab(label='Missing Values', children=[
-                html.Div(make_missing(report_df), id='tab_missing'),
-            ]),
-            dcc.Tab(label='Site Info', children=[
-                html.Div(make_site(report_df), id='tab_site'),
-            ]),
-            dcc.Tab(label='Timing', children=[
-                html.Div(make_timing(report_df), id='tab_timing'),
-            ]),
-            dcc.Tab(label='Hemolysis', children=[
-                html.Div(make_hemolysis(report_df), id='tab_hemolysis'),
-            ]),
-            dcc.Tab(label='Deviations', children=[
-                html.Div(make_deviations(report_df), id='tab_deviations'),
-            ]),
+def make_source_label(snapshot):
+    if snapshot['source'] == 'archive':
+        source = 'Data Source: report archive (report date ' + snapshot['report_date']
+    else:
+        source = 'Data Source: ' + snapshot['source']
+        source = source + ' (loaded ' + snapshot['loaded_at'].strftime('%Y-%m-%d %H:%M')
+    source = source + ', version ' + snapshot['version'] + ')'
+    return source
+
+def make_date_options():
+    ''' 'latest' plus each saved snapshot, newest report date first'''
+    options = [{'label': 'latest', 'value': 'latest'}]
+    for entry in list_snapshot_entries(SNAPSHOT_DIR, report):
+        label = entry['report_date']
+        if entry['source'] != 'archive':
+            label = label + ' ' + entry['loaded_at'][11:16]
+        label = label + ' (MCC ' + ', '.join(sorted(entry.get('mcc_rows', {}))) + ')'
+        options.append({'label': label, 'value': entry['version']})
+    return options
+
+def make_site_options(snapshot):
+    return [{'label': 'All Sites', 'value': 'all'}] + [{'label': k, 'value': k} for k in snapshot['sites']]
+
+def make_header(snapshot):
+    # The data stays on the server: the page only holds the snapshot version, and with
+    # CLIENTSIDE_SITE_SWITCH the figures of every site
+    stores = [dcc.Store(id='store-latest', data={'version': snapshot['version']})]
+    if CLIENTSIDE_SITE_SWITCH:
+        stores.append(dcc.Store(id='store-site-figures'))
+    header = html.Div(stores + [
+        dbc.Row([
+            dbc.Col([html.H1('A2CPS Blood Draw Report'), html.H5(make_source_label(snapshot), id='source-label')],width=8),
+            dbc.Col([html.Div([
+                html.H5('Report Date:'),
+                dcc.Dropdown(
+                    id='dropdown-date',
+                    options=make_date_options(),
+                    value='latest',
+                    clearable=False,
+                ),
+            ])],width=2),
+            dbc.Col([html.Div([
+                html.H5('Site:'),
+                dcc.Dropdown(
+                    id='dropdown-site',
+                    options=make_site_options(snapshot),
+                    value='all',
+                ),
+            ])],width=2),
         ]),
-        ])
-    return content_tabs
+    ])
+    return header
+
+# Tab builders by tab id, in display order
+content_tabs_list = [
+    ('missing', 'Missing Values', make_missing),
+    ('site', 'Site Info', make_site),
+    ('timing', 'Timing', make_timing),
+    ('hemolysis', 'Hemolysis', make_hemolysis),
+    ('deviations', 'Deviations', make_deviations),
+    ('trends', 'Trends', make_trends),
+    ('hemolysis_trend', 'Hemolysis Trend', make_hemolysis_trend),
+]
+tab_builders = {tab: builder for tab, label, builder in content_tabs_list}
+
+# Built tab contents are cached by (snapshot version, site, tab).  Entries of a snapshot
+# are dropped as soon as a newer snapshot replaces it, except that when the new snapshot
+# was built incrementally from the old one, entries of sites whose rows did not change
+# are moved to the new version.  Trend tabs gain a point with every report date, so they
+# are never moved, and their keys include the history store's files.
+history_tabs = ['trends', 'hemolysis_trend']
+
+def tab_key(snapshot, site, tab):
+    key = (snapshot['version'], site, tab)
+    if tab in history_tabs or tab == 'site-figures':
+        key = key + (history_key(report),)
+    return key
+
+def carry_over_key(old_snapshot, new_snapshot):
+    ''' rekey function moving cache keys of old_snapshot's unchanged sites to new_snapshot'''
+    old_version = old_snapshot['version']
+    new_version = new_snapshot['version']
+    incremental = new_snapshot.get('base_version') == old_version
+    dirty_sites = new_snapshot.get('dirty_sites', set())
+    def rekey_fn(key):
+        if key[0] != old_version:
+            return key
+        if incremental and key[1] != 'all' and key[1] not in dirty_sites and key[2] not in history_tabs:
+            return (new_version,) + key[1:]
+        return None
+    return rekey_fn
+
+tab_cache = LRUCache(TAB_CACHE_SIZE)
+
+@on_snapshot_change
+def invalidate_tab_cache(old_snapshot, new_snapshot):
+    if old_snapshot is not None and old_snapshot['version'] != new_snapshot['version']:
+        tab_cache.rekey(carry_over_key(old_snapshot, new_snapshot))
+
+# The frames shared by every tab of a site are derived once per (snapshot version, site)
+site_context_cache = LRUCache(SITE_CONTEXT_CACHE_SIZE)
+
+@on_snapshot_change
+def invalidate_site_context_cache(old_snapshot, new_snapshot):
+    if old_snapshot is not None and old_snapshot['version'] != new_snapshot['version']:
+        site_context_cache.discard(lambda key: key[0] == old_snapshot['version'])
+
+def get_site_context(snapshot, site):
+    key = (snapshot['version'], site)
+    return site_context_cache.get_or_build(key, lambda: make_site_context(snapshot, site))
+
+def build_tab_content(snapshot, site, tab):
+    with timed('a2cps_tab_build_seconds', tab=tab):
+        return tab_builders[tab](get_site_context(snapshot, site))
+
+def get_tab_content(snapshot, site, tab):
+    key = tab_key(snapshot, site, tab)
+    return tab_cache.get_or_build(key, lambda: build_tab_content(snapshot, site, tab))
+
+# Only the selected tab's content is built and sent; the others are built when clicked
+content_tabs = html.Div([
+    dcc.Tabs(id='tabs_tables', value=content_tabs_list[0][0], children=[
+        dcc.Tab(label=label, value=tab) for tab, label, builder in content_tabs_list
+    ]),
+    html.Div(id='tab_content'),
+    ])
 
 # ----------------------------------------------------------------------------
 # DASH APP LAYOUT FUNCTION
 # ----------------------------------------------------------------------------
 
 def serve_layout():
+    snapshot = get_current_snapshot()
     # try:
     dcc.Store(id='report_data'),
     page_layout = html.Div([
@@ -119,10 +228,10 @@ def serve_layout():
             dbc.Col(id='testdiv'),
         ],style={"margin":"10px"}),
         dbc.Row([
-            dbc.Col(header),
+            dbc.Col(make_header(snapshot)),
         ],style={"margin":"10px"}),
         dbc.Row([
-            dbc.Col(id='contents_div'),
+            dbc.Col(content_tabs, id='contents_div'),
         ],style={"margin":"10px"}),
     ])
     # except:
@@ -131,19 +240,288 @@ def serve_layout():
 
 app.layout = serve_layout
 
+# Refreshes only re-clean the MCC files and rows that changed since the current snapshot,
+# and never fall back to the bundled local file.  One worker refreshes, the others load the snapshots it saves.  Registered after the
+# layout: Dash calls serve_layout when it is set, which under gunicorn --preload happens in
+# the master process, and the master must not start the refresh thread.
+start_snapshot_refresh(lambda: build_report_snapshot(local_fallback=False, previous=get_current_snapshot()), DATA_REFRESH_INTERVAL,
+                       refresh_first=saved_snapshot is not None,
+                       lock_path=os.path.join(SNAPSHOT_DIR, '.refresh.lock'),
+                       follow_fn=lambda: load_newer_snapshot(SNAPSHOT_DIR, report, get_current_snapshot()))
+
 
 # ----------------------------------------------------------------------------
 # DATA CALLBACKS
 # ----------------------------------------------------------------------------
 
-# Allow User to run report for all Sites, or just for one.
-@app.callback(Output("contents_div","children"), Input('dropdown-site',"value"))
-def set_report_data(site):
-    if site == 'all':
-        site_df = report_df
-    else:
-        site_df = report_df[report_df['Site'] == site]
-    return make_content_tabs(site_df)
+def get_store_snapshot(store):
+    ''' Look up the snapshot the page was rendered from by the version in store-latest'''
+    version = store.get('version') if store else None
+    return get_snapshot(version)
+
+def snapshot_site(snapshot, site):
+    ''' site if the snapshot has it, otherwise 'all' (a cleared dropdown sends None).  Keeps
+    made-up site names from the request out of the cache keys.'''
+    return site if site == 'all' or site in snapshot['sites'] else 'all'
+
+# Switch the page to another saved snapshot.  Sites missing from it fall back to 'all'.
+@app.callback(Output('store-latest', 'data'), Output('dropdown-site', 'options'),
+              Output('dropdown-site', 'value'), Output('source-label', 'children'),
+              Input('dropdown-date', 'value'), State('dropdown-site', 'value'),
+              prevent_initial_call=True)
+def set_report_date(version, site):
+    snapshot = get_snapshot(None if version == 'latest' else version)
+    site = snapshot_site(snapshot, site)
+    return {'version': snapshot['version']}, make_site_options(snapshot), site, make_source_label(snapshot)
+
+# Allow User to run report for all Sites, or just for one.  Builds the selected tab only.
+def set_report_data(site, tab, store):
+    if tab not in tab_builders:
+        raise PreventUpdate
+    # Read the snapshot once so a background swap can't change the data mid-callback
+    snapshot = get_store_snapshot(store)
+    return render_tab_content(snapshot, snapshot_site(snapshot, site), tab)
+
+# With CLIENTSIDE_SITE_SWITCH the site is only read when a tab is rendered: changing it
+# swaps the figures in the browser instead (see switch_site_figures)
+if CLIENTSIDE_SITE_SWITCH:
+    app.callback(Output("tab_content","children"), Input('tabs_tables',"value"), Input('store-latest', 'data'),
+                 State('dropdown-site',"value"))(lambda tab, store, site: set_report_data(site, tab, store))
+else:
+    app.callback(Output("tab_content","children"), Input('dropdown-site',"value"), Input('tabs_tables',"value"),
+                 Input('store-latest', 'data'))(set_report_data)
+
+def render_tab_content(snapshot, site, tab):
+    return html.Div(get_tab_content(snapshot, site, tab), id='tab_' + tab)
+
+# set_report_data responses are also kept as serialized JSON bytes per (snapshot version,
+# site, tab), with their gzip / brotli variants, and served before Dash dispatches the
+# callback.  Repeated requests then skip rendering, JSON encoding and compression.
+response_cache = LRUCache(TAB_CACHE_SIZE)
+
+@on_snapshot_change
+def invalidate_response_cache(old_snapshot, new_snapshot):
+    if old_snapshot is not None and old_snapshot['version'] != new_snapshot['version']:
+        response_cache.rekey(carry_over_key(old_snapshot, new_snapshot))
+
+def get_callback_inputs(body):
+    ''' {(id, property): value} of a callback request's inputs and states'''
+    dependencies = body.get('inputs', []) + body.get('state', [])
+    return {(i['id'], i['property']): i.get('value') for i in dependencies if isinstance(i, dict)}
+
+# Time every Dash callback request by its output.  The timer is registered before
+# serve_tab_content so requests it answers from the response cache are timed too, and
+# stopped after flask-compress (after_request functions run in reverse order of
+# registration) so the time and size include compression.
+callback_path = app.config.routes_pathname_prefix + '_dash-update-component'
+
+def callback_label(output):
+    ''' The output of a registered callback, 'other' for anything else a client sends, so
+    requests can't add metric series'''
+    return output if isinstance(output, str) and output in app.callback_map else 'other'
+
+@app.server.before_request
+def start_callback_timer():
+    ensure_metrics_flush()
+    request = flask.request
+    if request.method == 'POST' and request.path == callback_path:
+        body = request.get_json(silent=True) or {}
+        flask.g.callback_timer = (time.perf_counter(), callback_label(body.get('output')))
+
+def stop_callback_timer(response):
+    timer = flask.g.pop('callback_timer', None)
+    if timer is not None:
+        start, output = timer
+        observe('a2cps_dash_callback_seconds', time.perf_counter() - start, output=output, status=response.status_code)
+        if not response.is_streamed:
+            observe('a2cps_dash_callback_response_bytes', response.calculate_content_length() or 0, output=output)
+    return response
+app.server.after_request_funcs.setdefault(None, []).insert(0, stop_callback_timer)
+
+@app.server.before_request
+def serve_tab_content():
+    request = flask.request
+    if request.method != 'POST' or request.path != callback_path:
+        return None
+    body = request.get_json(silent=True) or {}
+    if body.get('output') == 'store-site-figures.data':
+        return serve_site_figures(body)
+    if body.get('output') != 'tab_content.children':
+        return None
+    inputs = get_callback_inputs(body)
+    tab = inputs.get(('tabs_tables', 'value'))
+    if tab not in tab_builders:
+        return None
+    snapshot = get_store_snapshot(inputs.get(('store-latest', 'data')))
+    site = snapshot_site(snapshot, inputs.get(('dropdown-site', 'value')))
+    key = tab_key(snapshot, site, tab)
+    entry = response_cache.get_or_build(key, lambda: make_response_entry(
+        {'response': {'tab_content': {'children': render_tab_content(snapshot, site, tab)}}, 'multi': True}))
+    return encoded_response(entry, request.headers.get('Accept-Encoding'))
+
+# ----------------------------------------------------------------------------
+# CLIENTSIDE SITE SWITCH
+# ----------------------------------------------------------------------------
+
+# With CLIENTSIDE_SITE_SWITCH the figures of every site are sent to the page once per
+# snapshot (store-site-figures), and changing the site swaps them in the browser
+# (assets/site_switch.js).  Server datatables go back to their first page, which fetches
+# the new site's rows from update_server_datatable.  The store is kept with the tab
+# contents; the key's 'all' site keeps it from being carried over to a newer snapshot, and
+# as it holds the trend figures its key includes the history store's files.
+def get_site_figure_store(snapshot):
+    key = tab_key(snapshot, 'all', 'site-figures')
+    sites = ['all'] + snapshot['sites']
+    return tab_cache.get_or_build(key, lambda: make_site_figure_store(
+        (site, get_site_context(snapshot, site)) for site in sites))
+
+def make_site_figures_response(snapshot):
+    store = get_site_figure_store(snapshot)
+    return make_response_entry({'response': {'store-site-figures': {'data': store}}, 'multi': True})
+
+def serve_site_figures(body):
+    ''' The figure store of the page's snapshot, cached as encoded bytes like the tab content'''
+    snapshot = get_store_snapshot(get_callback_inputs(body).get(('store-latest', 'data')))
+    key = tab_key(snapshot, 'all', 'site-figures')
+    entry = response_cache.get_or_build(key, lambda: make_site_figures_response(snapshot))
+    return encoded_response(entry, flask.request.headers.get('Accept-Encoding'))
+
+if CLIENTSIDE_SITE_SWITCH:
+    # Usually answered from the encoded response cache by serve_site_figures first
+    @app.callback(Output('store-site-figures', 'data'), Input('store-latest', 'data'))
+    def set_site_figures(store):
+        return get_site_figure_store(get_store_snapshot(store))
+
+    app.clientside_callback(ClientsideFunction(namespace='site_switch', function_name='switch_site_figures'),
+                            Output({'type': 'site-graph', 'index': ALL}, 'figure'),
+                            Input('dropdown-site', 'value'), Input('store-site-figures', 'data'),
+                            State({'type': 'site-graph', 'index': ALL}, 'id'),
+                            prevent_initial_call=True)
+
+    app.clientside_callback(ClientsideFunction(namespace='site_switch', function_name='first_pages'),
+                            Output({'type': 'server-datatable', 'index': ALL}, 'page_current'),
+                            Input('dropdown-site', 'value'),
+                            State({'type': 'server-datatable', 'index': ALL}, 'id'),
+                            prevent_initial_call=True)
+
+# Page, sort and filter server side datatables.  The table's dataframe is rebuilt from
+# the snapshot (and cached) rather than kept in the browser.
+datatable_cache = LRUCache(TAB_CACHE_SIZE)
+
+@on_snapshot_change
+def invalidate_datatable_cache(old_snapshot, new_snapshot):
+    if old_snapshot is not None and old_snapshot['version'] != new_snapshot['version']:
+        datatable_cache.rekey(carry_over_key(old_snapshot, new_snapshot))
+
+def get_datatable_df(snapshot, site, table_id):
+    key = (snapshot['version'], site, table_id)
+    return datatable_cache.get_or_build(key, lambda: datatable_sources[table_id](get_site_context(snapshot, site)))
+
+def update_server_datatable(page_current, page_size, sort_by, filter_query, table_id, site, store):
+    table_id = table_id['index']
+    if table_id not in datatable_sources:
+        raise PreventUpdate
+    snapshot = get_store_snapshot(store)
+    df = get_datatable_df(snapshot, snapshot_site(snapshot, site), table_id)
+    return query_datatable(df, page_current, page_size, sort_by, filter_query)
+
+# Tables are re-rendered with the tab when the site changes, unless the site is switched
+# in the browser: then they fetch the new site's rows themselves
+datatable_outputs = [Output({'type': 'server-datatable', 'index': MATCH}, 'data'),
+                     Output({'type': 'server-datatable', 'index': MATCH}, 'page_count')]
+datatable_inputs = [Input({'type': 'server-datatable', 'index': MATCH}, 'page_current'),
+                    Input({'type': 'server-datatable', 'index': MATCH}, 'page_size'),
+                    Input({'type': 'server-datatable', 'index': MATCH}, 'sort_by'),
+                    Input({'type': 'server-datatable', 'index': MATCH}, 'filter_query')]
+if CLIENTSIDE_SITE_SWITCH:
+    app.callback(*datatable_outputs, *datatable_inputs, Input('dropdown-site', 'value'),
+                 State({'type': 'server-datatable', 'index': MATCH}, 'id'),
+                 State('store-latest', 'data'),
+                 prevent_initial_call=True)(
+        lambda page_current, page_size, sort_by, filter_query, site, table_id, store:
+            update_server_datatable(page_current, page_size, sort_by, filter_query, table_id, site, store))
+else:
+    app.callback(*datatable_outputs, *datatable_inputs,
+                 State({'type': 'server-datatable', 'index': MATCH}, 'id'),
+                 State('dropdown-site', 'value'),
+                 State('store-latest', 'data'),
+                 prevent_initial_call=True)(update_server_datatable)
+
+# ----------------------------------------------------------------------------
+# EXPORTS OF FLAGGED RECORDS
+# ----------------------------------------------------------------------------
+
+# A download is answered from the export file of (snapshot version, site, flag set) when it
+# has been written.  Otherwise the file is written in the background, and a request that
+# outlasts EXPORT_WAIT_SECONDS gets a page that retries until the file is ready.
+export_pending_page = '''<!DOCTYPE html>
+<html><head><meta http-equiv="refresh" content="{retry}"><title>Preparing export</title></head>
+<body><p>Preparing {name} &hellip; the download starts when it is ready.</p></body></html>'''
+
+# Point the export links at the site and snapshot the page shows (see export_link)
+app.clientside_callback(ClientsideFunction(namespace='exports', function_name='export_hrefs'),
+                        Output({'type': 'export-link', 'index': ALL}, 'href'),
+                        Input('dropdown-site', 'value'), Input('store-latest', 'data'),
+                        Input({'type': 'export-link', 'index': ALL}, 'id'))
+
+@app.server.route(app.config.routes_pathname_prefix + 'export/<flag>.<fmt>')
+def download_export(flag, fmt):
+    if flag not in export_flag_sets or fmt not in export_formats:
+        flask.abort(404)
+    snapshot = get_snapshot(flask.request.args.get('version'))
+    site = flask.request.args.get('site', 'all')
+    if site != 'all' and site not in snapshot['sites']:
+        flask.abort(404)
+    build_df = lambda: export_flag_sets[flag][1](get_site_context(snapshot, site))
+    path = export_path(snapshot['version'], site, flag, fmt)
+    download_name = export_download_name(snapshot, site, flag, fmt)
+    try:
+        ready = get_export_file(path, build_df, flag, fmt)
+    except Exception as e:
+        print('Export failed:', flag, fmt, site, e)
+        flask.abort(500)
+    if ready is None:
+        response = flask.make_response(export_pending_page.format(retry=2, name=download_name), 202)
+        response.headers['Retry-After'] = '2'
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    return flask.send_file(path, mimetype=export_formats[fmt], as_attachment=True,
+                           attachment_filename=download_name, conditional=True)
+
+# Cache counters for monitoring
+def get_cache_stats():
+    return {'tab_cache': tab_cache.stats(), 'datatable_cache': datatable_cache.stats(),
+            'site_context_cache': site_context_cache.stats(), 'response_cache': response_cache.stats(),
+            'snapshot_cache': snapshot_cache.stats()}
+
+@app.server.route('/cache-stats')
+def cache_stats():
+    return flask.jsonify(get_cache_stats())
+
+@register_collector
+def collect_cache_stats():
+    for cache_name, stats in get_cache_stats().items():
+        for event in ['hits', 'misses', 'evictions']:
+            set_value('a2cps_cache_events_total', stats[event], cache=cache_name, event=event)
+        set_value('a2cps_cache_entries', stats['size'], cache=cache_name)
+
+@on_snapshot_change
+def count_snapshot_swap(old_snapshot, new_snapshot):
+    inc('a2cps_snapshot_swaps_total')
+
+@register_collector
+def collect_snapshot_stats():
+    snapshot = get_current_snapshot()
+    set_value('a2cps_snapshot_loaded_timestamp_seconds', time.mktime(snapshot['loaded_at'].timetuple()))
+    clear_gauge('a2cps_snapshot_rows')
+    set_value('a2cps_snapshot_rows', len(snapshot['report_df']), site='all')
+    for site, rows in snapshot['site_rows'].items():
+        set_value('a2cps_snapshot_rows', len(rows), site=site)
+
+# Timings, snapshot sizes and memory of all workers in the Prometheus text format
+@app.server.route('/metrics')
+def metrics():
+    return flask.Response(export_metrics(), mimetype='text/plain; version=0.0.4')
 
 # ----------------------------------------------------------------------------
 # RUN APPLICATION
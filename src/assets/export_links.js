@@ -0,0 +1,17 @@
+// Clientside callback of the export links (see export_link in make_components.py): each
+// link downloads the records of the site and snapshot the page shows now.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    exports: {
+        // Export path (the link's id) with the selected site and the page's snapshot version
+        export_hrefs: function(site, store, ids) {
+            var params = {'site': site || 'all'};
+            if (store && store.version) {
+                params.version = store.version;
+            }
+            var query = new URLSearchParams(params).toString();
+            return ids.map(function(id) {
+                return id.index + '?' + query;
+            });
+        }
+    }
+});
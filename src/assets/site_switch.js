@@ -0,0 +1,22 @@
+// Clientside callbacks of CLIENTSIDE_SITE_SWITCH (see app.py): the figures of every site
+// are in store-site-figures, so changing the site needs no request to the server.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    site_switch: {
+        // Figure of each site-graph for the selected site, with the shared template
+        switch_site_figures: function(site, store, ids) {
+            if (!store || !store.sites) {
+                return window.dash_clientside.no_update;
+            }
+            var figures = store.sites[site] || store.sites['all'] || {};
+            return ids.map(function(id) {
+                var figure = figures[id.index] || {'data': [], 'layout': {}};
+                var layout = Object.assign({}, figure.layout, {'template': store.template});
+                return {'data': figure.data, 'layout': layout};
+            });
+        },
+        // Back to the first page of every server datatable, which fetches the site's rows
+        first_pages: function(site, ids) {
+            return ids.map(function() { return 0; });
+        }
+    }
+});
@@ -40,3 +40,72 @@ def get_django_user():
 DATA_PATH = pathlib.Path(__file__).parent.joinpath("data")
 ASSETS_PATH = pathlib.Path(__file__).parent.joinpath("assets")
 REQUESTS_PATHNAME_PREFIX = os.environ.get("REQUESTS_PATHNAME_PREFIX", "/")
+
+# Seconds between background re-runs of the ingest pipeline (0 disables the refresh)
+DATA_REFRESH_INTERVAL = int(os.environ.get("DATA_REFRESH_INTERVAL", 3600))
+
+# Only one worker re-runs the pipeline.  The others check the saved snapshots for its
+# results this often (seconds, 0 disables it).
+SNAPSHOT_POLL_INTERVAL = int(os.environ.get("SNAPSHOT_POLL_INTERVAL", 60))
+
+# Root URL of the report files ([root]/[report]/[report]-[mcc]-latest.json), e.g. a local
+# stand-in for load tests
+FILE_URL_ROOT = os.environ.get("FILE_URL_ROOT",
+    "https://api.a2cps.org/files/v2/download/public/system/a2cps.storage.community/reports")
+
+# Report file downloads: per request (connect, read) timeouts in seconds and retry count
+FETCH_CONNECT_TIMEOUT = float(os.environ.get("FETCH_CONNECT_TIMEOUT", 5))
+FETCH_READ_TIMEOUT = float(os.environ.get("FETCH_READ_TIMEOUT", 30))
+FETCH_RETRIES = int(os.environ.get("FETCH_RETRIES", 3))
+
+# Maximum number of rendered (snapshot, site, tab) contents kept in each worker
+TAB_CACHE_SIZE = int(os.environ.get("TAB_CACHE_SIZE", 128))
+
+# Maximum number of (snapshot, site) derived frame sets kept in each worker
+SITE_CONTEXT_CACHE_SIZE = int(os.environ.get("SITE_CONTEXT_CACHE_SIZE", 32))
+
+# Number of snapshots (current, recently replaced and browsed report dates) each worker keeps in memory
+SNAPSHOT_CACHE_SIZE = int(os.environ.get("SNAPSHOT_CACHE_SIZE", 4))
+
+# Draw the hemolysis bar charts of all screening sites as rows of one figure instead of one figure each
+HEMOLYSIS_SUBPLOTS = os.environ.get("HEMOLYSIS_SUBPLOTS", "false").lower() in ("1", "true", "yes")
+
+# Switch sites in the browser: the figures of every site are sent once per snapshot and a
+# clientside callback swaps them, so only record level tables are fetched from the server
+CLIENTSIDE_SITE_SWITCH = os.environ.get("CLIENTSIDE_SITE_SWITCH", "false").lower() in ("1", "true", "yes")
+
+# Cleaned snapshots saved on disk for fast starts, and how many of them to keep
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", str(DATA_PATH.joinpath("snapshots")))
+SNAPSHOT_DISK_KEEP = int(os.environ.get("SNAPSHOT_DISK_KEEP", 12))
+
+# Optional directory of dated report files ([report]-[mcc]-[YYYYMMDD].json) to ingest as
+# historical snapshots at startup
+REPORT_ARCHIVE_DIR = os.environ.get("REPORT_ARCHIVE_DIR", None)
+
+# Directory shared by the worker processes to pool their /metrics samples (defaults to a
+# temporary directory made at startup) and seconds between writes of each worker's samples
+METRICS_DIR = os.environ.get("METRICS_DIR", None)
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 15))
+
+# Exports of flagged records: directory of generated files shared by the workers, how many
+# files to keep there, background export threads per worker, seconds a download request
+# waits for its file before answering "in progress", and rows written at a time
+EXPORT_DIR = os.environ.get("EXPORT_DIR", str(DATA_PATH.joinpath("exports")))
+EXPORT_DISK_KEEP = int(os.environ.get("EXPORT_DISK_KEEP", 200))
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", 2))
+EXPORT_WAIT_SECONDS = float(os.environ.get("EXPORT_WAIT_SECONDS", 10))
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", 5000))
+
+# Ingest pipeline: the report the dashboard shows (it needs an entry in
+# report_pipeline.report_definitions) and the MCCs fetched for it, the threads running
+# their fetch -> flatten -> clean stages, and the cache of payloads and cleaned frames
+# shared by the workers and any other dashboard on the host
+REPORT = os.environ.get("REPORT", "blood").strip()
+MCC_LIST = [int(m) if m.strip().isdigit() else m.strip() for m in os.environ.get("MCC_LIST", "1,2").split(",") if m.strip()]
+PIPELINE_WORKERS = int(os.environ.get("PIPELINE_WORKERS", 4))
+PIPELINE_CACHE_DIR = os.environ.get("PIPELINE_CACHE_DIR", str(DATA_PATH.joinpath("pipeline")))
+
+# Append-only store of each snapshot's per site and visit aggregates, read by the trend
+# tabs, and the number of appended files it is merged back into one file after
+HISTORY_DIR = os.environ.get("HISTORY_DIR", str(DATA_PATH.joinpath("history")))
+HISTORY_COMPACT_SEGMENTS = int(os.environ.get("HISTORY_COMPACT_SEGMENTS", 16))
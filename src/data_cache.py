@@ -0,0 +1,117 @@
+# Libraries
+import os
+import threading
+from collections import OrderedDict
+try:
+    import fcntl # Locks shared between processes (not available on Windows)
+except ImportError:
+    fcntl = None
+
+# ----------------------------------------------------------------------------
+# LRU CACHE
+# ----------------------------------------------------------------------------
+
+class LRUCache(object):
+    ''' Thread safe least recently used cache holding at most maxsize entries.
+    Keeps hit / miss / eviction counters for monitoring.'''
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_build(self, key, build_fn):
+        ''' Return the cached value for key, building and storing it on a miss.
+        The build runs outside the lock, so slow builds don't block other keys.'''
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = build_fn()
+            self.set(key, value)
+        return value
+
+    def discard(self, predicate):
+        ''' Remove every entry whose key matches predicate(key)'''
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def rekey(self, rekey_fn):
+        ''' Replace each key with rekey_fn(key), keeping the entry and its position.
+        Entries for which rekey_fn returns None are removed.'''
+        with self._lock:
+            items = [(rekey_fn(k), v) for k, v in self._data.items()]
+            self._data = OrderedDict((k, v) for k, v in items if k is not None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+_MISSING = object()
+
+# ----------------------------------------------------------------------------
+# FILE LOCK
+# ----------------------------------------------------------------------------
+
+class file_lock(object):
+    ''' Context manager holding an exclusive lock on path, across threads and processes
+    (the workers of the app and other apps sharing a directory)'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock_file = open(self.path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        return False
+
+def try_lock_file(path):
+    ''' Take an exclusive lock on path without waiting.  Returns the open lock file, which
+    holds the lock until it is closed (or the process exits), or None if another process
+    holds it.'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lock_file = open(path, 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+    return lock_file
@@ -4,44 +4,39 @@
 import os # Operating system library
 import pathlib # file paths
 import json
+import codecs
+import re
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import math
+import itertools
 import numpy as np
 import pandas as pd # Dataframe manipulations
+from pandas.api.types import is_categorical_dtype, union_categoricals
 import datetime
 from datetime import datetime, timedelta
 
+from instrumentation import *
+
 
 # ----------------------------------------------------------------------------
 # FUNCTIONS
 # ----------------------------------------------------------------------------
 
-def dict_to_col(df, index_cols, dict_col, new_col_name = 'category', add_col_as_category=True):
-    ''' Take a dataframe with index columns and a column containing a dictionary and convert
-    the dictionary json into separate columns'''
-    new_df = df[index_cols +[dict_col]].copy()
-    new_df.dropna(subset=[dict_col], inplace=True)
-    new_df.reset_index(inplace=True, drop=True)
-    if add_col_as_category:
-        new_df[new_col_name] = dict_col
-    new_df = pd.concat([new_df, pd.json_normalize(new_df[dict_col])], axis=1)
-    return new_df
-
 def move_column_inplace(df, col, pos):
     ''' move a column position in df'''
     col = df.pop(col)
     df.insert(pos, col.name, col)
 
-def calc_stacked_bar(df, flag_col):
+def calc_stacked_bar(cube, flag_col, site='all'):
     ''' Count and calculate pass/fail percents for columns that use 1 as a flag for failure.
     In this case these are: 'bscp_lav1_not_obt', 'bscp_sample_obtained', 'bscp_paxg_aliq_na'
+    (see analysis_flag_cols), looked up in the aggregate cube
     '''
-
-    flag_df = df[['MCC','Visit','Screening Site',flag_col]].fillna(0)
-    flag_df[flag_col] = flag_df[flag_col].astype(int)
-    flag_df_count = flag_df.groupby(['MCC','Visit','Screening Site'])[flag_col].count().rename('count').reset_index()
-    flag_df_fail = flag_df.groupby(['MCC','Visit','Screening Site'])[flag_col].sum().rename('fail').reset_index()
-    flag_df_all = flag_df_count.merge(flag_df_fail, how='outer', on = ['MCC','Visit','Screening Site'])
+    flag_df_all = cube_pass_fail(cube, flag_col, site, by=['MCC','Visit','Screening Site']).drop(columns=['Metric'])
+    flag_df_all = flag_df_all[flag_df_all['count'] > 0].sort_values(by=['MCC','Visit','Screening Site'])
 
     flag_df_all['Collected'] = 100 -100 * flag_df_all['fail'] / flag_df_all['count']
     flag_df_all['Fail'] = 100 - flag_df_all['Collected']
@@ -53,108 +48,333 @@ def calc_stacked_bar(df, flag_col):
 
     return flag_df_all
 
-def pass_threshold(blood_drawn_df, metric_col, metric_threshold, fail_over = True):
-    # Drop missing rows where metric wasn't collected
-    df = blood_drawn_df[~blood_drawn_df[metric_col].isna()]
-
-    # Count metric entries by site
-    df_count = df.groupby(['Site','Visit'])['ID'].count().rename('Count').reset_index()
-
-    # Subset records that fail threshold (default is over = fail)
-    if fail_over:
-        fail_df = df[df[metric_col] >= metric_threshold]
-    else:
-        fail_df = df[df[metric_col] <= metric_threshold]
-
-    # Count failures by site
-    fail_df_count = fail_df.groupby(['Site','Visit'])['ID'].count().rename('Fail').reset_index()
-
-    # Merge counts itnto single data frame
-    count_total = df_count.merge(fail_df_count, how='left', on=['Site','Visit']).fillna(0)
-
-    # Calculate Pass percentage
-    count_total['Percent'] = 100 * (count_total['Count'] - count_total['Fail']) / count_total['Count']
-
-    return count_total
-
 # ----------------------------------------------------------------------------
 # LOAD DATA
 # ----------------------------------------------------------------------------
 
-def load_data_file(ASSETS_PATH, filename):
-    with open(os.path.join(ASSETS_PATH, filename )) as json_file:
-        data_json = json.load(json_file)
-    return data_json
+# Sessions hold open sockets, so each (forked) worker process builds its own.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(retries=3, backoff_factor=0.5, pool_size=10):
+    ''' Return a pooled requests session for this process that retries failed connections
+    and 429/5xx responses with exponential backoff'''
+    key = (os.getpid(), retries, backoff_factor, pool_size)
+    with _sessions_lock:
+        if key not in _sessions:
+            retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                          backoff_factor=backoff_factor,
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = session
+    return _sessions[key]
 
-def load_latest_data(file_url_root, report, mcc_list):
-    data_json = {}
-    latest_suffix = report + '-[mcc]-latest.json'
-    for mcc in mcc_list:
-        json_url = '/'.join([file_url_root, report,latest_suffix.replace('[mcc]',str(mcc))])
-        r = requests.get(json_url)
-        if r.status_code == 200:
-            data_json[mcc] = r.json()
+# ----------------------------------------------------------------------------
+# STREAMING JSON
+# ----------------------------------------------------------------------------
+
+# Bytes read from a report file or response at a time
+JSON_CHUNK_SIZE = 1 << 16
+
+_json_decoder = json.JSONDecoder()
+_json_whitespace = ' \t\n\r'
+
+class JSONStreamReader(object):
+    ''' Text buffer over an iterable of byte chunks that is refilled as it is consumed'''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.consumed = 0
+        self.eof = False
+
+    def fill(self):
+        ''' Read the next chunk into the buffer.  Returns False at the end of the input.'''
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            text = self.decoder.decode(b'', final=True)
         else:
-            print(json_url)
-            print(r.status_code)
-    return data_json
+            text = self.decoder.decode(chunk)
+        # Drop what has been consumed so the buffer stays about one chunk long
+        self.consumed += self.pos
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        ''' Next non whitespace character, or '' at the end of the input'''
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _json_whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected {!r} at character {} of the JSON stream, found {!r}'.format(chars, self.consumed + self.pos, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        ''' Decode the next JSON value.  A value that ends at the end of the buffer may be
+        cut short (a number), so it is only accepted once more input or the end is read.'''
+        self.peek()
+        while True:
+            try:
+                value, end = _json_decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def key(self):
+        ''' Decode the next object key and the colon after it'''
+        if self.peek() != '"':
+            self.expect('"')
+        key = self.value()
+        self.expect(':')
+        return key
+
+def iter_json_items(chunks, depth=1):
+    ''' Yield (keys, value) for every value nested depth objects deep in a JSON document
+    read from an iterable of byte chunks, e.g. (('1', '10005'), record) for depth 2 of
+    {mcc: {record_id: record}}.  Only one value is held in memory at a time.  Values at a
+    shallower level that aren't objects are skipped.'''
+    reader = JSONStreamReader(chunks)
+    def walk(keys):
+        reader.expect('{')
+        if reader.peek() == '}':
+            reader.pos += 1
+            return
+        while True:
+            key = reader.key()
+            if len(keys) + 1 == depth:
+                yield keys + (key,), reader.value()
+            elif reader.peek() == '{':
+                for item in walk(keys + (key,)):
+                    yield item
+            else:
+                reader.value()
+            if reader.expect(',}') == '}':
+                return
+    for item in walk(()):
+        yield item
+    if reader.peek():
+        raise ValueError('Extra data after the JSON document at character {}'.format(reader.consumed + reader.pos))
+
+def iter_file_chunks(file_path, chunk_size=JSON_CHUNK_SIZE):
+    with open(file_path, 'rb') as json_file:
+        for chunk in iter(lambda: json_file.read(chunk_size), b''):
+            yield chunk
 
 # ----------------------------------------------------------------------------
 # JSON input into Dataframe
 # ----------------------------------------------------------------------------
 
-def bloodjson_to_df(json, mcc_list):
-    df = pd.DataFrame()
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+def _flatten_dict(d, prefix=''):
+    ''' Flatten nested dictionaries to dotted keys, as pd.json_normalize does'''
+    items = []
+    for k, v in d.items():
+        if isinstance(v, dict):
+            items.extend(_flatten_dict(v, prefix + k + '.'))
+        else:
+            items.append((prefix + k, v))
+    return items
+
+# Streaming ingest: records are read one at a time from the report file or response (see
+# iter_json_items) and their values appended straight into column buffers, so the nested
+# dicts of the whole report are never held in memory.  The visit dictionary columns,
+# which clean_blooddata drops, are left out of the flattened dataframe.
+
+def read_blood_records(records):
+    ''' Collect the visits of the (record_id, record) pairs of one MCC into column buffers.
+    Returns {visit: buffers} for each visit any record has, with the record ID, site, row
+    key and row hash of each of its rows and the (row positions, values) of each field.'''
     dict_cols = ['Baseline Visit', '6-Wks Post-Op', '3-Mo Post-Op']
+    visits = {}
+    for record_id, record in records:
+        for c in dict_cols:
+            if c in record and c not in visits:
+                visits[c] = {'ids': [], 'sites': [], 'hashes': [], 'columns': {}}
+        site = record.get('screening_site')
+        if _is_missing(site):
+            continue
+        for c in dict_cols:
+            visit = record.get(c)
+            if _is_missing(visit):
+                continue
+            buffers = visits[c]
+            position = len(buffers['ids'])
+            buffers['ids'].append(record_id)
+            buffers['sites'].append(site)
+            buffers['hashes'].append(visit_row_hash(site, visit))
+            columns = buffers['columns']
+            for col, value in visit.items():
+                if isinstance(value, dict):
+                    for flat_col, flat_value in _flatten_dict(value, col + '.'):
+                        buffer = columns.setdefault(flat_col, ([], []))
+                        buffer[0].append(position)
+                        buffer[1].append(flat_value)
+                    continue
+                buffer = columns.get(col)
+                if buffer is None:
+                    buffer = columns[col] = ([], [])
+                buffer[0].append(position)
+                buffer[1].append(value)
+    return {c: visits[c] for c in dict_cols if c in visits}
+
+def read_blood_stream(chunks):
+    ''' read_blood_records of a {record_id: record} report file streamed as byte chunks'''
+    return read_blood_records((keys[0], record) for keys, record in iter_json_items(chunks, depth=1))
+
+def read_blood_file(file_path, filename, mcc_list):
+    ''' Stream a {mcc: {record_id: record}} file into {mcc: read_blood_records} for the
+    MCCs in mcc_list'''
+    mcc_keys = [str(mcc) for mcc in mcc_list]
+    items = iter_json_items(iter_file_chunks(os.path.join(file_path, filename)), depth=2)
+    mcc_visits = {}
+    for mcc, mcc_items in itertools.groupby(items, key=lambda item: item[0][0]):
+        records = ((keys[1], record) for keys, record in mcc_items)
+        if mcc in mcc_keys:
+            mcc_visits[mcc] = read_blood_records(records)
+        else:
+            for record in records:
+                pass
+    return mcc_visits
+
+def blood_visits_to_df(mcc_visits, mcc_list):
+    ''' Build the flattened dataframe and row hashes from {mcc: read_blood_records}, with
+    one row per record visit ordered by mcc, then visit, then file order.  The row hashes
+    (see visit_row_hash) are indexed by an 'mcc|record ID|visit' key.'''
+    segments = []
     for mcc in mcc_list:
-        if mcc in json.keys():
-            m = json[mcc]
-        if str(mcc) in json.keys():
-            mcc=str(mcc)
-            m = json[mcc]
-        if m:
-            mdf = pd.DataFrame.from_dict(m, orient='index')
-            mdf.dropna(subset=['screening_site'], inplace=True)
-            mdf.reset_index(inplace=True)
-            mdf['MCC'] = mcc
-            for c in dict_cols:
-                if c in mdf.columns:
-                    col_df = dict_to_col(mdf, ['index','MCC','screening_site'], c,'Visit')
-                    df = pd.concat([df, col_df])
-                    df.reset_index(inplace=True, drop=True)
-    return df
-
+        if str(mcc) in mcc_visits.keys():
+            mcc = str(mcc)
+        for c, buffers in (mcc_visits.get(mcc) or {}).items():
+            segments.append((mcc, c, buffers))
+    if not segments:
+        return pd.DataFrame(), pd.Series([], index=pd.Index([], dtype=object), dtype='int64')
+
+    data = {'index': [], 'MCC': [], 'screening_site': [], 'Visit': []}
+    keys = []
+    hashes = []
+    field_cols = {}
+    n_rows = 0
+    for mcc, c, buffers in segments:
+        n = len(buffers['ids'])
+        data['index'].extend(buffers['ids'])
+        data['MCC'].extend([mcc] * n)
+        data['screening_site'].extend(buffers['sites'])
+        data['Visit'].extend([c] * n)
+        prefix = '{}|'.format(mcc)
+        suffix = '|' + c
+        keys.extend(prefix + str(record_id) + suffix for record_id in buffers['ids'])
+        hashes.extend(buffers['hashes'])
+        for col, buffer in buffers['columns'].items():
+            field_cols.setdefault(col, []).append((n_rows, buffer))
+        n_rows += n
+
+    for col, parts in field_cols.items():
+        column = [np.nan] * n_rows
+        for start, (positions, values) in parts:
+            for position, value in zip(positions, values):
+                column[start + position] = value
+        data[col] = column
+    blood_df = pd.DataFrame(data, columns=list(data))
+    row_hashes = pd.Series(hashes, index=pd.Index(keys, dtype=object), dtype='int64')
+    return blood_df, row_hashes
 
 # ----------------------------------------------------------------------------
 # Clean dataframe
 # ----------------------------------------------------------------------------
 
-def clean_blooddata(blood_df):
+# Declared column types of the flattened blood data.  Datetimes are parsed with an
+# explicit format; values that don't match it fall back to format inference.
+BLOOD_SCHEMA = {
+    'datetime': {
+        'bscp_time_blood_draw': '%Y-%m-%d %H:%M',
+        'bscp_aliquot_freezer_time': '%Y-%m-%d %H:%M',
+        'bscp_time_centrifuge': '%Y-%m-%d %H:%M',
+    },
+    'numeric': {
+        'bscp_aliq_cnt': 'float64',
+        'bscp_protocol_dev': 'float64',
+        'bscp_protocol_dev_reason': 'float64',
+    },
+    'category': ['MCC', 'Visit', 'screening_site', 'Site', 'bscp_deg_of_hemolysis', 'Deviation Reason'],
+}
+
+def parse_datetime_col(col, datetime_format):
+    ''' Parse a column with a fixed datetime format, inferring only the values that don't match'''
+    parsed = pd.to_datetime(col, format=datetime_format, errors='coerce')
+    unparsed = parsed.isna() & col.notna()
+    if unparsed.any():
+        parsed[unparsed] = pd.to_datetime(col[unparsed], errors='coerce')
+    return parsed
+
+def apply_schema(df, schema, kinds=('datetime', 'numeric', 'category')):
+    ''' Convert the columns of df in place to the types declared in schema'''
+    if 'datetime' in kinds:
+        for col, datetime_format in schema['datetime'].items():
+            if col in df.columns:
+                df[col] = parse_datetime_col(df[col], datetime_format)
+    if 'numeric' in kinds:
+        for col, dtype in schema['numeric'].items():
+            if col in df.columns:
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype(dtype)
+    if 'category' in kinds:
+        for col in schema['category']:
+            if col in df.columns:
+                df[col] = df[col].astype('category')
+    return df
+
+def total_minutes(timedelta_col):
+    ''' Whole minutes in a timedelta column, including the days part'''
+    return timedelta_col.dt.total_seconds() // 60
+
+# Clean column names for more human friendly usage
+BLOOD_RENAME = {'index':'ID',
+                'screening_site':'Screening Site',
+                'bscp_deg_of_hemolysis':'Hemolysis'}
+
+def clean_blooddata(blood_df, schema=BLOOD_SCHEMA):
     # Drop baseline dict, 6 week dict, 3 month dict
-    blood_df.drop(['Baseline Visit', '6-Wks Post-Op', '3-Mo Post-Op'], axis=1, inplace=True)
+    blood_df.drop(['Baseline Visit', '6-Wks Post-Op', '3-Mo Post-Op'], axis=1, inplace=True, errors='ignore')
 
     # move Visit column to beginning of DF
     move_column_inplace(blood_df, 'Visit', 2)
 
-    # Convert numeric columns
-    numeric_cols = ['bscp_aliq_cnt','bscp_protocol_dev','bscp_protocol_dev_reason']
-    blood_df[numeric_cols] = blood_df[numeric_cols].apply(pd.to_numeric,errors='coerce')
-
-    # Convert datetime columns
-    datetime_cols = ['bscp_time_blood_draw','bscp_aliquot_freezer_time','bscp_time_centrifuge']
-    blood_df[datetime_cols] = blood_df[datetime_cols].apply(pd.to_datetime,errors='coerce')
+    # Convert datetime and numeric columns
+    apply_schema(blood_df, schema, kinds=('datetime', 'numeric'))
 
     # Add calculated columns
     # Calculate time to freezer: freezer time - blood draw time
     blood_df['time_to_freezer'] = blood_df['bscp_aliquot_freezer_time'] - blood_df['bscp_time_blood_draw']
-    blood_df['time_to_freezer_minutes'] = blood_df['time_to_freezer'].dt.components['hours']*60 + blood_df['time_to_freezer'].dt.components['minutes']
+    blood_df['time_to_freezer_minutes'] = total_minutes(blood_df['time_to_freezer'])
 
     # Calculate time to centrifuge: centrifuge time - blood draw time
     blood_df['time_to_centrifuge'] = blood_df['bscp_time_centrifuge'] - blood_df['bscp_time_blood_draw']
-    blood_df['time_to_centrifuge_minutes'] = blood_df['time_to_centrifuge'].dt.components['hours']*60 + blood_df['time_to_centrifuge'].dt.components['minutes']
+    blood_df['time_to_centrifuge_minutes'] = total_minutes(blood_df['time_to_centrifuge'])
 
-    # Calculate times exist in correct order
-    blood_df['time_values_check'] = (blood_df['time_to_centrifuge_minutes'] < blood_df['time_to_freezer_minutes'] ) & (blood_df['time_to_centrifuge_minutes'] <= 30) & (blood_df['time_to_freezer_minutes'] <= 60)
+    # Calculate times exist in correct order.  A time before the blood draw gives a negative
+    # duration, which fails the check.
+    blood_df['time_values_check'] = (blood_df['time_to_centrifuge_minutes'] >= 0) & (blood_df['time_to_centrifuge_minutes'] < blood_df['time_to_freezer_minutes'] ) & (blood_df['time_to_centrifuge_minutes'] <= 30) & (blood_df['time_to_freezer_minutes'] <= 60)
 
     # Get 'Site' column that combines MCC and screening site
     blood_df['Site'] = 'MCC' + blood_df['MCC'].astype(str) + ': ' + blood_df['screening_site']
@@ -163,21 +383,83 @@ def clean_blooddata(blood_df):
     deviation_dict = {1:'Unable to obtain blood sample -technical reason',
                       2: 'Unable to obtain blood sample -patient related',
                       3: 'Sample handling/processing error'}
-    deviation_df = pd.DataFrame.from_dict(deviation_dict, orient='index')
-    deviation_df.reset_index(inplace=True)
-    deviation_df.columns = ['bscp_protocol_dev_reason','Deviation Reason']
-    blood_df = blood_df.merge(deviation_df, on='bscp_protocol_dev_reason', how='left')
+    blood_df['Deviation Reason'] = blood_df['bscp_protocol_dev_reason'].map(deviation_dict)
 
-    # Clean column names for more human friendly usage
-    rename_dict = {'index':'ID',
-                   'screening_site':'Screening Site',
-                   'bscp_deg_of_hemolysis':'Hemolysis'}
+    # Site, Visit, MCC, hemolysis and deviation values repeat on every row: store them as categoricals
+    apply_schema(blood_df, schema, kinds=('category',))
 
     # rename index col as ID
-    blood_df = blood_df.rename(columns=rename_dict)
+    blood_df = blood_df.rename(columns=BLOOD_RENAME)
 
     return blood_df
 
+# ----------------------------------------------------------------------------
+# Incremental cleaning
+# ----------------------------------------------------------------------------
+
+def visit_row_hash(site, visit):
+    try:
+        return hash((site, tuple(visit.items())))
+    except (TypeError, AttributeError):
+        return hash((site, json.dumps(visit, sort_keys=True, default=str)))
+
+def incremental_clean_blooddata(blood_df, new_hashes, old_report_df, old_hashes, old_columns, schema=BLOOD_SCHEMA):
+    ''' Clean only the rows of blood_df that are new or changed since old_report_df and reuse
+    the old cleaned rows for the rest.  The result is identical to clean_blooddata(blood_df).
+    new_hashes and old_hashes are the row hashes blood_visits_to_df gives with the new and
+    old flattened frames.
+    Returns (report_df, sites whose rows changed), or None when the columns changed and a
+    full rebuild is needed.'''
+    if list(blood_df.columns) != list(old_columns) or len(new_hashes) != len(blood_df):
+        return None
+    old_positions = old_hashes.index.get_indexer(new_hashes.index)
+    found = old_positions >= 0
+    unchanged = np.zeros(len(blood_df), dtype=bool)
+    unchanged[found] = old_hashes.values[old_positions[found]] == new_hashes.values[found]
+    changed = ~unchanged
+
+    # Nothing new, changed or removed: the old cleaned frame is still current
+    if not changed.any() and len(old_hashes) == len(new_hashes) and \
+            (old_positions == np.arange(len(old_positions))).all():
+        return old_report_df, set()
+
+    # Clean the changed rows.  They keep the dtypes of the whole new flattened frame.
+    parts = [old_report_df.iloc[old_positions[unchanged]]]
+    if changed.any():
+        changed_df = clean_blooddata(blood_df[changed].copy(), schema)
+        if list(changed_df.columns) != list(old_report_df.columns) or \
+                any(changed_df[c].dtype != old_report_df[c].dtype for c in changed_df.columns if not is_categorical_dtype(changed_df[c])):
+            return None
+        parts.append(changed_df)
+
+    # Reassemble in the new row order.  Categories are rebuilt from the rows that are left,
+    # sorted, as astype('category') makes them.
+    category_cols = [BLOOD_RENAME.get(c, c) for c in schema['category'] if BLOOD_RENAME.get(c, c) in old_report_df.columns]
+    order = np.argsort(np.concatenate([np.flatnonzero(unchanged), np.flatnonzero(changed)]), kind='mergesort')
+    categories = {}
+    for c in category_cols:
+        try:
+            combined = union_categoricals([pd.Categorical(part[c]) for part in parts], sort_categories=True)
+        except TypeError:
+            combined = pd.Categorical(pd.concat([part[c].astype(object) for part in parts]))
+        categories[c] = combined.take(order).remove_unused_categories()
+    parts = [part.drop(columns=category_cols) for part in parts]
+    report_df = pd.concat(parts).iloc[order].reset_index(drop=True)
+    for c in category_cols:
+        report_df[c] = categories[c]
+    report_df = report_df[old_report_df.columns]
+
+    # Sites with new, changed or removed rows
+    removed = np.ones(len(old_hashes), dtype=bool)
+    removed[old_positions[unchanged]] = False
+    dirty_sites = set(report_df['Site'][changed].dropna()) | set(old_report_df['Site'][removed].dropna())
+    # If records moved within the file every site's rows may be in a new order
+    kept_positions = old_positions[unchanged]
+    if (np.diff(kept_positions) < 0).any():
+        dirty_sites |= set(report_df['Site'].dropna())
+
+    return report_df, dirty_sites
+
 # ----------------------------------------------------------------------------
 # MISSING DATA
 # ----------------------------------------------------------------------------
@@ -196,61 +478,324 @@ def missing_blood_draws(df):
 # SITE INFO
 # ----------------------------------------------------------------------------
 
-def metric_obtained(blood_drawn_df, metric_col):
-    blood_site_count = blood_drawn_df.groupby(['Site','Visit'])['ID'].count().rename('Count').reset_index()
-
-    cols = ['ID', 'Site', 'Visit'] + [metric_col]
-    df = blood_drawn_df[cols]
-    df = df[~df[metric_col].isna()]
-    df_count = df.groupby(['Site','Visit'])['ID'].count().rename('Metric Count').reset_index()
-
-    df_total = blood_site_count.merge(df_count, how='left', on=['Site','Visit']).fillna(0)
-    df_total['Percent'] = 100 * (df_total['Count'] - df_total['Metric Count']) / df_total['Count']
-
-    return df_total
+# Metrics reported per Site x Visit.  Each metric has a kind:
+#   count     number of blood draws
+#   obtained  percent of draws with no value in col (the *_na flag columns)
+#   at_least  percent of draws with col >= threshold, missing values counted as 0
+#   under     percent of draws with a value in col where it is >= 0 and < threshold
+#             (a negative duration means a time was entered before the blood draw)
+#   over      percent of draws with a value in col where it is > threshold
+site_metrics = [
+    {'metric': 'Count', 'kind': 'count'},
+    {'metric': 'Pax Obtained', 'kind': 'obtained', 'col': 'bscp_paxg_aliq_na'},
+    {'metric': 'Buffy Obtained', 'kind': 'obtained', 'col': 'bscp_buffycoat_na'},
+    {'metric': 'Aliquots >= 5', 'kind': 'at_least', 'col': 'bscp_aliq_cnt', 'threshold': 5},
+    {'metric': 'Aliquots >= 1', 'kind': 'at_least', 'col': 'bscp_aliq_cnt', 'threshold': 1},
+]
+
+timing_metrics = [
+    {'metric': 'Centrifuge < 30 min', 'kind': 'under', 'col': 'time_to_centrifuge_minutes', 'threshold': 30},
+    {'metric': 'Freezer < 60 min', 'kind': 'under', 'col': 'time_to_freezer_minutes', 'threshold': 60},
+]
+
+def metric_flags(blood_drawn_df, metric):
+    ''' (counted, failed) boolean arrays of a metric for every row'''
+    kind = metric['kind']
+    n_rows = len(blood_drawn_df)
+    if kind == 'count':
+        return np.ones(n_rows, dtype=bool), np.zeros(n_rows, dtype=bool)
+    values = blood_drawn_df[metric['col']]
+    if kind == 'obtained':
+        return np.ones(n_rows, dtype=bool), values.notna().values
+    if kind == 'at_least':
+        return np.ones(n_rows, dtype=bool), (values.fillna(0) < metric['threshold']).values
+    if kind == 'under':
+        return values.notna().values, ((values >= metric['threshold']) | (values < 0)).values
+    if kind == 'over':
+        return values.notna().values, (values <= metric['threshold']).values
+    raise ValueError('Unknown metric kind: ' + str(kind))
+
+def get_metric(metrics_df, metric):
+    ''' Rows of one metric from a cube_site_metrics frame'''
+    return metrics_df[metrics_df['Metric'] == metric]
+
+def get_metrics_missing(blood_drawn_df):
+    ''' Blood draws with a value in one of the pax / buffy coat columns, or no aliquot count'''
+    pax_missing = ~blood_drawn_df['bscp_paxg_aliq_na'].isna()
+    buffy_missing = ~blood_drawn_df['bscp_buffycoat_na'].isna()
+    aliquots_missing = blood_drawn_df['bscp_aliq_cnt'].isna()
+    metrics_missing = blood_drawn_df[pax_missing | buffy_missing | aliquots_missing].copy()
+    move_column_inplace(metrics_missing, 'bscp_buffycoat_na', 4)
+    move_column_inplace(metrics_missing, 'bscp_paxg_aliq_na', 4)
+    move_column_inplace(metrics_missing, 'bscp_aliq_cnt', 4)
+    return metrics_missing
 
-def aliquot_obtained(blood_drawn_df, threshold):
-    blood_site_count = blood_drawn_df.groupby(['Site','Visit'])['ID'].count().rename('Count').reset_index()
-
-    cols = ['ID', 'Site', 'Visit','bscp_aliq_cnt']
-    df = blood_drawn_df[cols].copy()
-    df = df.fillna(0)
-    df['Threshold'] = df['bscp_aliq_cnt'] >= threshold
-
-    df_count = df[~df['Threshold']].groupby(['Site','Visit'])['ID'].count().rename('Below Threshold').reset_index()
-
-    df_total = blood_site_count.merge(df_count, how='left', on=['Site','Visit']).fillna(0)
-    df_total['Percent'] = 100 * (df_total['Count'] - df_total['Below Threshold']) / df_total['Count']
+# ----------------------------------------------------------------------------
+# Timing
+# ----------------------------------------------------------------------------
 
-    return df_total
+def get_time_check_fail(blood_drawn_df):
+    return blood_drawn_df[~blood_drawn_df['time_values_check']]
 
 # ----------------------------------------------------------------------------
 # Hemolysis
 # ----------------------------------------------------------------------------
 
-def count_hemolysis_records(df):
-    hem_cols = ['ID', 'MCC', 'Screening Site', 'Visit','Hemolysis']
-    hem_df = df[hem_cols].dropna(subset=['Hemolysis'])
-    hem_df['Hemolysis'] = hem_df['Hemolysis'].str.replace('.','0.',regex=True)
-
-    hem_count = hem_df.groupby(by = ['MCC','Screening Site', 'Visit','Hemolysis']).count().reset_index().rename(columns={'ID':'count'})
+def hemolysis_degree(value):
+    ''' Degree of hemolysis written with a leading 0 ('.5' -> '0.5')'''
+    return str(value).replace('.', '0.')
 
-    # Get complete list of possible sites / Hem Degrees with counts
-    sites_df = hem_df[['MCC','Screening Site']].drop_duplicates().sort_values(by=['MCC','Screening Site']).reset_index(drop=True)
-    hem_degrees = pd.DataFrame({'Hemolysis':hem_df['Hemolysis'].unique()})
-    visits = pd.DataFrame({'Visit':hem_df['Visit'].unique()})
-    hem_degrees = sites_df.merge(hem_degrees, how='cross').merge(visits, how='cross')
+def hemolysis_counts(cube, site='all'):
+    ''' Records by site, degree of hemolysis and visit, looked up in the aggregate cube.  Every
+    combination of the sites, degrees and visits that have records is listed, with a count
+    of 0 where there are none.'''
+    hem_degrees = cube_counts(cube, 'Hemolysis', site)
+    for col in ['Site', 'Level', 'Visit']:
+        observed = hem_degrees.loc[hem_degrees['count'] > 0, col].unique()
+        hem_degrees = hem_degrees[hem_degrees[col].isin(observed)]
+    hem_degrees = hem_degrees.rename(columns={'Level': 'Hemolysis'})
+    return hem_degrees[['MCC', 'Screening Site', 'Hemolysis', 'Visit', 'count']].reset_index(drop=True)
 
-    hem_degrees = hem_degrees.merge(hem_count,how='outer', on=['MCC','Screening Site','Hemolysis', 'Visit'])
-    hem_degrees = hem_degrees.fillna(0)
-
-    return hem_degrees
+def get_hemolysis_flagged(df):
+    ''' Records with a degree of hemolysis of 1 or more'''
+    degree = pd.to_numeric(df['Hemolysis'].astype(object), errors='coerce')
+    return df[degree >= 1]
 
 
 # ----------------------------------------------------------------------------
 # Deviations
 # ----------------------------------------------------------------------------
+def get_deviation_records(df):
+    ''' Complete records where bscp_protocol_dev != 0'''
+    return df[df.bscp_protocol_dev !=0]
+
 def get_deviations(df):
     dev_cols = ['Site','ID','Visit','bscp_protocol_dev','bscp_protocol_dev_reason','Deviation Reason']
-    dev = df[dev_cols][df.bscp_protocol_dev !=0]
+    dev = get_deviation_records(df)[dev_cols]
     return dev
+
+def deviation_counts(cube, site='all'):
+    ''' Records by site, visit and deviation reason, looked up in the aggregate cube'''
+    dev_count = cube_counts(cube, 'Deviation Reason', site)
+    dev_count = dev_count[dev_count['count'] > 0].rename(columns={'Level': 'Deviation Reason'})
+    dev_count = dev_count.sort_values(by=['Site','Visit','Deviation Reason'])
+    return dev_count[['Site','Visit','Deviation Reason','count']].reset_index(drop=True)
+
+# ----------------------------------------------------------------------------
+# AGGREGATE CUBE
+# ----------------------------------------------------------------------------
+
+# Record counts for every (MCC, Screening Site, Visit, Metric, Level) cell, built once per
+# snapshot, so the tabs look up the slice they show instead of grouping the rows of the
+# site again.  Site (the 'MCCn: Screening Site' label of the site dropdown) is kept as a
+# level too.  The grid is dense: each metric has a count, 0 or not, for every site, visit
+# and level of that metric, and its cells are in (Site, Level, Visit) order.  Levels are:
+#   Pass / Fail     for site_metrics, timing_metrics and analysis_flag_cols, counting the
+#                   rows the metric applies to
+#   the degree      for 'Hemolysis'
+#   the reason      for 'Deviation Reason', counting protocol deviation records
+CUBE_LEVELS = ['Metric', 'MCC', 'Screening Site', 'Site', 'Level', 'Visit']
+VISIT_ORDER = ['Baseline Visit', '6-Wks Post-Op', '3-Mo Post-Op']
+PASS_FAIL = ['Pass', 'Fail']
+
+# Columns that use 1 as a flag for a missing analysis (see calc_stacked_bar)
+analysis_flag_cols = ['bscp_lav1_not_obt', 'bscp_sample_obtained', 'bscp_paxg_aliq_na']
+
+def level_sort_key(value):
+    ''' Numbers first, in numeric order, then text'''
+    number = pd.to_numeric(value, errors='coerce')
+    if pd.isna(number):
+        return (1, 0, str(value))
+    return (0, number, '')
+
+def ordered_levels(values):
+    ''' Distinct values that aren't missing, in level_sort_key order'''
+    return sorted((value for value in pd.unique(values) if not pd.isna(value)), key=level_sort_key)
+
+def level_codes(values, levels):
+    ''' Position of each value in levels, -1 for missing values'''
+    return pd.Categorical(values, categories=levels).codes
+
+def factorized_levels(values, label=None):
+    ''' (level code of each value, ordered levels) of a column, with the levels made from
+    the distinct values (passed through label) rather than from every row'''
+    codes, distinct = pd.factorize(values)
+    labels = [label(value) for value in distinct] if label else list(distinct)
+    levels = ordered_levels(labels)
+    if not levels:
+        return np.full(len(codes), -1), levels
+    distinct_codes = level_codes(labels, levels)
+    return np.where(codes >= 0, distinct_codes[np.maximum(codes, 0)], -1), levels
+
+def cube_metric_levels(df, metrics=None):
+    ''' {metric: (row positions, level code of each of those rows, levels)} of every metric
+    counted into the cube, or those in metrics'''
+    wanted = lambda name: metrics is None or name in metrics
+    levels = {}
+    drawn = np.flatnonzero(df['bscp_time_blood_draw'].notna().values)
+    blood_drawn = df[list({metric['col'] for metric in site_metrics + timing_metrics if 'col' in metric})].iloc[drawn]
+    for metric in site_metrics + timing_metrics:
+        if wanted(metric['metric']):
+            counted, failed = metric_flags(blood_drawn, metric)
+            levels[metric['metric']] = (drawn[counted], failed[counted].astype(np.int8), PASS_FAIL)
+    for col in analysis_flag_cols:
+        if wanted(col):
+            codes, distinct = pd.factorize(df[col])
+            distinct_failed = pd.to_numeric(pd.Series(distinct, dtype=object), errors='coerce').values == 1
+            failed = (codes >= 0) & distinct_failed[np.maximum(codes, 0)] if len(distinct) else np.zeros(len(df), dtype=bool)
+            levels[col] = (np.arange(len(df)), failed.astype(np.int8), PASS_FAIL)
+    if wanted('Hemolysis'):
+        codes, degree_levels = factorized_levels(df['Hemolysis'], hemolysis_degree)
+        rated = np.flatnonzero(codes >= 0)
+        levels['Hemolysis'] = (rated, codes[rated], degree_levels)
+    if wanted('Deviation Reason'):
+        codes, reason_levels = factorized_levels(df['Deviation Reason'])
+        deviation = np.flatnonzero((df['bscp_protocol_dev'] != 0).values & (codes >= 0))
+        levels['Deviation Reason'] = (deviation, codes[deviation], reason_levels)
+    return levels
+
+def build_aggregate_cube(df, metrics=None):
+    ''' Series of record counts indexed by CUBE_LEVELS, for every metric of
+    cube_metric_levels or those in metrics.  Rows are binned by the categorical codes of
+    their site, level and visit; no grouping or joins.'''
+    first_rows = df['Site'].reset_index(drop=True).dropna().drop_duplicates().index
+    sites = df[['Site', 'MCC', 'Screening Site']].iloc[first_rows].sort_values(by=['MCC', 'Screening Site'])
+    site_labels = list(sites['Site'])
+    present = set(df['Visit'].dropna())
+    visits = [visit for visit in VISIT_ORDER if visit in present] + sorted(present - set(VISIT_ORDER))
+    mcc_levels = ordered_levels(sites['MCC'])
+    screening_levels = ordered_levels(sites['Screening Site'])
+
+    row_sites = level_codes(df['Site'], site_labels)
+    row_visits = level_codes(df['Visit'], visits)
+    n_sites, n_visits = len(site_labels), len(visits)
+
+    metric_levels = cube_metric_levels(df, metrics)
+    all_levels = list(dict.fromkeys(level for positions, codes, levels in metric_levels.values() for level in levels))
+    counts, codes = [], {level: [] for level in CUBE_LEVELS}
+    for metric_code, (positions, row_levels, levels) in enumerate(metric_levels.values()):
+        n_levels = len(levels)
+        cells = (row_sites[positions].astype(np.int64) * n_levels + row_levels) * n_visits + row_visits[positions]
+        binned = (row_sites[positions] >= 0) & (row_levels >= 0) & (row_visits[positions] >= 0)
+        counts.append(np.bincount(cells[binned], minlength=n_sites * n_levels * n_visits))
+
+        # Codes of the dense (Site, Level, Visit) grid of this metric
+        cell_sites = np.repeat(np.arange(n_sites), n_levels * n_visits)
+        codes['Metric'].append(np.full(len(cell_sites), metric_code))
+        codes['Site'].append(cell_sites)
+        codes['Level'].append(np.tile(np.repeat(level_codes(levels, all_levels), n_visits), n_sites))
+        codes['Visit'].append(np.tile(np.arange(n_visits), n_sites * n_levels))
+    site_codes = np.concatenate(codes['Site']) if counts else np.array([], dtype=int)
+    codes['MCC'] = [level_codes(sites['MCC'], mcc_levels)[site_codes]]
+    codes['Screening Site'] = [level_codes(sites['Screening Site'], screening_levels)[site_codes]]
+
+    index = pd.MultiIndex(
+        levels=[list(metric_levels), mcc_levels, screening_levels, site_labels, all_levels, visits],
+        codes=[np.concatenate(codes[level]) if codes[level] else [] for level in CUBE_LEVELS],
+        names=CUBE_LEVELS, verify_integrity=False)
+    return pd.Series(np.concatenate(counts) if counts else [], index=index, dtype=np.int64, name='count')
+
+def cube_counts(cube, metrics, site='all'):
+    ''' Counts of a metric (or a list of them), for one site or all of them, as a frame with
+    a column per cube level'''
+    index = cube.index
+    metrics = [metrics] if isinstance(metrics, str) else metrics
+    keep = np.isin(index.codes[0], index.levels[0].get_indexer(metrics))
+    if site != 'all':
+        keep &= index.codes[3] == index.levels[3].get_indexer([site])[0]
+    counts = pd.DataFrame({name: np.asarray(level, dtype=object)[codes[keep]]
+                           for name, level, codes in zip(index.names, index.levels, index.codes)})
+    counts['count'] = cube.values[keep]
+    return counts
+
+def cube_pass_fail(cube, metrics, site='all', by=['Site', 'Visit']):
+    ''' Rows counted ('count') and failed ('fail') by Metric and the by levels, for Pass /
+    Fail metrics.  The Fail cells line up with the Pass cells of the dense grid.'''
+    counts = cube_counts(cube, metrics, site)
+    failed = (counts['Level'] == 'Fail').values
+    values = counts['count'].values
+    pass_fail_df = counts.loc[failed, ['Metric'] + by].reset_index(drop=True)
+    pass_fail_df['count'] = values[failed] + values[~failed]
+    pass_fail_df['fail'] = values[failed]
+    return pass_fail_df
+
+def cube_site_metrics(cube, metrics, site='all'):
+    ''' Every metric in metrics for each Site x Visit group of the site's rows, looked up in
+    the aggregate cube.  Returns a tidy frame with one row per metric and group: Site,
+    Visit, Metric, Count (rows counted), Fail and Percent (of counted rows that pass).
+    Groups with no counted rows are left out.'''
+    names = [metric['metric'] for metric in metrics]
+    metrics_df = cube_pass_fail(cube, names, site).rename(columns={'count': 'Count', 'fail': 'Fail'})
+    metrics_df = metrics_df[metrics_df['Count'] > 0].sort_values(by=['Site', 'Visit'], kind='mergesort')
+    position = metrics_df['Metric'].map({name: i for i, name in enumerate(names)}).values
+    metrics_df = metrics_df.iloc[np.argsort(position, kind='mergesort')].reset_index(drop=True)
+    metrics_df = metrics_df[['Site', 'Visit', 'Metric', 'Count', 'Fail']]
+    metrics_df['Percent'] = 100 * (metrics_df['Count'] - metrics_df['Fail']) / metrics_df['Count']
+    return metrics_df
+
+# ----------------------------------------------------------------------------
+# Server side datatables
+# ----------------------------------------------------------------------------
+
+# DataTable filter operators and their symbol aliases.  Case (s/i) prefixes such as
+# 'icontains' are accepted and treated like the plain operator.
+filter_operators = {'eq': 'eq', '=': 'eq', 'ne': 'ne', '!=': 'ne',
+                    'lt': 'lt', '<': 'lt', 'le': 'le', '<=': 'le',
+                    'gt': 'gt', '>': 'gt', 'ge': 'ge', '>=': 'ge',
+                    'contains': 'contains', 'datestartswith': 'datestartswith'}
+filter_part_re = re.compile(r'^\s*\{(?P<name>.+?)\}\s*(?P<operator>[a-z]+|[<>!=]+)\s*(?P<value>.*?)\s*$')
+
+def split_filter_part(filter_part):
+    ''' Split one part of a DataTable filter_query into (column, operator, value)'''
+    match = filter_part_re.match(filter_part)
+    if not match:
+        return [None] * 3
+    operator = match.group('operator')
+    if operator not in filter_operators and operator[:1] in ('s', 'i'):
+        operator = operator[1:]
+    if operator not in filter_operators:
+        return [None] * 3
+    value_part = match.group('value')
+    v0 = value_part[:1]
+    if v0 and len(value_part) > 1 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+        value = value_part[1: -1].replace('\\' + v0, v0)
+    else:
+        try:
+            value = float(value_part)
+        except ValueError:
+            value = value_part
+    return match.group('name'), filter_operators[operator], value
+
+def filter_mask(col, operator, value):
+    if operator == 'contains':
+        return col.astype(str).str.contains(str(value), regex=False)
+    if operator == 'datestartswith':
+        return col.astype(str).str.startswith(str(value))
+    compare = {'eq': col.__eq__, 'ne': col.__ne__, 'lt': col.__lt__,
+               'le': col.__le__, 'gt': col.__gt__, 'ge': col.__ge__}[operator]
+    try:
+        return compare(value).fillna(False).astype(bool)
+    except TypeError:
+        # e.g. text typed into a numeric column, or an unordered categorical
+        col = col.astype(str)
+        compare = {'eq': col.__eq__, 'ne': col.__ne__, 'lt': col.__lt__,
+                   'le': col.__le__, 'gt': col.__gt__, 'ge': col.__ge__}[operator]
+        return compare(str(value))
+
+def query_datatable(df, page_current, page_size, sort_by=None, filter_query=None):
+    ''' Filter, sort and page a dataframe the way a DataTable with custom actions asks for.
+    Returns the records of the requested page and the total page count.'''
+    if filter_query:
+        for filter_part in filter_query.split(' && '):
+            col_name, operator, value = split_filter_part(filter_part)
+            if col_name in df.columns:
+                df = df[filter_mask(df[col_name], operator, value)]
+    if sort_by:
+        sort_cols = [s['column_id'] for s in sort_by if s['column_id'] in df.columns]
+        if sort_cols:
+            ascending = [s['direction'] == 'asc' for s in sort_by if s['column_id'] in df.columns]
+            df = df.sort_values(by=sort_cols, ascending=ascending, na_position='last', kind='mergesort')
+    page_current = page_current or 0
+    page_count = max(1, math.ceil(len(df) / page_size))
+    page_df = df.iloc[page_current * page_size:(page_current + 1) * page_size]
+    return page_df.to_dict('records'), page_count
@@ -0,0 +1,433 @@
+# Libraries
+import os # Operating system library
+import threading
+import time
+import hashlib
+import json
+import re
+from datetime import datetime
+import pandas as pd # Dataframe manipulations
+import pyarrow.feather as feather
+
+from data_processing import *
+from data_cache import *
+from config_settings import *
+
+# ----------------------------------------------------------------------------
+# SNAPSHOT BUILD
+# ----------------------------------------------------------------------------
+
+def snapshot_version(report_df):
+    ''' Short content hash of a cleaned report dataframe.  The same data gives the same
+    version in every worker, so it can be used as a cache key across processes.'''
+    row_hashes = pd.util.hash_pandas_object(report_df, index=False).values
+    return hashlib.sha1(row_hashes.tobytes()).hexdigest()[:12]
+
+def site_partition(report_df):
+    ''' Row positions of each site in report_df, in row order'''
+    return report_df.groupby('Site', observed=True).indices
+
+def make_snapshot(report_df, file_source, loaded_at=None, report_date=None):
+    ''' Wrap a fully cleaned report dataframe with the metadata the app displays.
+    report_date (YYYY-MM-DD) defaults to the day it was loaded.'''
+    loaded_at = loaded_at or datetime.now()
+    snapshot = {
+        'version': snapshot_version(report_df),
+        'loaded_at': loaded_at,
+        'report_date': report_date or loaded_at.strftime('%Y-%m-%d'),
+        'source': file_source,
+        'report_df': report_df,
+        'sites': list(report_df.sort_values(by=['Site'])['Site'].unique()),
+        'site_rows': site_partition(report_df),
+    }
+    with timed('a2cps_ingest_stage_seconds', stage='aggregate'):
+        snapshot['cube'] = build_aggregate_cube(report_df)
+    return snapshot
+
+def make_pipeline_snapshot(result, previous=None):
+    ''' Wrap a report combined by the ingest pipeline (see run_pipeline) into a snapshot.
+    Returns previous itself when the report didn't change, and None when there is no
+    data.  Snapshots built on previous record its version and the sites whose rows
+    changed, so cached views of the other sites can be kept.'''
+    if result is None:
+        return None
+    if previous is not None and result['report_df'] is previous['report_df']:
+        return previous
+    snapshot = make_snapshot(result['report_df'], result['source'])
+    if previous is not None and result['dirty_sites'] is not None:
+        snapshot['base_version'] = previous['version']
+        snapshot['dirty_sites'] = result['dirty_sites']
+    return snapshot
+
+# ----------------------------------------------------------------------------
+# SITE SELECTION
+# ----------------------------------------------------------------------------
+
+def get_site_df(snapshot, site):
+    ''' Rows of one site (or all of them), looked up in the snapshot's partition index'''
+    report_df = snapshot['report_df']
+    if site == 'all':
+        return report_df
+    return report_df.iloc[snapshot['site_rows'].get(site, [])]
+
+def make_site_context(snapshot, site):
+    ''' The frames every report tab of one site is built from, derived once:
+    df (the site's rows), blood_drawn, missing_blood and missing_analysis, next to the
+    snapshot's aggregate cube and report date'''
+    site_df = get_site_df(snapshot, site)
+    blood_drawn, missing_blood, missing_analysis = missing_blood_draws(site_df)
+    return {
+        'version': snapshot['version'],
+        'report_date': snapshot['report_date'],
+        'site': site,
+        'df': site_df,
+        'blood_drawn': blood_drawn,
+        'missing_blood': missing_blood,
+        'missing_analysis': missing_analysis,
+        'cube': snapshot['cube'],
+    }
+
+# ----------------------------------------------------------------------------
+# SNAPSHOT FILES
+# ----------------------------------------------------------------------------
+
+# Cleaned snapshots are written as Arrow IPC (feather) files next to a manifest.json
+# listing them newest first, so a worker can start from the last good snapshot without
+# fetching or re-cleaning anything.
+
+def _write_atomic(path, write_fn):
+    ''' Write to a temporary file and move it into place, so readers in other workers never
+    see a partly written file'''
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+# Pages send the version they were rendered from with every callback, so versions this
+# worker doesn't hold are looked up in the manifest often.  The parsed manifest, indexed by
+# version, is kept until the file changes, along with the versions whose file could not be
+# loaded; a version that isn't in the manifest costs one stat.
+_manifest_cache = {}
+_manifest_lock = threading.Lock()
+
+def _load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    except OSError:
+        return []
+    except ValueError as e:
+        print('Unreadable snapshot manifest:', e)
+        return []
+
+def cached_manifest(snapshot_dir):
+    ''' {'manifest', 'index' (entries by version), 'unreadable' (versions)} of the snapshot
+    directory's manifest, read again only when the file changed'''
+    manifest_path = os.path.join(snapshot_dir, 'manifest.json')
+    try:
+        stat = os.stat(manifest_path)
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        key = None
+    with _manifest_lock:
+        cached = _manifest_cache.get(snapshot_dir)
+    if cached is None or cached['key'] != key:
+        manifest = _load_manifest(manifest_path) if key is not None else []
+        cached = {'key': key, 'manifest': manifest, 'index': {m['version']: m for m in manifest}, 'unreadable': set()}
+        with _manifest_lock:
+            _manifest_cache[snapshot_dir] = cached
+    return cached
+
+def read_manifest(snapshot_dir):
+    ''' Manifest entries, newest first.  The entries are shared: don't change them.'''
+    return list(cached_manifest(snapshot_dir)['manifest'])
+
+def write_manifest(snapshot_dir, manifest):
+    def write_fn(tmp_path):
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+    _write_atomic(os.path.join(snapshot_dir, 'manifest.json'), write_fn)
+
+def save_snapshot(snapshot, snapshot_dir, report, keep=SNAPSHOT_DISK_KEEP):
+    ''' Persist a snapshot's cleaned dataframe and add it to the manifest, indexed by report
+    date and the row count of each MCC.  Only the newest keep fetched snapshots are kept on
+    disk; snapshots ingested from the report archive are never removed.'''
+    try:
+        # Workers save at the same time: read, prune and rewrite the manifest under a lock so
+        # none of them drops another's entry or removes a file still listed
+        with file_lock(os.path.join(snapshot_dir, '.lock')):
+            os.makedirs(snapshot_dir, exist_ok=True)
+            filename = '{}-{}.feather'.format(report, snapshot['version'])
+            file_path = os.path.join(snapshot_dir, filename)
+            if not os.path.exists(file_path):
+                report_df = snapshot['report_df'].reset_index(drop=True)
+                _write_atomic(file_path, lambda tmp_path: feather.write_feather(report_df, tmp_path))
+
+            entry = {'report': report,
+                     'version': snapshot['version'],
+                     'file': filename,
+                     'source': snapshot['source'],
+                     'loaded_at': snapshot['loaded_at'].isoformat(),
+                     'report_date': snapshot['report_date'],
+                     'rows': len(snapshot['report_df']),
+                     'mcc_rows': {str(mcc): int(n) for mcc, n in snapshot['report_df']['MCC'].value_counts().items() if n}}
+            # Workers loading this snapshot keep the cached views of sites it didn't change
+            if 'base_version' in snapshot:
+                entry['base_version'] = snapshot['base_version']
+                entry['dirty_sites'] = sorted(snapshot['dirty_sites'])
+            manifest = [m for m in read_manifest(snapshot_dir) if m['file'] != filename]
+            manifest.insert(0, entry)
+            report_entries = [m for m in manifest if m['report'] == report and m['source'] != 'archive']
+            for old_entry in report_entries[keep:]:
+                manifest.remove(old_entry)
+                old_path = os.path.join(snapshot_dir, old_entry['file'])
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+            write_manifest(snapshot_dir, manifest)
+    except Exception as e:
+        print('Could not save snapshot:', e)
+
+def load_snapshot_file(snapshot_dir, entry):
+    ''' Read a saved snapshot back with the metadata from its manifest entry'''
+    file_path = os.path.join(snapshot_dir, entry['file'])
+    # Memory mapping only speeds up the read: the report's numeric and time columns all have
+    # missing values and its strings become Python objects, so pandas holds its own copy of
+    # every column.  Converting column by column keeps pandas from consolidating them into
+    # blocks, a second copy.
+    report_df = feather.read_table(file_path, memory_map=True).to_pandas(split_blocks=True, self_destruct=True)
+    loaded_at = datetime.fromisoformat(entry['loaded_at'])
+    snapshot = {
+        'version': entry['version'],
+        'loaded_at': loaded_at,
+        'report_date': entry.get('report_date', loaded_at.strftime('%Y-%m-%d')),
+        'source': entry['source'],
+        'report_df': report_df,
+        'sites': list(report_df.sort_values(by=['Site'])['Site'].unique()),
+        'site_rows': site_partition(report_df),
+        'cube': build_aggregate_cube(report_df),
+        'file': entry['file'],
+    }
+    if 'base_version' in entry:
+        snapshot['base_version'] = entry['base_version']
+        snapshot['dirty_sites'] = set(entry['dirty_sites'])
+    return snapshot
+
+def list_snapshot_entries(snapshot_dir, report):
+    ''' Manifest entries of report, newest report date first'''
+    entries = [m for m in read_manifest(snapshot_dir) if m['report'] == report]
+    entries.sort(key=lambda m: (m.get('report_date', m['loaded_at'][:10]), m['loaded_at']), reverse=True)
+    return entries
+
+def load_latest_snapshot_file(snapshot_dir, report):
+    ''' Return the newest readable saved snapshot of report, or None.  Fetched snapshots
+    are preferred over ones ingested from the report archive.'''
+    entries = list_snapshot_entries(snapshot_dir, report)
+    entries.sort(key=lambda m: m['source'] == 'archive')
+    for entry in entries:
+        try:
+            return load_snapshot_file(snapshot_dir, entry)
+        except Exception as e:
+            print('Could not load snapshot', entry['file'], e)
+    return None
+
+def load_newer_snapshot(snapshot_dir, report, current):
+    ''' The newest saved snapshot of report fetched after current was loaded, or None if
+    there is none or it has current's data'''
+    entries = [m for m in read_manifest(snapshot_dir) if m['report'] == report and m['source'] != 'archive']
+    if not entries:
+        return None
+    entry = max(entries, key=lambda m: m['loaded_at'])
+    if current is not None and (entry['version'] == current['version']
+                                or datetime.fromisoformat(entry['loaded_at']) <= current['loaded_at']):
+        return None
+    return load_snapshot_file(snapshot_dir, entry)
+
+# Dated report files in the archive are named [report]-[mcc]-[YYYYMMDD or YYYY-MM-DD].json
+archive_file_re = re.compile(r'^(?P<report>.+)-(?P<mcc>[^-]+)-(?P<date>\d{4}-?\d{2}-?\d{2})\.json$')
+
+def ingest_report_archive(archive_dir, report, mcc_list, snapshot_dir):
+    ''' Build and save a snapshot for each report date found in archive_dir that isn't
+    in the manifest yet.  Returns the number of new snapshots.'''
+    if not archive_dir or not os.path.isdir(archive_dir):
+        return 0
+    dated_files = {}
+    for filename in os.listdir(archive_dir):
+        match = archive_file_re.match(filename)
+        if not match or match.group('report') != report:
+            continue
+        mcc = match.group('mcc')
+        if mcc not in [str(m) for m in mcc_list]:
+            continue
+        report_date = datetime.strptime(match.group('date').replace('-', ''), '%Y%m%d')
+        dated_files.setdefault(report_date, {})[mcc] = filename
+
+    ingested_dates = set(m.get('report_date') for m in list_snapshot_entries(snapshot_dir, report) if m['source'] == 'archive')
+    new_snapshots = 0
+    for report_date, mcc_files in sorted(dated_files.items()):
+        if report_date.strftime('%Y-%m-%d') in ingested_dates:
+            continue
+        try:
+            mcc_visits = {mcc: read_blood_stream(iter_file_chunks(os.path.join(archive_dir, filename)))
+                          for mcc, filename in mcc_files.items()}
+            report_df = clean_blooddata(blood_visits_to_df(mcc_visits, mcc_list)[0])
+        except Exception as e:
+            print('Could not ingest', report_date.strftime('%Y-%m-%d'), e)
+            continue
+        snapshot = make_snapshot(report_df, 'archive', loaded_at=report_date)
+        save_snapshot(snapshot, snapshot_dir, report)
+        new_snapshots += 1
+    return new_snapshots
+
+# ----------------------------------------------------------------------------
+# CURRENT SNAPSHOT
+# ----------------------------------------------------------------------------
+
+# The published snapshot is only ever replaced by a single reference assignment of a
+# fully built dict, so readers see either the old or the new snapshot, never a mix.
+_current = {'snapshot': None}
+
+# Refresh thread settings.  Threads do not survive the fork done by gunicorn --preload,
+# so each worker starts its own thread the first time it reads the snapshot.  Only the
+# worker holding the lock on lock_path (taken in that thread, so never by the preloading
+# master) runs build_fn; the others run follow_fn to pick up the snapshots it saves.
+_refresh = {'build_fn': None, 'interval': 0, 'refresh_first': False, 'lock_path': None, 'follow_fn': None,
+            'poll_interval': 0, 'lock_file': None, 'pid': None, 'thread': None}
+_refresh_lock = threading.Lock()
+
+# Functions called with (old_snapshot, new_snapshot) after a new snapshot is published,
+# used to invalidate anything derived from the old data.
+_snapshot_listeners = []
+
+def on_snapshot_change(listener):
+    ''' Register listener(old_snapshot, new_snapshot) to run after each snapshot swap'''
+    _snapshot_listeners.append(listener)
+    return listener
+
+# Recently published snapshots by version.  Pages only hold the version of the snapshot
+# they were rendered from and look the data up here.
+snapshot_cache = LRUCache(SNAPSHOT_CACHE_SIZE)
+
+def set_current_snapshot(snapshot):
+    ''' Publish a new snapshot to all readers'''
+    old_snapshot = _current['snapshot']
+    snapshot_cache.set(snapshot['version'], snapshot)
+    _current['snapshot'] = snapshot
+    for listener in _snapshot_listeners:
+        try:
+            listener(old_snapshot, snapshot)
+        except Exception as e:
+            print('Snapshot listener failed:', e)
+
+def get_current_snapshot():
+    ''' Return the published snapshot.  Callers should read it once per callback and use
+    that reference throughout.'''
+    ensure_refresh_thread()
+    return _current['snapshot']
+
+def get_snapshot(version=None, snapshot_dir=SNAPSHOT_DIR):
+    ''' Return the snapshot with this version, from this worker's snapshot cache or else
+    from its saved file, falling back to the current snapshot.  Loaded files go through
+    the bounded snapshot cache, so only a few dataframes are held in memory.'''
+    if version is not None:
+        current = _current['snapshot']
+        if current is not None and current['version'] == version:
+            return get_current_snapshot()
+        snapshot = snapshot_cache.get(version)
+        if snapshot is not None:
+            return snapshot
+        manifest = cached_manifest(snapshot_dir)
+        entry = manifest['index'].get(version)
+        if entry is not None and version not in manifest['unreadable']:
+            try:
+                snapshot = load_snapshot_file(snapshot_dir, entry)
+            except Exception as e:
+                print('Could not load snapshot', entry['file'], e)
+                manifest['unreadable'].add(version)
+            else:
+                snapshot_cache.set(version, snapshot)
+                return snapshot
+    return get_current_snapshot()
+
+def _publish_from(build_fn, label):
+    if build_fn is None:
+        return False
+    try:
+        snapshot = build_fn()
+    except Exception as e:
+        print('Snapshot {} failed:'.format(label), e)
+        return False
+    if snapshot is None:
+        return False
+    current = _current['snapshot']
+    if current is not None and current['version'] == snapshot['version']:
+        return False
+    set_current_snapshot(snapshot)
+    return True
+
+def refresh_snapshot():
+    ''' Rebuild the snapshot off the request path and swap it in if the data changed.
+    Returns True when a new snapshot was published.'''
+    return _publish_from(_refresh['build_fn'], 'refresh')
+
+def follow_snapshot():
+    ''' Swap in the snapshot another worker built, if there is a new one.  Returns True
+    when a new snapshot was published.'''
+    return _publish_from(_refresh['follow_fn'], 'follow')
+
+def is_refresher():
+    ''' Whether this worker runs the refresh: without a lock path every worker does,
+    otherwise the one that holds the lock, until it exits'''
+    if _refresh['lock_path'] is None:
+        return True
+    if _refresh['lock_file'] is None:
+        _refresh['lock_file'] = try_lock_file(_refresh['lock_path'])
+    return _refresh['lock_file'] is not None
+
+def _refresh_loop(interval, refresh_first, poll_interval):
+    next_refresh = time.time() + (0 if refresh_first else interval)
+    while True:
+        if is_refresher():
+            if time.time() >= next_refresh:
+                refresh_snapshot()
+                if interval <= 0:
+                    return
+                next_refresh = time.time() + interval
+            time.sleep(max(next_refresh - time.time(), 0))
+        else:
+            # Followers take over the refresh if the refreshing worker exits
+            if poll_interval <= 0:
+                return
+            time.sleep(poll_interval)
+            follow_snapshot()
+
+def start_snapshot_refresh(build_fn, interval, refresh_first=False, lock_path=None, follow_fn=None,
+                           poll_interval=SNAPSHOT_POLL_INTERVAL):
+    ''' Register the function used to rebuild the snapshot and how often (seconds) to run it.
+    With refresh_first set, the refreshing worker rebuilds once as soon as its thread
+    starts, e.g. when the app started from a snapshot file.  An interval of 0 or less
+    disables the background refresh.  With lock_path set, only the worker holding the
+    lock on it refreshes and the others call follow_fn every poll_interval seconds.'''
+    _refresh['build_fn'] = build_fn
+    _refresh['interval'] = interval
+    _refresh['refresh_first'] = refresh_first
+    _refresh['lock_path'] = lock_path
+    _refresh['follow_fn'] = follow_fn
+    _refresh['poll_interval'] = poll_interval
+
+def ensure_refresh_thread():
+    ''' Start the background refresh thread for this process if it isn't running'''
+    if _refresh['build_fn'] is None or (_refresh['interval'] <= 0 and not _refresh['refresh_first']):
+        return
+    pid = os.getpid()
+    if _refresh['pid'] == pid:
+        return
+    with _refresh_lock:
+        if _refresh['pid'] == pid:
+            return
+        # A lock file inherited through a fork is the parent's lock, not this worker's
+        _refresh['lock_file'] = None
+        thread = threading.Thread(target=_refresh_loop,
+                                  args=(_refresh['interval'], _refresh['refresh_first'], _refresh['poll_interval']),
+                                  name='snapshot-refresh', daemon=True)
+        thread.start()
+        _refresh['pid'] = pid
+        _refresh['thread'] = thread
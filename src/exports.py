@@ -0,0 +1,169 @@
+# Libraries
+import os
+import re
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import pandas as pd
+import xlsxwriter
+
+from config_settings import *
+from data_processing import *
+from instrumentation import *
+
+# ----------------------------------------------------------------------------
+# FLAG SETS
+# ----------------------------------------------------------------------------
+
+# The complete records of each "Pull complete data for all samples with ..." flag of the
+# report tabs, as (label, function of the site context returning the flagged rows)
+export_flag_sets = {
+    'missing_draws': ('Missing blood draws', lambda context: context['missing_blood']),
+    'missing_components': ('Missing components', lambda context: get_metrics_missing(context['blood_drawn'])),
+    'time_check_fail': ('Failed time checks', lambda context: get_time_check_fail(context['blood_drawn'])),
+    'hemolysis': ('Hemolysis >= 1', lambda context: get_hemolysis_flagged(context['df'])),
+    'deviations': ('Protocol deviations', lambda context: get_deviation_records(context['df'])),
+}
+
+export_formats = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# ----------------------------------------------------------------------------
+# WRITERS
+# ----------------------------------------------------------------------------
+
+# Both writers go through the frame EXPORT_CHUNK_ROWS rows at a time, and xlsxwriter's
+# constant_memory mode flushes each row to disk once the next one is started, so only a
+# chunk of rows is ever converted at once.
+
+def write_csv(df, path, sheet_name=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    with open(path, 'w', newline='', encoding='utf-8') as csv_file:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            df.iloc[start:start + chunk_rows].to_csv(csv_file, header=start == 0, index=False)
+
+def excel_rows(chunk):
+    ''' Rows of chunk as values xlsxwriter can write: None for missing values and text for
+    durations'''
+    columns = []
+    for col in chunk.columns:
+        values = chunk[col]
+        missing = values.isna().tolist()
+        if pd.api.types.is_timedelta64_dtype(values):
+            values = values.astype(str)
+        columns.append([None if is_missing else value
+                        for value, is_missing in zip(values.astype(object).tolist(), missing)])
+    return zip(*columns)
+
+def write_xlsx(df, path, sheet_name='Sheet1', chunk_rows=EXPORT_CHUNK_ROWS):
+    workbook = xlsxwriter.Workbook(path, {
+        'constant_memory': True,
+        'tmpdir': os.path.dirname(path),
+        'strings_to_formulas': False,
+        'strings_to_urls': False,
+        'nan_inf_to_errors': True,
+        'default_date_format': 'yyyy-mm-dd hh:mm',
+    })
+    try:
+        worksheet = workbook.add_worksheet(sheet_name[:31])
+        worksheet.write_row(0, 0, [str(col) for col in df.columns], workbook.add_format({'bold': True}))
+        worksheet.freeze_panes(1, 0)
+        row_number = 1
+        for start in range(0, len(df), chunk_rows):
+            for row in excel_rows(df.iloc[start:start + chunk_rows]):
+                worksheet.write_row(row_number, 0, row)
+                row_number += 1
+    finally:
+        workbook.close()
+
+export_writers = {'csv': write_csv, 'xlsx': write_xlsx}
+
+# ----------------------------------------------------------------------------
+# EXPORT FILES
+# ----------------------------------------------------------------------------
+
+# Files are named by (snapshot version, site, flag set, format), so a file once written is
+# the answer to every later download of it, from any worker.
+
+def export_path(version, site, flag, fmt, export_dir=EXPORT_DIR):
+    site_key = hashlib.sha1(site.encode('utf-8')).hexdigest()[:10]
+    return os.path.join(export_dir, '{}-{}-{}.{}'.format(version, site_key, flag, fmt))
+
+def export_download_name(snapshot, site, flag, fmt):
+    ''' File name offered to the browser, e.g. blood-hemolysis-all-2021-06-01.csv'''
+    site_slug = re.sub('[^A-Za-z0-9]+', '-', site).strip('-').lower() or 'site'
+    return 'blood-{}-{}-{}.{}'.format(flag.replace('_', '-'), site_slug, snapshot['report_date'], fmt)
+
+def prune_exports(export_dir=EXPORT_DIR, keep=EXPORT_DISK_KEEP):
+    ''' Remove all but the keep most recently written export files'''
+    try:
+        files = [os.path.join(export_dir, name) for name in os.listdir(export_dir)
+                 if os.path.splitext(name)[1][1:] in export_formats]
+        files.sort(key=os.path.getmtime, reverse=True)
+    except OSError as e:
+        print('Could not list exports:', e)
+        return
+    for path in files[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def write_export(path, build_df, flag, fmt):
+    ''' Write the rows returned by build_df() to path, through a temporary file so a partly
+    written export is never served'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with timed('a2cps_export_seconds', flag=flag, format=fmt):
+            export_writers[fmt](build_df(), tmp_path, sheet_name=flag)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    prune_exports(os.path.dirname(path))
+    return path
+
+# ----------------------------------------------------------------------------
+# BACKGROUND EXPORTS
+# ----------------------------------------------------------------------------
+
+# Exports are written by a small thread pool in each worker, off the request threads.  A
+# download of a file that is already being written waits on the same job.
+_export_pool = {'pid': None, 'executor': None}
+_export_jobs = {}
+_export_lock = threading.Lock()
+
+def _get_executor():
+    ''' This worker's export thread pool, made after the fork by gunicorn'''
+    if _export_pool['pid'] != os.getpid():
+        _export_pool['executor'] = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='export')
+        _export_pool['pid'] = os.getpid()
+        _export_jobs.clear()
+    return _export_pool['executor']
+
+def request_export(path, build_df, flag, fmt):
+    ''' Future of the export at path, starting it unless it is already being written'''
+    with _export_lock:
+        executor = _get_executor()
+        future = _export_jobs.get(path)
+        if future is None:
+            future = executor.submit(write_export, path, build_df, flag, fmt)
+            _export_jobs[path] = future
+            future.add_done_callback(lambda done: _export_jobs.pop(path, None))
+    return future
+
+def get_export_file(path, build_df, flag, fmt, wait=EXPORT_WAIT_SECONDS):
+    ''' path once the export is written, or None if it is still being written after wait
+    seconds.  Errors of the export are raised.'''
+    if os.path.exists(path):
+        inc('a2cps_cache_events_total', cache='export_files', event='hits')
+        return path
+    inc('a2cps_cache_events_total', cache='export_files', event='misses')
+    try:
+        return request_export(path, build_df, flag, fmt).result(timeout=wait)
+    except FutureTimeoutError:
+        return None
@@ -0,0 +1,276 @@
+# Libraries
+import os
+import bisect
+import json
+import tempfile
+import threading
+import time
+
+from config_settings import *
+
+# ----------------------------------------------------------------------------
+# METRICS
+# ----------------------------------------------------------------------------
+
+# Metric definitions by name: Prometheus type, help text and, for histograms, the upper
+# bounds of the buckets.  Samples are kept per tuple of (label, value) pairs.
+SECONDS_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7)
+
+metric_definitions = {
+    'a2cps_ingest_fetch_seconds': ('histogram', 'Download time of each MCC report file', SECONDS_BUCKETS),
+    'a2cps_ingest_fetch_responses_total': ('counter', 'Report file downloads by HTTP status (error when no response)', None),
+    'a2cps_ingest_payload_bytes': ('gauge', 'Size of the last downloaded report file', None),
+    'a2cps_ingest_stage_seconds': ('histogram', 'Duration of each ingest stage (read, flatten, clean, incremental_clean, combine, aggregate)', SECONDS_BUCKETS),
+    'a2cps_snapshot_rows': ('gauge', 'Rows of the current snapshot by site', None),
+    'a2cps_snapshot_loaded_timestamp_seconds': ('gauge', 'Unix time the current snapshot was loaded', None),
+    'a2cps_snapshot_swaps_total': ('counter', 'Snapshots published', None),
+    'a2cps_tab_build_seconds': ('histogram', 'Build time of tab contents (cache misses only)', SECONDS_BUCKETS),
+    'a2cps_dash_callback_seconds': ('histogram', 'Dash callback request time by output, including compression', SECONDS_BUCKETS),
+    'a2cps_dash_callback_response_bytes': ('histogram', 'Dash callback response size by output, as sent', BYTES_BUCKETS),
+    'a2cps_export_seconds': ('histogram', 'Time to write an export file by flag set and format', SECONDS_BUCKETS),
+    'a2cps_cache_events_total': ('counter', 'Cache hits, misses and evictions by cache', None),
+    'a2cps_cache_entries': ('gauge', 'Entries held by each cache', None),
+    'process_resident_memory_bytes': ('gauge', 'Resident memory of the worker process', None),
+}
+
+_samples = {name: {} for name in metric_definitions}
+_samples_lock = threading.Lock()
+
+# Functions called before metrics are written out, to set values read from elsewhere
+# (cache counters, ...)
+_collectors = []
+
+def register_collector(collector):
+    ''' Register collector() to run before each metrics export'''
+    _collectors.append(collector)
+    return collector
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def inc(name, amount=1, **labels):
+    key = _label_key(labels)
+    with _samples_lock:
+        _samples[name][key] = _samples[name].get(key, 0) + amount
+
+def set_value(name, value, **labels):
+    ''' Set a gauge, or a counter that is counted elsewhere'''
+    with _samples_lock:
+        _samples[name][_label_key(labels)] = value
+
+def clear_gauge(name):
+    with _samples_lock:
+        _samples[name].clear()
+
+def observe(name, value, **labels):
+    ''' Add value to a histogram'''
+    buckets = metric_definitions[name][2]
+    key = _label_key(labels)
+    with _samples_lock:
+        sample = _samples[name].get(key)
+        if sample is None:
+            sample = _samples[name][key] = [[0] * (len(buckets) + 1), 0., 0]
+        sample[0][bisect.bisect_left(buckets, value)] += 1
+        sample[1] += value
+        sample[2] += 1
+
+class timed(object):
+    ''' Context manager adding the duration of its block to a seconds histogram'''
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+def _reset_after_fork():
+    ''' Forked workers start their counters and histograms from zero, so what the parent
+    recorded (e.g. the ingest run by gunicorn --preload) isn't counted once per worker'''
+    global _samples_lock
+    _samples_lock = threading.Lock()
+    for name, (kind, help_text, buckets) in metric_definitions.items():
+        if kind != 'gauge':
+            _samples[name].clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def process_rss():
+    ''' Resident memory of this process in bytes, None where /proc is not available'''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def collect():
+    ''' Run the collectors and return a copy of this process's samples'''
+    for collector in _collectors:
+        try:
+            collector()
+        except Exception as e:
+            print('Metrics collector failed:', e)
+    rss = process_rss()
+    if rss is not None:
+        set_value('process_resident_memory_bytes', rss)
+    with _samples_lock:
+        return {name: {key: [list(value[0]), value[1], value[2]] if isinstance(value, list) else value
+                       for key, value in samples.items()}
+                for name, samples in _samples.items()}
+
+# ----------------------------------------------------------------------------
+# WORKER AGGREGATION
+# ----------------------------------------------------------------------------
+
+# gunicorn serves requests from several worker processes, and a scrape reaches only one of
+# them.  Each worker writes its samples to a file in a shared directory every few seconds
+# (and when scraped), and /metrics adds up the files of all live workers.  With
+# gunicorn --preload the default temporary directory is made before the fork, so every
+# worker of the app shares it.
+metrics_dir = METRICS_DIR or tempfile.mkdtemp(prefix='a2cps-metrics-')
+
+_flush = {'pid': None}
+_flush_lock = threading.Lock()
+
+def _worker_file(pid):
+    return os.path.join(metrics_dir, 'worker-{}.json'.format(pid))
+
+def write_worker_metrics():
+    ''' Write this worker's samples to its file in the metrics directory'''
+    samples = collect()
+    data = {name: [[list(key), value] for key, value in values.items()] for name, values in samples.items()}
+    path = _worker_file(os.getpid())
+    try:
+        with open(path + '.tmp', 'w') as metrics_file:
+            json.dump(data, metrics_file)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print('Could not write metrics:', e)
+    return samples
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def read_worker_metrics():
+    ''' {pid: samples} of every live worker.  Files of workers that exited are removed.'''
+    workers = {}
+    try:
+        file_names = os.listdir(metrics_dir)
+    except OSError:
+        return workers
+    for file_name in file_names:
+        if not (file_name.startswith('worker-') and file_name.endswith('.json')):
+            continue
+        pid = int(file_name[len('worker-'):-len('.json')])
+        path = os.path.join(metrics_dir, file_name)
+        if not _pid_alive(pid):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as metrics_file:
+                data = json.load(metrics_file)
+        except (OSError, ValueError):
+            continue
+        workers[pid] = {name: {tuple(tuple(pair) for pair in key): value for key, value in values}
+                        for name, values in data.items() if name in metric_definitions}
+    return workers
+
+def merge_worker_metrics(workers):
+    ''' Add up counters and histograms across workers.  Gauges are kept per worker, with
+    a pid label.'''
+    merged = {name: {} for name in metric_definitions}
+    for pid, samples in workers.items():
+        for name, values in samples.items():
+            kind = metric_definitions[name][0]
+            for key, value in values.items():
+                if kind == 'gauge':
+                    merged[name][key + (('pid', str(pid)),)] = value
+                elif kind == 'counter':
+                    merged[name][key] = merged[name].get(key, 0) + value
+                elif key in merged[name]:
+                    total = merged[name][key]
+                    total[0] = [a + b for a, b in zip(total[0], value[0])]
+                    total[1] += value[1]
+                    total[2] += value[2]
+                else:
+                    merged[name][key] = [list(value[0]), value[1], value[2]]
+    return merged
+
+def _flush_loop(interval):
+    while True:
+        time.sleep(interval)
+        write_worker_metrics()
+
+def ensure_metrics_flush():
+    ''' Start this worker's metrics flush thread if it isn't running'''
+    pid = os.getpid()
+    if _flush['pid'] == pid or METRICS_FLUSH_INTERVAL <= 0:
+        return
+    with _flush_lock:
+        if _flush['pid'] == pid:
+            return
+        thread = threading.Thread(target=_flush_loop, args=(METRICS_FLUSH_INTERVAL,),
+                                  name='metrics-flush', daemon=True)
+        thread.start()
+        _flush['pid'] = pid
+
+# ----------------------------------------------------------------------------
+# PROMETHEUS TEXT FORMAT
+# ----------------------------------------------------------------------------
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(k, v.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')) for k, v in pairs]
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in escaped) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render_metrics(samples):
+    ''' Samples in the Prometheus text exposition format'''
+    lines = []
+    for name, (kind, help_text, buckets) in metric_definitions.items():
+        values = samples.get(name, {})
+        if not values:
+            continue
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for key, value in sorted(values.items()):
+            if kind != 'histogram':
+                lines.append('{}{} {}'.format(name, _format_labels(key), _format_value(value)))
+                continue
+            bucket_counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + [float('inf')], bucket_counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(key, [('le', _format_value(float(bound)))]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(key), _format_value(float(total))))
+            lines.append('{}_count{} {}'.format(name, _format_labels(key), count))
+    return '\n'.join(lines) + '\n'
+
+def export_metrics():
+    ''' Prometheus text of all workers' metrics, with this worker's samples up to date'''
+    samples = write_worker_metrics()
+    workers = read_worker_metrics()
+    workers[os.getpid()] = samples
+    return render_metrics(merge_worker_metrics(workers))
@@ -2,6 +2,8 @@
 # Data
 import pandas as pd # Dataframe manipulations
 import math
+import re
+from urllib.parse import urlencode
 
 # Dash App
 # from jupyter_dash import JupyterDash # for running in a Jupyter Notebook
@@ -12,8 +14,10 @@ import dash_bootstrap_components as dbc
 import dash_table as dt
 
 # Data Visualization
-import plotly.express as px
+from make_figures import *
 from data_processing import *
+from aggregate_history import *
+from config_settings import *
 from styling import *
 
 # ----------------------------------------------------------------------------
@@ -24,39 +28,86 @@ from styling import *
 # CUSTOM FUNCTIONS FOR DASH UI COMPONENTS
 # ----------------------------------------------------------------------------
 
-def build_datatable(df,table_id):
-    table = html.Div([
-        dt.DataTable(
+def build_datatable(df,table_id, server_side=True, page_size=10):
+    ''' DataTable of df.  With server_side set and a source registered for table_id in
+    datatable_sources, only the first page is sent with the table; paging, sorting and
+    filtering are then done on the server by the update_server_datatable callback.'''
+    columns = [{"name": i, "id": i} for i in df.columns]
+    if server_side and table_id in datatable_sources:
+        data, page_count = query_datatable(df, 0, page_size)
+        table = dt.DataTable(
+            id={'type': 'server-datatable', 'index': table_id},
+            columns=columns,
+            data=data,
+            style_table={'overflowX': 'auto'},
+            page_action="custom",
+            page_current=0,
+            page_size=page_size,
+            page_count=page_count,
+            sort_action="custom",
+            sort_mode="multi",
+            sort_by=[],
+            filter_action="custom",
+            filter_query='',
+            style_cell={
+                'whitespace':'normal',
+                'height':'auto',
+            },
+        )
+    else:
+        table = dt.DataTable(
             id=table_id,
-            columns=[{"name": i, "id": i} for i in df.columns],
+            columns=columns,
             data=df.to_dict('records'),
             style_table={'overflowX': 'auto'},
             sort_action="native",
             sort_mode="multi",
-            page_size=10,
+            page_size=page_size,
             style_cell={
                 'whitespace':'normal',
                 'height':'auto',
             },
         )
-        ],style={'margin-bottom':'50px'})
-    return table
+    return html.Div([table],style={'margin-bottom':'50px'})
+
+def export_link(context, flag, fmt, label):
+    ''' Download link of an export.  The id holds the path, and the export_hrefs clientside
+    callback sets the query to the site and snapshot the page shows now: the site can be
+    switched in the browser and a cached tab can be carried over to a newer snapshot.'''
+    path = REQUESTS_PATHNAME_PREFIX + 'export/' + flag + '.' + fmt
+    query = urlencode({'site': context['site'], 'version': context['version']})
+    return html.A(label, href=path + '?' + query, target='_blank', id={'type': 'export-link', 'index': path})
+
+def export_links(context, flag):
+    ''' CSV and XLSX download links of the complete records of a flag set (see exports.py)'''
+    return html.Div([
+        'Download complete records: ',
+        export_link(context, flag, 'csv', 'CSV'),
+        ' | ',
+        export_link(context, flag, 'xlsx', 'XLSX'),
+    ], style=EXCEL_EXPORT_STYLE)
 
 def bar_percent_figure(fig_df):
-    fig = px.bar(fig_df, x='Visit', y='Percent', color='Site', barmode='group')
-    fig.update_xaxes(categoryorder='category descending')
-    return fig
+    return bar_figure(fig_df, 'Visit', 'Percent', 'Site', categoryorder='category descending')
+
+def site_graph(figures, graph_id):
+    ''' Graph of one of the figures that change with the site.  With CLIENTSIDE_SITE_SWITCH
+    it gets a pattern id, so the site switch clientside callback can replace its figure.'''
+    if CLIENTSIDE_SITE_SWITCH:
+        return dcc.Graph(figure=figures[graph_id], id={'type': 'site-graph', 'index': graph_id})
+    return dcc.Graph(figure=figures[graph_id], id=graph_id)
 
 # ----------------------------------------------------------------------------
 # Missing Data Section
 # ----------------------------------------------------------------------------
 
-def make_missing(df):
-    blood_drawn, missing_blood_df, missing_analysis_df = missing_blood_draws(df)
+def make_missing(context):
+    blood_drawn, missing_blood_df, missing_analysis_df = context['blood_drawn'], context['missing_blood'], context['missing_analysis']
 
     missing = html.Div([
         dbc.Row([
             dbc.Col([
+                export_links(context, 'missing_draws'),
                 html.H3('Missing Blood Draws'),
                 dcc.Markdown('''Records without a value in the 'bscp_time_blood_draw' column.'''),
                 build_datatable(missing_blood_df,'table_missing_blood'),
@@ -86,35 +137,32 @@ def make_missing(df):
 # ----------------------------------------------------------------------------
 # Sample counts by site
 # ----------------------------------------------------------------------------
-def make_site(df):
-    blood_drawn, missing_blood_df, missing_analysis_df = missing_blood_draws(df)
-
-    # Count by site
-    blood_site_count = blood_drawn.groupby(['Site','Visit'])['ID'].count().rename('Count').reset_index()
-    blood_site_count_fig = px.bar(blood_site_count, x='Visit', y='Count', color='Site',barmode='group')
-    blood_site_count_fig.update_xaxes(categoryorder='category descending')
-
-    # Count by percent
-    fig_no_pax_df = bar_percent_figure(metric_obtained(blood_drawn, 'bscp_paxg_aliq_na'))
-    fig_no_buffy_df = bar_percent_figure(metric_obtained(blood_drawn, 'bscp_buffycoat_na'))
-    fig_aliquot_5_df = bar_percent_figure(aliquot_obtained(blood_drawn, 5))
-    fig_aliquot_1_df = bar_percent_figure(aliquot_obtained(blood_drawn, 1))
+def site_tab_figures(context):
+    # Counts and percents by site, all from one grouped pass
+    metrics_df = cube_site_metrics(context['cube'], site_metrics, context['site'])
+    return {
+        # Count by site
+        'fig_blood_site_count': bar_figure(get_metric(metrics_df, 'Count'), 'Visit', 'Count', 'Site', categoryorder='category descending'),
+        # Count by percent
+        'fig_no_pax': bar_percent_figure(get_metric(metrics_df, 'Pax Obtained')),
+        'fig_no_buffy': bar_percent_figure(get_metric(metrics_df, 'Buffy Obtained')),
+        'fig_aliquot_5': bar_percent_figure(get_metric(metrics_df, 'Aliquots >= 5')),
+        'fig_aliquot_1': bar_percent_figure(get_metric(metrics_df, 'Aliquots >= 1')),
+    }
+
+def make_site(context):
+    blood_drawn, missing_blood_df, missing_analysis_df = context['blood_drawn'], context['missing_blood'], context['missing_analysis']
+    figures = site_tab_figures(context)
 
     # Missing elements
-    pax_missing = ~blood_drawn['bscp_paxg_aliq_na'].isna()
-    buffy_missing = ~blood_drawn['bscp_buffycoat_na'].isna()
-    aliquots_missing = blood_drawn['bscp_aliq_cnt'].isna()
-    metrics_missing = blood_drawn[pax_missing | buffy_missing | aliquots_missing]
-    move_column_inplace(metrics_missing, 'bscp_buffycoat_na', 4)
-    move_column_inplace(metrics_missing, 'bscp_paxg_aliq_na', 4)
-    move_column_inplace(metrics_missing, 'bscp_aliq_cnt', 4)
+    metrics_missing = get_metrics_missing(blood_drawn)
 
     site = html.Div([
         dbc.Row([
             dbc.Col([
                 html.H4('Count by Site'),
                 dcc.Markdown(''' Count of records with blood draw data grouped by Site and visit type'''),
-                dcc.Graph(figure=blood_site_count_fig,id = 'fig_blood_site_count'),
+                site_graph(figures, 'fig_blood_site_count'),
             ],width=6),
             dbc.Col([
 
@@ -124,26 +172,27 @@ def make_site(df):
             dbc.Col([
                 html.H4('Percent of samples with Pax Obtained'),
                 dcc.Markdown(''' '''),
-                dcc.Graph(figure=fig_no_pax_df, id = 'fig_no_pax'),
+                site_graph(figures, 'fig_no_pax'),
             ],width=6),
             dbc.Col([
                 html.H4('Percent of samples with Buffy Obtained'),
                 dcc.Markdown(''' '''),
-                dcc.Graph(figure=fig_no_buffy_df, id = 'fig_no_buffy'),
+                site_graph(figures, 'fig_no_buffy'),
             ],width=6),
         ]),
         dbc.Row([
             dbc.Col([
                 html.H4('Percent of samples with Aliquot count >= 5'),
                 dcc.Markdown(''' '''),
-                dcc.Graph(figure=fig_aliquot_5_df,id = 'fig_aliquot_5'),
+                site_graph(figures, 'fig_aliquot_5'),
             ],width=6),
             dbc.Col([
                 html.H4('Percent of samples with at least one Aliquot'),
                 dcc.Markdown(''' '''),
-                dcc.Graph(figure=fig_aliquot_1_df, id = 'fig_aliquot_1'),
+                site_graph(figures, 'fig_aliquot_1'),
             ],width=6),
         ]),
+        export_links(context, 'missing_components'),
         html.H4('Blood Draws with missing components'),
         dcc.Markdown(''' Samples with a value in one of ['bscp_paxg_aliq_na', 'bscp_buffycoat_na', 'bscp_aliq_cnt']'''),
         build_datatable(metrics_missing,'table_metrics_missing'),
@@ -171,47 +220,48 @@ def make_site(df):
 # ----------------------------------------------------------------------------
 def time_bar(df):
     df = df.sort_values(by=['Site'])
-    fig = px.bar(df, x='Visit', y='Percent', facet_col='Site', barmode='group', color='Site')
-    fig.update_xaxes(categoryorder='category descending', title='')
-    return fig
+    return facet_bar_figure(df, 'Visit', 'Percent', 'Site', categoryorder='category descending', x_title='')
 
 def time_hist(df, time_col, range_top):
     hist_df = df[df[time_col] < range_top].sort_values(by=['Site'])
-    fig = px.histogram(hist_df, x=time_col, facet_col='Site', color='Site')
-    return fig
-
-def make_timing(df):
-    blood_drawn, missing_blood_df, missing_analysis_df = missing_blood_draws(df)
-
-    centrifuge_df = pass_threshold(blood_drawn,'time_to_centrifuge_minutes', 30)
-    # fig_centrifuge_df = bar_percent_figure(centrifuge_df)
-    fig_centrifuge_df = time_bar(centrifuge_df)
-    hist_centrifuge = time_hist(blood_drawn, "time_to_centrifuge_minutes", 200)
-
-
-
-    freezer_df = pass_threshold(blood_drawn,'time_to_freezer_minutes', 60)
-    # fig_freezer_df = bar_percent_figure(freezer_df)
-    fig_freezer_df = time_bar(freezer_df)
-    hist_freezer = time_hist(blood_drawn, "time_to_freezer_minutes", 200)
+    return facet_histogram_figure(hist_df, time_col, 'Site')
+
+def timing_tab_figures(context):
+    blood_drawn = context['blood_drawn']
+    metrics_df = cube_site_metrics(context['cube'], timing_metrics, context['site'])
+
+    centrifuge_df = get_metric(metrics_df, 'Centrifuge < 30 min')
+    freezer_df = get_metric(metrics_df, 'Freezer < 60 min')
+    return {
+        'fig_hist_centrifuge': time_hist(blood_drawn, "time_to_centrifuge_minutes", 200),
+        # 'fig_centrifuge': bar_percent_figure(centrifuge_df),
+        'fig_centrifuge': time_bar(centrifuge_df),
+        'fig_hist_freezer': time_hist(blood_drawn, "time_to_freezer_minutes", 200),
+        # 'fig_freezer': bar_percent_figure(freezer_df),
+        'fig_freezer': time_bar(freezer_df),
+    }
+
+def make_timing(context):
+    blood_drawn, missing_blood_df, missing_analysis_df = context['blood_drawn'], context['missing_blood'], context['missing_analysis']
+    figures = timing_tab_figures(context)
 
     timing = html.Div([
         dbc.Row([
             dbc.Col([
                 html.H4('Distribution of centrifuge time'),
                     dcc.Markdown('''Histograms of times below 200.  There are only a few records >200, but they are removed for better display of the more normal values.'''),
-                dcc.Graph(figure=hist_centrifuge, id = 'fig_hist_centrifuge'),
+                site_graph(figures, 'fig_hist_centrifuge'),
                 html.H4('Percent of samples to Centrifuge in less than 30 min'),
                 dcc.Markdown(''' '''),
-                dcc.Graph(figure=fig_centrifuge_df, id = 'fig_centrifuge'),
+                site_graph(figures, 'fig_centrifuge'),
             ],width=6),
             dbc.Col([
                 html.H4('Distribution of freezer time'),
                     dcc.Markdown('''Histograms of times below 200.  There are only a few records >200, but they are removed for better display of the more normal values.'''),
-                dcc.Graph(figure=hist_freezer, id = 'fig_hist_freezer'),
+                site_graph(figures, 'fig_hist_freezer'),
                 html.H4('Percent of samples to Freezer in less than 30 min'),
                 dcc.Markdown(''' '''),
-                dcc.Graph(figure=fig_freezer_df, id = 'fig_freezer'),
+                site_graph(figures, 'fig_freezer'),
             ],width=6)
         ]),
         dbc.Row([
@@ -219,10 +269,11 @@ def make_timing(df):
         ]),
         dbc.Row([
             dbc.Col([
+                export_links(context, 'time_check_fail'),
                 html.H4('Records that fail time checks'),
                 dcc.Markdown(''' Records flagged as failing the time check criteria.
-                 blood_df['time_values_check'] = (blood_df['time_to_centrifuge_minutes'] < blood_df['time_to_freezer_minutes'] ) & (blood_df['time_to_centrifuge_minutes'] <= 30) & (blood_df['time_to_freezer_minutes'] <= 60) '''),
-                build_datatable(blood_drawn[~blood_drawn['time_values_check']],'table_time_check_fail'),
+                 blood_df['time_values_check'] = (blood_df['time_to_centrifuge_minutes'] >= 0) & (blood_df['time_to_centrifuge_minutes'] < blood_df['time_to_freezer_minutes'] ) & (blood_df['time_to_centrifuge_minutes'] <= 30) & (blood_df['time_to_freezer_minutes'] <= 60) '''),
+                build_datatable(get_time_check_fail(blood_drawn),'table_time_check_fail'),
                 ],width = 12)
         ]),
         dbc.Row([
@@ -250,22 +301,36 @@ def make_timing(df):
 # ----------------------------------------------------------------------------
 def make_hemolysis_fig(hem_df, site):
     fig_df = hem_df[hem_df['Screening Site'] == site]
-    fig = px.bar(fig_df, x='Hemolysis', y='count', color='Visit', title=site,barmode="group")
-    fig.update_xaxes(categoryorder='category ascending')
-    return fig
+    return bar_figure(fig_df, 'Hemolysis', 'count', 'Visit', title=site, categoryorder='category ascending')
+
+def hemolysis_figure(hem_degrees):
+    return stacked_bar_figure(hem_degrees, 'Hemolysis', 'count', 'Visit', 'Screening Site', categoryorder='category ascending')
+
+def hemolysis_tab_figures(context):
+    ''' The stacked hemolysis figure, used with HEMOLYSIS_SUBPLOTS or CLIENTSIDE_SITE_SWITCH'''
+    return {'graph_hemolysis': hemolysis_figure(hemolysis_counts(context['cube'], context['site']))}
+
+def make_hemolysis_graphs(hem_degrees):
+    ''' A graph per screening site, or all of them as rows of one figure with HEMOLYSIS_SUBPLOTS.
+    Switching sites in the browser replaces figures but not graphs, so CLIENTSIDE_SITE_SWITCH
+    also uses the single figure.'''
+    if HEMOLYSIS_SUBPLOTS or CLIENTSIDE_SITE_SWITCH:
+        return html.Div([site_graph({'graph_hemolysis': hemolysis_figure(hem_degrees)}, 'graph_hemolysis')])
+    return html.Div([
+        dcc.Graph(id='graph'+site, figure = make_hemolysis_fig(hem_degrees, site)) for site in hem_degrees['Screening Site'].unique()
+    ])
 
-def make_hemolysis(df):
-    hem_degrees = count_hemolysis_records(df)
+def make_hemolysis(context):
+    hem_degrees = hemolysis_counts(context['cube'], context['site'])
 
     hemolysis = html.Div([
+        export_links(context, 'hemolysis'),
         html.H3('Hemolysis Data'),
         dcc.Markdown('''Roll up data to count number of records by Site, Visit type and degree of hemolysis (table at end)
         Plot barplots of hemolysis degree data colored by visit and split by site
         '''),
 
-        html.Div([
-            dcc.Graph(id='graph'+site, figure = make_hemolysis_fig(hem_degrees, site)) for site in hem_degrees['Screening Site'].unique()
-        ]),
+        make_hemolysis_graphs(hem_degrees),
         build_datatable(hem_degrees,'table_hem_degrees'),
 
         dcc.Markdown('''
@@ -286,10 +351,11 @@ def make_hemolysis(df):
 # Protcol Deviations
 # ----------------------------------------------------------------------------
 
-def make_deviations(df):
-    deviations_df = get_deviations(df)
-    dev_count = deviations_df.groupby(['Site','Visit','Deviation Reason'])['ID'].count().rename('count').reset_index()
+def make_deviations(context):
+    deviations_df = get_deviations(context['df'])
+    dev_count = deviation_counts(context['cube'], context['site'])
     deviations = html.Div([
+        export_links(context, 'deviations'),
         html.H3('Protocol Deviations'),
         dcc.Markdown(''' Deviation columns for records where bscp_protocol_dev !=0 '''),
         build_datatable(deviations_df,'table_deviations'),
@@ -307,3 +373,105 @@ def make_deviations(df):
             ,style={"white-space": "pre"}),
         ])
     return deviations
+
+# ----------------------------------------------------------------------------
+# Trends
+# ----------------------------------------------------------------------------
+
+# Trend tabs read the aggregate history store of the dashboard's report, one point per
+# week, up to the report date of the snapshot shown
+trend_metrics = [metric['metric'] for metric in site_metrics + timing_metrics if metric['kind'] != 'count']
+
+def trend_graph_id(metric):
+    return 'fig_trend_' + re.sub('[^a-z0-9]+', '_', metric.lower()).strip('_')
+
+def context_history(context):
+    history = read_history(REPORT)
+    return weekly_history(history, until=history_until(history, context['version'], context['report_date']))
+
+def trend_tab_figures(context):
+    weekly, site = context_history(context), context['site']
+    group = trend_group(site)
+    figures = {'fig_trend_count': line_figure(metric_trend(weekly, 'Count', site), 'Week', 'Count', group)}
+    for metric in trend_metrics:
+        figures[trend_graph_id(metric)] = line_figure(metric_trend(weekly, metric, site), 'Week', 'Percent', group, y_range=[0, 105])
+    return figures
+
+def hemolysis_trend_tab_figures(context):
+    trend = hemolysis_trend(context_history(context), context['site'])
+    return {'fig_trend_hemolysis': bar_figure(trend, 'Week', 'Percent', 'Hemolysis', barmode='stack')}
+
+def history_note(context):
+    weekly = context_history(context)
+    weeks = weekly['Week'].nunique()
+    if not weeks:
+        return dcc.Markdown('''No history yet: a point is added for each day the report is loaded from TACC, and each report in the archive.''')
+    return dcc.Markdown('''Last report of each week, {} weeks up to {}.'''.format(weeks, weekly['report_date'].astype(str).max()))
+
+def make_trends(context):
+    figures = trend_tab_figures(context)
+    group = trend_group(context['site'])
+    graphs = [('Count of samples by week', 'fig_trend_count')] + \
+             [('Percent of samples with ' + metric + ' by week', trend_graph_id(metric)) for metric in trend_metrics]
+    rows = []
+    for i in range(0, len(graphs), 2):
+        rows.append(dbc.Row([
+            dbc.Col([
+                html.H4(title),
+                site_graph(figures, graph_id),
+            ],width=6) for title, graph_id in graphs[i:i + 2]
+        ]))
+
+    trends = html.Div([
+        html.H3('Trends'),
+        history_note(context),
+        dcc.Markdown(''' Metrics of the Site Info and Timing tabs for each week, by {}'''.format(group.lower())),
+        ] + rows)
+    return trends
+
+def make_hemolysis_trend(context):
+    figures = hemolysis_trend_tab_figures(context)
+    hemolysis_trend_div = html.Div([
+        html.H3('Hemolysis Trend'),
+        history_note(context),
+        dcc.Markdown(''' Percent of records by degree of hemolysis for each week'''),
+        site_graph(figures, 'fig_trend_hemolysis'),
+    ])
+    return hemolysis_trend_div
+
+# ----------------------------------------------------------------------------
+# Site switch figure store
+# ----------------------------------------------------------------------------
+
+# Functions returning {graph id: figure} for the graphs of each tab that change with the site
+site_figure_sources = [site_tab_figures, timing_tab_figures, hemolysis_tab_figures,
+                       trend_tab_figures, hemolysis_trend_tab_figures]
+
+def make_site_figure_store(site_contexts):
+    ''' Figures of every site for the site switch clientside callback, from (site, context)
+    pairs: {'template': ..., 'sites': {site: {graph id: figure}}}.  The template is sent
+    once rather than with each figure.'''
+    sites = {}
+    for site, context in site_contexts:
+        figures = {}
+        for source in site_figure_sources:
+            figures.update(source(context))
+        sites[site] = {graph_id: without_template(figure) for graph_id, figure in figures.items()}
+    return {'template': figure_template, 'sites': sites}
+
+# ----------------------------------------------------------------------------
+# Server side datatable sources
+# ----------------------------------------------------------------------------
+
+# Functions that rebuild each table's dataframe from the site context, so any worker
+# can answer page / sort / filter requests for a table it didn't render itself.
+datatable_sources = {
+    'table_missing_blood': lambda context: context['missing_blood'],
+    'table_missing_analysis': lambda context: context['missing_analysis'],
+    'table_metrics_missing': lambda context: get_metrics_missing(context['blood_drawn']),
+    'table_blood': lambda context: context['blood_drawn'],
+    'table_time_check_fail': lambda context: get_time_check_fail(context['blood_drawn']),
+    'table_hem_degrees': lambda context: hemolysis_counts(context['cube'], context['site']),
+    'table_deviations': lambda context: get_deviations(context['df']),
+    'table_deviations_count': lambda context: deviation_counts(context['cube'], context['site']),
+}
@@ -0,0 +1,317 @@
+# Libraries
+import math
+import numpy as np
+import plotly.io as pio
+
+# ----------------------------------------------------------------------------
+# FIGURE TEMPLATE
+# ----------------------------------------------------------------------------
+
+# Figures are built as plain figure dicts instead of through plotly express, which
+# validates every property of every trace on each render.  They use the template and
+# colors px would use, so they draw the same.
+figure_template = pio.templates[pio.templates.default].to_plotly_json()
+colorway = figure_template['layout']['colorway']
+
+def without_template(figure):
+    ''' Copy of a figure dict without its layout template'''
+    layout = {k: v for k, v in figure['layout'].items() if k != 'template'}
+    return {'data': figure['data'], 'layout': layout}
+
+def color_map(values):
+    ''' Colorway color of each value, in order of first appearance (as px assigns them)'''
+    return {value: colorway[i % len(colorway)] for i, value in enumerate(values)}
+
+def groups_in_order(df, col):
+    ''' (value, rows) of each value of col, in order of first appearance'''
+    if df.empty:
+        return []
+    return list(df.groupby(col, sort=False, observed=True))
+
+def hover_template(labels):
+    return '<br>'.join(labels) + '<extra></extra>'
+
+# ----------------------------------------------------------------------------
+# HISTOGRAM BINS
+# ----------------------------------------------------------------------------
+
+def round_up(value, values, reverse=False):
+    ''' Port of plotly.js Lib.roundUp: the first of the sorted values above value, or with
+    reverse the last one at or below it'''
+    low, high = 0, len(values) - 1
+    while low < high:
+        if reverse:
+            mid = int(math.ceil((low + high) / 2.))
+            if values[mid] <= value:
+                low = mid
+            else:
+                high = mid - 1
+        else:
+            mid = (low + high) // 2
+            if values[mid] <= value:
+                low = mid + 1
+            else:
+                high = mid
+    return values[low]
+
+def histogram_bin_edges(values):
+    ''' Bin edges for values, computed as plotly.js bins histograms automatically (autoBin):
+    the bin size scales with the spread and count of the data and is rounded to 2, 5 or 10
+    times a power of ten, and integer data get bins centered on whole numbers.  Returns
+    None when there are no values.'''
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return None
+    data_min, data_max = values.min(), values.max()
+
+    # Rough bin size from the smallest gap between values and the standard deviation
+    distinct = np.unique(values)
+    min_diff = (data_max - data_min) or 1.
+    gaps = np.diff(distinct)
+    gaps = gaps[gaps > min_diff / max(len(values) - 1, 1) / 1e4]
+    if len(gaps):
+        min_diff = min(min_diff, gaps.min())
+    power = 10 ** math.floor(math.log(min_diff) / math.log(10))
+    min_size = power * round_up(min_diff / power, [.9, 1.9, 4.9, 9.9], reverse=True)
+    rough_size = max(min_size, 2 * values.std() / len(values) ** .4)
+    base = 10 ** math.floor(math.log(rough_size) / math.log(10))
+    size = base * round_up(rough_size / base, [2, 5, 10]) or 1
+
+    # First bin starts a bin below the first multiple of size at or above the minimum,
+    # then moves so values don't fall on bin edges
+    start = math.ceil(data_min / size) * size - size
+    def on_edge(v):
+        return np.fmod(1 + 100 * (v - start) / size, 100) < 2
+    if np.all(values % 1 == 0):
+        if size < 1:
+            start = data_min - .5 * size
+        else:
+            start -= .5
+            if start + size < data_min:
+                start += size
+    else:
+        edge_count = on_edge(values).sum()
+        mid_count = on_edge(values + size / 2.).sum()
+        if mid_count < .1 * len(values) and (edge_count > .3 * len(values) or on_edge(data_min) or on_edge(data_max)):
+            start += size / 2. if start + size / 2. < data_min else -size / 2.
+    n_bins = 1 + int(math.floor((data_max - start) / size))
+    return start + size * np.arange(n_bins + 1)
+
+def bin_label(low, high, integers):
+    ''' Hover text of a bin: its range of whole numbers for integer data'''
+    if integers:
+        low, high = int(math.ceil(low)), int(math.ceil(high)) - 1
+        return str(low) if low == high else '{} - {}'.format(low, high)
+    return '{:g} - {:g}'.format(low, high)
+
+# ----------------------------------------------------------------------------
+# TRACES AND LAYOUTS
+# ----------------------------------------------------------------------------
+
+def bar_trace(group_col, group, x, y, rows, color, axis=''):
+    return {
+        'alignmentgroup': 'True',
+        'hovertemplate': hover_template([group_col + '=' + str(group), x + '=%{x}', y + '=%{y}']),
+        'legendgroup': str(group),
+        'marker': {'color': color},
+        'name': str(group),
+        'offsetgroup': str(group),
+        'orientation': 'v',
+        'showlegend': True,
+        'textposition': 'auto',
+        'x': rows[x].tolist(),
+        'xaxis': 'x' + axis,
+        'y': rows[y].tolist(),
+        'yaxis': 'y' + axis,
+        'type': 'bar',
+    }
+
+def binned_trace(group_col, group, x, counts, edges, labels, color, axis=''):
+    ''' Bar trace of pre-binned counts that draws like a histogram trace.  Empty bins draw
+    nothing, so they are left out.'''
+    filled = np.flatnonzero(counts)
+    return {
+        'alignmentgroup': 'True',
+        'customdata': [labels[i] for i in filled],
+        'hovertemplate': hover_template([group_col + '=' + str(group), x + '=%{customdata}', 'count=%{y}']),
+        'legendgroup': str(group),
+        'marker': {'color': color},
+        'name': str(group),
+        'offsetgroup': str(group),
+        'orientation': 'v',
+        'showlegend': True,
+        'x': ((edges[filled] + edges[filled + 1]) / 2).tolist(),
+        'y': counts[filled].tolist(),
+        'width': float(edges[1] - edges[0]),
+        'xaxis': 'x' + axis,
+        'yaxis': 'y' + axis,
+        'type': 'bar',
+    }
+
+def line_trace(group_col, group, x, y, rows, color):
+    return {
+        'hovertemplate': hover_template([group_col + '=' + str(group), x + '=%{x}', y + '=%{y}']),
+        'legendgroup': str(group),
+        'line': {'color': color, 'dash': 'solid'},
+        'marker': {'symbol': 'circle'},
+        'mode': 'lines+markers',
+        'name': str(group),
+        'orientation': 'v',
+        'showlegend': True,
+        'x': rows[x].tolist(),
+        'xaxis': 'x',
+        'y': rows[y].tolist(),
+        'yaxis': 'y',
+        'type': 'scatter',
+    }
+
+def axis_name(i):
+    ''' Suffix of the i-th (0 based) subplot's axes: '', '2', '3', ...'''
+    return str(i + 1) if i else ''
+
+def column_domains(n, spacing=0.02):
+    ''' x domains of n side by side subplots, computed as plotly.subplots.make_subplots does'''
+    widths = [(1. - spacing * (n - 1)) * (1. / n)] * n
+    domains = []
+    for c in range(n):
+        start = sum(widths[:c]) + c * spacing
+        domains.append([start, start + widths[c]])
+    return domains
+
+def facet_layout(facet_col, facets, x_title, y_title, legend_title, barmode, xaxis=None):
+    ''' Layout of one row of facet_col subplots with shared axes, like px facet_col'''
+    xaxis = xaxis or {}
+    layout = {}
+    annotations = []
+    for i, (facet, domain) in enumerate(zip(facets, column_domains(max(len(facets), 1)))):
+        n = axis_name(i)
+        layout['xaxis' + n] = dict({'anchor': 'y' + n, 'domain': domain, 'title': {'text': x_title}}, **xaxis)
+        layout['yaxis' + n] = {'anchor': 'x' + n, 'domain': [0.0, 1.0]}
+        if i:
+            layout['xaxis' + n]['matches'] = 'x'
+            layout['yaxis' + n].update({'matches': 'y', 'showticklabels': False})
+        else:
+            layout['yaxis']['title'] = {'text': y_title}
+        annotations.append({'font': {}, 'showarrow': False, 'text': facet_col + '=' + str(facet),
+                            'x': (domain[0] + domain[1]) / 2, 'xanchor': 'center', 'xref': 'paper',
+                            'y': 1.0, 'yanchor': 'bottom', 'yref': 'paper'})
+    if annotations:
+        layout['annotations'] = annotations
+    layout.update({
+        'template': figure_template,
+        'legend': {'title': {'text': legend_title}, 'tracegroupgap': 0},
+        'margin': {'t': 60},
+        'barmode': barmode,
+    })
+    return layout
+
+# ----------------------------------------------------------------------------
+# FIGURES
+# ----------------------------------------------------------------------------
+
+def bar_figure(df, x, y, color, barmode='group', categoryorder=None, title=None):
+    ''' Bar chart with one trace per value of color, like px.bar(df, x, y, color)'''
+    groups = groups_in_order(df, color)
+    colors = color_map([group for group, rows in groups])
+    xaxis = {'anchor': 'y', 'domain': [0.0, 1.0], 'title': {'text': x}}
+    if categoryorder:
+        xaxis['categoryorder'] = categoryorder
+    layout = {
+        'template': figure_template,
+        'xaxis': xaxis,
+        'yaxis': {'anchor': 'x', 'domain': [0.0, 1.0], 'title': {'text': y}},
+        'legend': {'title': {'text': color}, 'tracegroupgap': 0},
+        'barmode': barmode,
+    }
+    if title is None:
+        layout['margin'] = {'t': 60}
+    else:
+        layout['title'] = {'text': title}
+    data = [bar_trace(color, group, x, y, rows, colors[group]) for group, rows in groups]
+    return {'data': data, 'layout': layout}
+
+def line_figure(df, x, y, color, y_range=None):
+    ''' Line chart with markers and one trace per value of color, like
+    px.line(df, x, y, color=color, markers=True)'''
+    groups = groups_in_order(df, color)
+    colors = color_map([group for group, rows in groups])
+    yaxis = {'anchor': 'x', 'domain': [0.0, 1.0], 'title': {'text': y}}
+    if y_range:
+        yaxis['range'] = y_range
+    layout = {
+        'template': figure_template,
+        'xaxis': {'anchor': 'y', 'domain': [0.0, 1.0], 'title': {'text': x}},
+        'yaxis': yaxis,
+        'legend': {'title': {'text': color}, 'tracegroupgap': 0},
+        'margin': {'t': 60},
+    }
+    data = [line_trace(color, group, x, y, rows, colors[group]) for group, rows in groups]
+    return {'data': data, 'layout': layout}
+
+def facet_bar_figure(df, x, y, facet_col, barmode='group', categoryorder=None, x_title=None):
+    ''' Bar chart with one subplot (and color) per value of facet_col, like
+    px.bar(df, x, y, facet_col=facet_col, color=facet_col)'''
+    groups = groups_in_order(df, facet_col)
+    colors = color_map([group for group, rows in groups])
+    xaxis = {'categoryorder': categoryorder} if categoryorder else {}
+    layout = facet_layout(facet_col, [group for group, rows in groups], x if x_title is None else x_title,
+                          y, facet_col, barmode, xaxis)
+    data = [bar_trace(facet_col, group, x, y, rows, colors[group], axis_name(i)) for i, (group, rows) in enumerate(groups)]
+    return {'data': data, 'layout': layout}
+
+def facet_histogram_figure(df, x, facet_col):
+    ''' Histogram with one subplot (and color) per value of facet_col, like
+    px.histogram(df, x, facet_col=facet_col, color=facet_col).  The values are binned
+    here with the same edges for every facet and sent as bars of counts, so the figure
+    size depends on the number of bins rather than the number of rows.'''
+    groups = groups_in_order(df, facet_col)
+    colors = color_map([group for group, rows in groups])
+    layout = facet_layout(facet_col, [group for group, rows in groups], x, 'count', facet_col, 'relative')
+    layout['bargap'] = 0
+    edges = histogram_bin_edges(df[x]) if groups else None
+    data = []
+    if edges is not None:
+        integers = bool((df[x].dropna() == df[x].dropna().round()).all())
+        labels = [bin_label(low, high, integers) for low, high in zip(edges[:-1], edges[1:])]
+        for i, (group, rows) in enumerate(groups):
+            counts, _ = np.histogram(rows[x].dropna().values, bins=edges)
+            data.append(binned_trace(facet_col, group, x, counts, edges, labels, colors[group], axis_name(i)))
+    return {'data': data, 'layout': layout}
+
+def stacked_bar_figure(df, x, y, color, row_col, categoryorder=None, row_height=300, spacing=0.04):
+    ''' One figure with a bar chart per value of row_col stacked in rows, sharing one legend
+    and one color per value of color.  Replaces a separate figure per row_col value.'''
+    rows_list = groups_in_order(df, row_col)
+    colors = color_map(list(df[color].unique())) if not df.empty else {}
+    n = max(len(rows_list), 1)
+    height = (1. - spacing * (n - 1)) / n
+    layout = {
+        'template': figure_template,
+        'legend': {'title': {'text': color}, 'tracegroupgap': 0},
+        'barmode': 'group',
+        'height': row_height * n,
+        'margin': {'t': 60},
+        'annotations': [],
+    }
+    data = []
+    shown = set()
+    for i, (row_value, row_df) in enumerate(rows_list):
+        suffix = axis_name(i)
+        bottom = (n - 1 - i) * (height + spacing)
+        top = min(bottom + height, 1.)
+        layout['xaxis' + suffix] = {'anchor': 'y' + suffix, 'domain': [0.0, 1.0]}
+        if categoryorder:
+            layout['xaxis' + suffix]['categoryorder'] = categoryorder
+        layout['yaxis' + suffix] = {'anchor': 'x' + suffix, 'domain': [bottom, top], 'title': {'text': y}}
+        layout['annotations'].append({'font': {}, 'showarrow': False, 'text': str(row_value),
+                                      'x': 0.5, 'xanchor': 'center', 'xref': 'paper',
+                                      'y': top, 'yanchor': 'bottom', 'yref': 'paper'})
+        for group, rows in groups_in_order(row_df, color):
+            trace = bar_trace(color, group, x, y, rows, colors[group], suffix)
+            trace['showlegend'] = group not in shown
+            shown.add(group)
+            data.append(trace)
+    if rows_list:
+        layout['xaxis' + axis_name(len(rows_list) - 1)]['title'] = {'text': x}
+    return {'data': data, 'layout': layout}
@@ -0,0 +1,443 @@
+# Libraries
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+import requests
+from pandas.api.types import is_categorical_dtype, union_categoricals
+
+from config_settings import *
+from data_processing import *
+from data_cache import *
+from instrumentation import *
+
+# ----------------------------------------------------------------------------
+# REPORT DEFINITIONS
+# ----------------------------------------------------------------------------
+
+# The stages of each report the pipeline can ingest.  Each MCC file of a report goes
+# through fetch -> flatten -> clean on its own, and the cleaned frames of the MCCs are
+# then combined into the report:
+#   read_stream        parse one MCC file from byte chunks
+#   read_file          parse the bundled local file into {mcc: parsed}
+#   flatten            ({mcc: parsed}, mcc_list) -> (flattened frame, row hashes)
+#   clean              flattened frame -> cleaned frame
+#   clean_incremental  re-clean only changed rows, as incremental_clean_blooddata
+#   required_columns   columns clean needs, added empty to an MCC file without them
+#   stage_version      bumped when flatten or clean change, so cached frames are rebuilt
+report_definitions = {
+    'blood': {
+        'local_datafile': 'blood_dict.json',
+        'read_stream': read_blood_stream,
+        'read_file': read_blood_file,
+        'flatten': blood_visits_to_df,
+        'clean': clean_blooddata,
+        'clean_incremental': incremental_clean_blooddata,
+        'required_columns': list(BLOOD_SCHEMA['datetime']) + list(BLOOD_SCHEMA['numeric']),
+        'stage_version': 1,
+    },
+}
+
+def report_file_url(file_url_root, report, mcc):
+    return '/'.join([file_url_root, report, '{}-{}-latest.json'.format(report, mcc)])
+
+# ----------------------------------------------------------------------------
+# SHARED STAGE CACHE
+# ----------------------------------------------------------------------------
+
+# Every process using PIPELINE_CACHE_DIR (the workers of this app and other dashboards on
+# the same host) shares one entry per (report, mcc): the validators and content hash of
+# the last download, the raw payload, the cleaned frame and its row hashes.  A lock file
+# per entry lets only one process fetch and clean a file at a time; the others then send
+# the new entry's validators, get a 304 and read the cleaned frame memory mapped.
+
+# Row hashes use Python's hash, so they are only reused by processes with the same hash
+# seed, i.e. the workers forked from one gunicorn master
+ROW_HASH_SEED = hash('a2cps row hashes')
+
+def stage_cache_path(report, mcc, suffix, cache_dir=PIPELINE_CACHE_DIR):
+    return os.path.join(cache_dir, '{}-{}{}'.format(report, mcc, suffix))
+
+def stage_lock(report, mcc, cache_dir=PIPELINE_CACHE_DIR):
+    ''' Lock of one (report, mcc) cache entry'''
+    return file_lock(stage_cache_path(report, mcc, '.lock', cache_dir))
+
+def write_cache_file(path, write_fn):
+    ''' Write through a temporary file moved into place, so other processes never read a
+    partly written file'''
+    tmp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def read_cache_entry(report, mcc, cache_dir=PIPELINE_CACHE_DIR):
+    entry_path = stage_cache_path(report, mcc, '.entry.json', cache_dir)
+    if not os.path.exists(entry_path):
+        return None
+    try:
+        with open(entry_path) as entry_file:
+            return json.load(entry_file)
+    except ValueError as e:
+        print('Unreadable pipeline cache entry:', e)
+        return None
+
+def write_cache_entry(report, mcc, entry, old_entry=None, cache_dir=PIPELINE_CACHE_DIR):
+    ''' Replace the entry of (report, mcc) and remove the files only the old entry used'''
+    def write_fn(tmp_path):
+        with open(tmp_path, 'w') as entry_file:
+            json.dump(entry, entry_file, indent=2)
+    write_cache_file(stage_cache_path(report, mcc, '.entry.json', cache_dir), write_fn)
+    for key in ['payload_file', 'frame_file', 'hashes_file']:
+        old_file = (old_entry or {}).get(key)
+        if old_file and old_file not in entry.values():
+            try:
+                os.remove(os.path.join(cache_dir, old_file))
+            except OSError:
+                pass
+
+def entry_file(entry, key, cache_dir=PIPELINE_CACHE_DIR):
+    ''' Path of one of the entry's files, None if it has none or it was removed'''
+    if not entry or not entry.get(key):
+        return None
+    path = os.path.join(cache_dir, entry[key])
+    return path if os.path.exists(path) else None
+
+# pyarrow sets up its pandas support on first use, which isn't safe from several threads
+_feather_lock = threading.Lock()
+
+def read_cached_frame(path):
+    table = feather.read_table(path, memory_map=True)
+    with _feather_lock:
+        return table.to_pandas()
+
+def write_cached_frame(df, path):
+    def write_fn(tmp_path):
+        with _feather_lock:
+            feather.write_feather(df.reset_index(drop=True), tmp_path)
+    write_cache_file(path, write_fn)
+
+def read_cached_hashes(entry, cache_dir=PIPELINE_CACHE_DIR):
+    ''' Row hashes of the entry if they were made with this process's hash seed'''
+    path = entry_file(entry, 'hashes_file', cache_dir)
+    if path is None or entry.get('hash_seed') != ROW_HASH_SEED:
+        return None
+    hashes_df = read_cached_frame(path)
+    return pd.Series(hashes_df['hash'].values, index=pd.Index(hashes_df['key'], dtype=object), dtype='int64')
+
+def write_cached_hashes(row_hashes, path):
+    hashes_df = pd.DataFrame({'key': row_hashes.index.astype(str), 'hash': row_hashes.values})
+    write_cached_frame(hashes_df, path)
+
+# ----------------------------------------------------------------------------
+# FETCH
+# ----------------------------------------------------------------------------
+
+def fetch_payload(session, url, entry, read_stream, payload_path, timeout=(5, 30), cache_dir=PIPELINE_CACHE_DIR):
+    ''' GET one MCC file using If-None-Match / If-Modified-Since against the cache entry.
+    The body is streamed through read_stream and into payload_path at once.  Returns
+    {'status': 'unchanged'} for a 304, {'status': 'fetched', 'parsed', 'payload_hash',
+    'etag', 'last_modified'} for a new download, or None if the file could not be
+    retrieved.'''
+    headers = {}
+    # Only revalidate against a payload that is still on disk to rebuild from
+    if entry_file(entry, 'payload_file', cache_dir):
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        r = session.get(url, headers=headers, timeout=timeout, stream=True)
+    except requests.exceptions.RequestException as e:
+        inc('a2cps_ingest_fetch_responses_total', status='error')
+        print(url)
+        print(e)
+        return None
+    with r:
+        inc('a2cps_ingest_fetch_responses_total', status=r.status_code)
+        if r.status_code == 304 and headers:
+            return {'status': 'unchanged'}
+        if r.status_code != 200:
+            print(url)
+            print(r.status_code)
+            return None
+        digest = hashlib.sha1()
+        def tee_chunks(payload_file):
+            for chunk in r.iter_content(JSON_CHUNK_SIZE):
+                digest.update(chunk)
+                payload_file.write(chunk)
+                yield chunk
+        try:
+            def write_fn(tmp_path):
+                with open(tmp_path, 'wb') as payload_file:
+                    chunks = tee_chunks(payload_file)
+                    fetched['parsed'] = read_stream(chunks)
+                    # Keep anything after the parsed value, so the hash covers the whole file
+                    for chunk in chunks:
+                        pass
+            fetched = {'status': 'fetched'}
+            write_cache_file(payload_path, write_fn)
+        except (ValueError, OSError, requests.exceptions.RequestException) as e:
+            print(url)
+            print(e)
+            return None
+        set_value('a2cps_ingest_payload_bytes', r.raw.tell(), file=url.rsplit('/', 1)[-1])
+        fetched.update({'payload_hash': digest.hexdigest()[:16],
+                        'etag': r.headers.get('ETag'),
+                        'last_modified': r.headers.get('Last-Modified')})
+        return fetched
+
+# ----------------------------------------------------------------------------
+# STAGES
+# ----------------------------------------------------------------------------
+
+def flatten_and_clean(report, mcc, parsed, known=None):
+    ''' flatten -> clean of one MCC file.  With the row hashes of what this process last
+    cleaned of it (known), only new and changed rows are cleaned.  Returns (cleaned frame
+    or None when the file has no rows, row hashes, flat columns, sites whose rows changed
+    or None for all of them)'''
+    definition = report_definitions[report]
+    with timed('a2cps_ingest_stage_seconds', stage='flatten', report=report):
+        flat_df, row_hashes = definition['flatten']({str(mcc): parsed}, [mcc])
+    if flat_df.empty:
+        return None, row_hashes, [], None
+    for col in definition['required_columns']:
+        if col not in flat_df.columns:
+            flat_df[col] = np.nan
+    flat_columns = list(flat_df.columns)
+
+    result = None
+    if known and known.get('row_hashes') is not None and definition.get('clean_incremental'):
+        with timed('a2cps_ingest_stage_seconds', stage='incremental_clean', report=report):
+            result = definition['clean_incremental'](flat_df, row_hashes, known['frame'](), known['row_hashes'], known['flat_columns'])
+    if result is not None:
+        return result[0], row_hashes, flat_columns, result[1]
+    with timed('a2cps_ingest_stage_seconds', stage='clean', report=report):
+        return definition['clean'](flat_df), row_hashes, flat_columns, None
+
+def run_stage(report, mcc, session, file_url_root, timeout=(5, 30), known=None, cache_dir=PIPELINE_CACHE_DIR):
+    ''' fetch -> flatten -> clean of one MCC file of report, through the shared cache.
+    known is what this process kept of the file's last result (see _stage_state), with
+    'frame' a function returning its cleaned rows.  Returns a stage result, or None if the
+    file could not be fetched and isn't cached.'''
+    definition = report_definitions[report]
+    version = definition['stage_version']
+    url = report_file_url(file_url_root, report, mcc)
+    with stage_lock(report, mcc, cache_dir):
+        entry = read_cache_entry(report, mcc, cache_dir)
+        tmp_payload = stage_cache_path(report, mcc, '.download.json', cache_dir)
+        with timed('a2cps_ingest_fetch_seconds', mcc=mcc, report=report):
+            fetched = fetch_payload(session, url, entry, definition['read_stream'], tmp_payload, timeout, cache_dir)
+
+        # A failed download falls back to the last good one in the cache
+        if fetched is None and entry is None:
+            return None
+        status = fetched['status'] if fetched else 'cached'
+        payload_hash = fetched['payload_hash'] if status == 'fetched' else entry['payload_hash']
+        result = {'report': report, 'mcc': mcc, 'status': status, 'payload_hash': payload_hash}
+        new_entry = dict(entry or {})
+        if status == 'fetched':
+            payload_file = '{}-{}-{}.json'.format(report, mcc, payload_hash)
+            os.replace(tmp_payload, os.path.join(cache_dir, payload_file))
+            new_entry.update({'url': url, 'payload_hash': payload_hash, 'payload_file': payload_file,
+                              'etag': fetched['etag'], 'last_modified': fetched['last_modified']})
+
+        if known is not None and known['payload_hash'] == payload_hash:
+            # The same file this process cleaned last time
+            inc('a2cps_cache_events_total', cache='pipeline_frames', event='hits')
+            result.update({'df': known['frame'](), 'row_hashes': known['row_hashes'],
+                           'flat_columns': known['flat_columns'], 'dirty_sites': set()})
+        elif entry and entry['payload_hash'] == payload_hash and entry.get('stage_version') == version \
+                and (entry.get('rows') == 0 or entry_file(entry, 'frame_file', cache_dir)):
+            # Cleaned by another worker or process
+            inc('a2cps_cache_events_total', cache='pipeline_frames', event='hits')
+            frame_path = entry_file(entry, 'frame_file', cache_dir)
+            result.update({'df': read_cached_frame(frame_path) if frame_path else None,
+                           'row_hashes': read_cached_hashes(entry, cache_dir),
+                           'flat_columns': entry.get('flat_columns', []), 'dirty_sites': None})
+        else:
+            inc('a2cps_cache_events_total', cache='pipeline_frames', event='misses')
+            if status == 'fetched':
+                parsed = fetched['parsed']
+            else:
+                payload_path = entry_file(entry, 'payload_file', cache_dir)
+                if payload_path is None:
+                    return None
+                with timed('a2cps_ingest_stage_seconds', stage='read', report=report):
+                    parsed = definition['read_stream'](iter_file_chunks(payload_path))
+            df, row_hashes, flat_columns, dirty_sites = flatten_and_clean(report, mcc, parsed, known)
+            result.update({'df': df, 'row_hashes': row_hashes, 'flat_columns': flat_columns, 'dirty_sites': dirty_sites})
+
+            file_stem = '{}-{}-{}-v{}'.format(report, mcc, payload_hash, version)
+            new_entry.update({'stage_version': version, 'flat_columns': flat_columns,
+                              'rows': 0 if df is None else len(df), 'frame_file': None,
+                              'hashes_file': file_stem + '-hashes.feather', 'hash_seed': ROW_HASH_SEED})
+            try:
+                if df is not None:
+                    new_entry['frame_file'] = file_stem + '.feather'
+                    write_cached_frame(df, os.path.join(cache_dir, new_entry['frame_file']))
+                write_cached_hashes(row_hashes, os.path.join(cache_dir, new_entry['hashes_file']))
+            except Exception as e:
+                print('Could not cache', report, mcc, e)
+                return result
+
+        if new_entry != entry:
+            write_cache_entry(report, mcc, new_entry, entry, cache_dir)
+    return result
+
+def run_local_stages(report, mcc_list, assets_path, executor):
+    ''' Stage results of every MCC in the report's bundled local file'''
+    definition = report_definitions[report]
+    with timed('a2cps_ingest_stage_seconds', stage='read', report=report):
+        mcc_data = definition['read_file'](assets_path, definition['local_datafile'], mcc_list)
+    def local_stage(mcc):
+        df, row_hashes, flat_columns, dirty_sites = flatten_and_clean(report, mcc, mcc_data[str(mcc)])
+        return {'report': report, 'mcc': mcc, 'status': 'local', 'payload_hash': None, 'df': df,
+                'row_hashes': row_hashes, 'flat_columns': flat_columns, 'dirty_sites': None}
+    futures = {mcc: executor.submit(local_stage, mcc) for mcc in mcc_list if str(mcc) in mcc_data}
+    return {mcc: future.result() for mcc, future in futures.items()}
+
+# ----------------------------------------------------------------------------
+# COMBINE
+# ----------------------------------------------------------------------------
+
+def mcc_rows(report_df, mcc):
+    ''' Rows of one MCC in a combined report frame'''
+    return report_df[(report_df['MCC'].astype(str) == str(mcc)).values].reset_index(drop=True)
+
+def combine_frames(frames):
+    ''' Concatenate the cleaned frames of a report's MCCs.  Categories are combined and
+    sorted, as cleaning the whole report in one frame makes them.'''
+    columns = list(dict.fromkeys(col for df in frames for col in df.columns))
+    category_cols = [col for col in columns if any(col in df.columns and is_categorical_dtype(df[col]) for df in frames)]
+    categories = {}
+    for col in category_cols:
+        parts = [pd.Categorical(df[col]) if col in df.columns else pd.Categorical([np.nan] * len(df)) for df in frames]
+        try:
+            combined = union_categoricals(parts, sort_categories=True)
+        except TypeError:
+            combined = pd.Categorical(pd.concat([pd.Series(part).astype(object) for part in parts]))
+        categories[col] = combined.remove_unused_categories()
+    report_df = pd.concat([df.drop(columns=[col for col in category_cols if col in df.columns]) for df in frames],
+                          ignore_index=True)
+    for col in category_cols:
+        report_df[col] = categories[col]
+    return report_df[columns]
+
+# What each process kept of the last result of every (report, mcc): payload hash, row
+# hashes, flat and cleaned columns and the version of the report frame holding its rows.  The
+# cleaned rows themselves are only held once, in that report frame.
+_stage_state = {}
+
+def known_stage(report, mcc, previous):
+    ''' This process's last result of (report, mcc) if previous is the report frame it went
+    into'''
+    state = _stage_state.get((report, mcc))
+    if state is None or previous is None or state['version'] != previous['version']:
+        return None
+    return dict(state, frame=lambda: mcc_rows(previous['report_df'], mcc)[state['columns']])
+
+def combine_report(report, mcc_list, stages, previous=None):
+    ''' Combine the stage results of a report's MCCs, in mcc_list order, into
+    {'report_df', 'source', 'dirty_sites'}.  dirty_sites are the sites whose rows changed
+    since previous, None when previous isn't known.  Returns previous's report_df itself
+    when nothing changed.'''
+    stages = [stages[mcc] for mcc in mcc_list if stages.get(mcc) is not None]
+    source = 'local files' if all(stage['status'] == 'local' for stage in stages) else 'TACC files'
+    previous_mccs = [mcc for mcc in mcc_list if known_stage(report, mcc, previous)]
+    if previous is not None and [stage['mcc'] for stage in stages] == previous_mccs and \
+            all(stage['dirty_sites'] == set() for stage in stages):
+        return {'report_df': previous['report_df'], 'source': source, 'dirty_sites': set(), 'stages': stages}
+
+    frames = [stage['df'] for stage in stages if stage['df'] is not None]
+    if not frames:
+        return None
+    with timed('a2cps_ingest_stage_seconds', stage='combine', report=report):
+        report_df = combine_frames(frames)
+
+    dirty_sites = None
+    if previous is not None:
+        # Sites of MCCs cleaned from scratch, added or dropped are all taken as changed
+        dirty_sites = set()
+        old_df = previous['report_df']
+        old_mcc = old_df['MCC'].astype(str)
+        new_stages = {str(stage['mcc']): stage for stage in stages}
+        for mcc in set(new_stages) | set(old_mcc.unique()):
+            stage = new_stages.get(mcc)
+            if stage is not None and stage['dirty_sites'] is not None and stage['mcc'] in previous_mccs:
+                dirty_sites |= stage['dirty_sites']
+                continue
+            dirty_sites |= set(old_df['Site'][(old_mcc == mcc).values].dropna())
+            if stage is not None and stage['df'] is not None:
+                dirty_sites |= set(stage['df']['Site'].dropna())
+    return {'report_df': report_df, 'source': source, 'dirty_sites': dirty_sites, 'stages': stages}
+
+def remember_stages(report, result, version):
+    ''' Keep what the next run needs of the stages combined into the report frame with
+    this version'''
+    for key in [key for key in _stage_state if key[0] == report]:
+        del _stage_state[key]
+    for stage in result.get('stages', []):
+        if stage['status'] != 'local' and stage['df'] is not None:
+            _stage_state[(report, stage['mcc'])] = {
+                'payload_hash': stage['payload_hash'], 'row_hashes': stage['row_hashes'],
+                'flat_columns': stage['flat_columns'], 'columns': list(stage['df'].columns), 'version': version}
+
+# ----------------------------------------------------------------------------
+# PIPELINE
+# ----------------------------------------------------------------------------
+
+# Stages of every report and MCC run at once on a thread pool per worker, made after the
+# fork by gunicorn
+_pipeline_pool = {'pid': None, 'executor': None}
+_pipeline_lock = threading.Lock()
+
+def _get_executor():
+    with _pipeline_lock:
+        if _pipeline_pool['pid'] != os.getpid():
+            _pipeline_pool['executor'] = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix='pipeline')
+            _pipeline_pool['pid'] = os.getpid()
+        return _pipeline_pool['executor']
+
+def run_pipeline(reports, mcc_list, file_url_root, assets_path, local_fallback=True, previous=None,
+                 timeout=(5, 30), retries=3, backoff_factor=0.5, cache_dir=PIPELINE_CACHE_DIR):
+    ''' Run fetch -> flatten -> clean for every MCC file of every report in parallel, and
+    combine each report's MCCs (see combine_report).  previous is {report: {'version',
+    'report_df'}} of the reports this process holds.  A report whose files can't be
+    fetched or found in the cache is read from its bundled local file when local_fallback
+    is set, otherwise it is None, so a refresh never replaces newer data with the old file.
+    Returns {report: combined result or None}.'''
+    previous = previous or {}
+    for report in reports:
+        if report not in report_definitions:
+            raise ValueError('Unknown report: ' + str(report))
+    executor = _get_executor()
+    session = get_session(retries, backoff_factor, pool_size=max(len(reports) * len(mcc_list), 1))
+    futures = {(report, mcc): executor.submit(run_stage, report, mcc, session, file_url_root, timeout,
+                                              known_stage(report, mcc, previous.get(report)), cache_dir)
+               for report in reports for mcc in mcc_list}
+
+    results = {}
+    for report in reports:
+        stages = {}
+        for mcc in mcc_list:
+            try:
+                stages[mcc] = futures[(report, mcc)].result()
+            except Exception as e:
+                print('Pipeline stage failed:', report, mcc, e)
+                stages[mcc] = None
+        if not any(stages.values()):
+            if not local_fallback:
+                results[report] = None
+                continue
+            stages = run_local_stages(report, mcc_list, assets_path, executor)
+        results[report] = combine_report(report, mcc_list, stages, previous.get(report))
+    return results
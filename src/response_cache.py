@@ -0,0 +1,91 @@
+# Libraries
+import gzip
+import json
+import flask
+import plotly
+
+# orjson and brotli are optional: without them responses are encoded with the standard
+# json module and compressed with gzip only
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# ----------------------------------------------------------------------------
+# JSON ENCODING
+# ----------------------------------------------------------------------------
+
+_plotly_encoder = plotly.utils.PlotlyJSONEncoder()
+
+def _encode_default(obj):
+    ''' Dash components and anything else orjson can't serialize, as PlotlyJSONEncoder does'''
+    if hasattr(obj, 'to_plotly_json'):
+        return obj.to_plotly_json()
+    return _plotly_encoder.default(obj)
+
+def encode_json(obj):
+    ''' Serialize a Dash response (components, figures, numpy / pandas values) to bytes'''
+    if orjson is not None:
+        return orjson.dumps(obj, default=_encode_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, cls=plotly.utils.PlotlyJSONEncoder).encode('utf-8')
+
+# ----------------------------------------------------------------------------
+# COMPRESSION
+# ----------------------------------------------------------------------------
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+def _compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, GZIP_LEVEL)
+    return body
+
+def accepted_encoding(accept_encoding):
+    ''' Best encoding we can serve for an Accept-Encoding header: br, gzip or identity'''
+    accepted = set()
+    for part in accept_encoding.split(','):
+        fields = part.strip().split(';')
+        name = fields[0].strip().lower()
+        quality = 1.
+        for field in fields[1:]:
+            key, _, value = field.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.
+        if name and quality > 0:
+            accepted.add(name)
+    if brotli is not None and ('br' in accepted or '*' in accepted):
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return 'identity'
+
+# ----------------------------------------------------------------------------
+# RESPONSES
+# ----------------------------------------------------------------------------
+
+def make_response_entry(obj):
+    ''' Cache entry for a response: its JSON bytes, plus each compressed variant once it
+    has been asked for'''
+    return {'identity': encode_json(obj)}
+
+def encoded_response(entry, accept_encoding):
+    ''' Flask response with the entry's bytes in the best encoding the client accepts'''
+    encoding = accepted_encoding(accept_encoding or '')
+    if encoding not in entry:
+        entry[encoding] = _compress(entry['identity'], encoding)
+    response = flask.Response(entry[encoding], mimetype='application/json')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
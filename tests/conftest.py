@@ -0,0 +1,5 @@
+# The app's modules are flat files in src/, imported the way app.py imports them
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
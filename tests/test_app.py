@@ -0,0 +1,97 @@
+''' Dash callback requests through the Flask test client, with the app reading its bundled
+local data file'''
+import os
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+# Settings are read when the app is imported: keep its files out of the repository and
+# point the report downloads at a closed local port so it falls back to the local file
+_app_dir = tempfile.mkdtemp(prefix='test-app-')
+for _name in ['SNAPSHOT_DIR', 'HISTORY_DIR', 'PIPELINE_CACHE_DIR', 'EXPORT_DIR', 'METRICS_DIR']:
+    os.environ[_name] = os.path.join(_app_dir, _name.lower())
+os.environ['DATA_REFRESH_INTERVAL'] = '0'
+os.environ['FETCH_RETRIES'] = '0'
+os.environ['FILE_URL_ROOT'] = 'http://127.0.0.1:9/reports'
+
+import app as dash_app
+
+callback_path = '/_dash-update-component'
+
+@pytest.fixture
+def client():
+    return dash_app.app.server.test_client()
+
+@pytest.fixture
+def snapshot():
+    return dash_app.get_current_snapshot()
+
+def tab_body(snapshot, site, tab):
+    return {'output': 'tab_content.children', 'outputs': {'id': 'tab_content', 'property': 'children'},
+            'inputs': [{'id': 'dropdown-site', 'property': 'value', 'value': site},
+                       {'id': 'tabs_tables', 'property': 'value', 'value': tab},
+                       {'id': 'store-latest', 'property': 'data', 'value': {'version': snapshot['version']}}],
+            'changedPropIds': ['dropdown-site.value']}
+
+def cached_sites(snapshot):
+    keys = list(dash_app.response_cache._data) + list(dash_app.site_context_cache._data)
+    return {key[1] for key in keys if key[0] == snapshot['version']}
+
+@pytest.mark.parametrize('site', [None, 'Made-up Site'])
+def test_unknown_site_is_served_as_all(client, snapshot, site):
+    r = client.post(callback_path, json=tab_body(snapshot, site, 'missing'))
+    assert r.status_code == 200
+    expected = client.post(callback_path, json=tab_body(snapshot, 'all', 'missing'))
+    assert r.get_data() == expected.get_data()
+    assert site not in cached_sites(snapshot)
+
+def callback_outputs():
+    samples = dash_app.collect()
+    return {dict(key).get('output') for key in samples.get('a2cps_dash_callback_seconds', {})}
+
+def test_unregistered_outputs_are_labelled_other(client, snapshot):
+    client.post(callback_path, json={'output': 'made-up.children', 'inputs': []})
+    client.post(callback_path, json=tab_body(snapshot, 'all', 'missing'))
+    outputs = callback_outputs()
+    assert 'made-up.children' not in outputs
+    assert 'other' in outputs
+    assert 'tab_content.children' in outputs
+
+def find_export_links(node):
+    if isinstance(node, dict):
+        props = node.get('props')
+        if isinstance(props, dict) and isinstance(props.get('id'), dict) and props['id'].get('type') == 'export-link':
+            yield props
+        for value in node.values():
+            yield from find_export_links(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from find_export_links(value)
+
+def test_export_links_follow_the_page(client, snapshot):
+    # The hrefs are set in the browser from the page's site and snapshot, not fixed when
+    # the tab is rendered (and cached)
+    dependencies = client.get('/_dash-dependencies').get_json()
+    export_hrefs = [dep for dep in dependencies if 'export-link' in dep['output']]
+    assert len(export_hrefs) == 1
+    assert export_hrefs[0]['clientside_function']['function_name'] == 'export_hrefs'
+    assert {dep['id'] for dep in export_hrefs[0]['inputs']} >= {'dropdown-site', 'store-latest'}
+
+    r = client.post(callback_path, json=tab_body(snapshot, 'all', 'hemolysis'))
+    links = list(find_export_links(r.get_json()))
+    assert {link['id']['index'] for link in links} == {'/export/hemolysis.csv', '/export/hemolysis.xlsx'}
+    site = snapshot['sites'][0]
+    for link in links:
+        download = client.get(link['id']['index'], query_string={'site': site, 'version': snapshot['version']})
+        assert download.status_code in (200, 202)
+
+def test_unknown_report_stops_the_start(tmp_path):
+    env = dict(os.environ, REPORT='made-up')
+    for name in ['SNAPSHOT_DIR', 'HISTORY_DIR', 'PIPELINE_CACHE_DIR', 'EXPORT_DIR', 'METRICS_DIR']:
+        env[name] = str(tmp_path / name.lower())
+    started = subprocess.run([sys.executable, '-c', 'import app'], cwd=os.path.dirname(dash_app.__file__), env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=120)
+    assert started.returncode != 0
+    assert b"ValueError: Unknown report 'made-up': set REPORT to one of blood" in started.stdout
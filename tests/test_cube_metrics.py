@@ -0,0 +1,40 @@
+''' Site metrics looked up in the aggregate cube against computing them from the rows'''
+import pandas as pd
+import pytest
+
+from data_processing import (read_blood_file, blood_visits_to_df, clean_blooddata, missing_blood_draws,
+                             metric_flags, build_aggregate_cube, cube_site_metrics, site_metrics, timing_metrics)
+from config_settings import ASSETS_PATH
+
+def site_visit_metrics(blood_drawn_df, metrics, by=['Site','Visit']):
+    ''' Reference: every metric in metrics for each Site x Visit group of the rows, in one
+    grouped pass'''
+    flags = {}
+    for metric in metrics:
+        counted, failed = metric_flags(blood_drawn_df, metric)
+        flags[(metric['metric'], 'Count')] = counted
+        flags[(metric['metric'], 'Fail')] = failed & counted
+    flags = pd.DataFrame(flags, index=blood_drawn_df.index)
+    grouped = flags.groupby([blood_drawn_df[c] for c in by], observed=True).sum().sort_index()
+
+    metrics_df = []
+    for metric in metrics:
+        df = grouped[metric['metric']]
+        df = df[df['Count'] > 0].reset_index()
+        df.insert(len(by), 'Metric', metric['metric'])
+        df['Percent'] = 100 * (df['Count'] - df['Fail']) / df['Count']
+        metrics_df.append(df)
+    return pd.concat(metrics_df, ignore_index=True)
+
+@pytest.fixture(scope='module')
+def report_df():
+    mcc_visits = read_blood_file(ASSETS_PATH, 'blood_dict.json', [1, 2])
+    return clean_blooddata(blood_visits_to_df(mcc_visits, [1, 2])[0])
+
+def test_cube_metrics_match_rows(report_df):
+    metrics = site_metrics + timing_metrics
+    cube = build_aggregate_cube(report_df)
+    for site in ['all'] + sorted(report_df['Site'].unique()):
+        site_df = report_df if site == 'all' else report_df[report_df['Site'] == site]
+        expected = site_visit_metrics(missing_blood_draws(site_df)[0], metrics)
+        pd.testing.assert_frame_equal(cube_site_metrics(cube, metrics, site).astype(str), expected.astype(str))
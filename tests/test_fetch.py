@@ -0,0 +1,111 @@
+''' fetch_payload against a local stand-in for the report files endpoint'''
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from data_processing import get_session
+from report_pipeline import fetch_payload, run_pipeline
+
+PAYLOAD = [{'screening_site': 'Site A', 'record_id': '1'}]
+ETAG = '"v1"'
+
+class StandInHandler(BaseHTTPRequestHandler):
+    ''' /ok serves PAYLOAD with an ETag and answers a matching If-None-Match with a 304,
+    /unavailable always answers 503 and /slow answers after the read timeout'''
+    def do_GET(self):
+        self.server.hits[self.path] = self.server.hits.get(self.path, 0) + 1
+        if self.path == '/ok':
+            if self.headers.get('If-None-Match') == ETAG:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = json.dumps(PAYLOAD).encode('utf-8')
+            self.send_response(200)
+            self.send_header('ETag', ETAG)
+            self.send_header('Last-Modified', 'Mon, 04 Oct 2021 00:00:00 GMT')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/slow':
+            time.sleep(1)
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'[]')
+        else:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def stand_in():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.hits = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def url(server, path):
+    return 'http://127.0.0.1:{}{}'.format(server.server_address[1], path)
+
+def read_json(chunks):
+    return json.loads(b''.join(chunks))
+
+def test_fetch_then_unchanged(stand_in, tmp_path):
+    session = get_session(retries=0, backoff_factor=0)
+    payload_path = str(tmp_path / 'payload.json')
+    fetched = fetch_payload(session, url(stand_in, '/ok'), None, read_json, payload_path, cache_dir=str(tmp_path))
+    assert fetched['status'] == 'fetched'
+    assert fetched['parsed'] == PAYLOAD
+    assert fetched['etag'] == ETAG
+    with open(payload_path) as payload_file:
+        assert json.load(payload_file) == PAYLOAD
+
+    entry = {'payload_file': 'payload.json', 'etag': fetched['etag'], 'last_modified': fetched['last_modified']}
+    again = fetch_payload(session, url(stand_in, '/ok'), entry, read_json, str(tmp_path / 'again.json'),
+                          cache_dir=str(tmp_path))
+    assert again == {'status': 'unchanged'}
+    assert not os.path.exists(str(tmp_path / 'again.json'))
+
+def test_no_revalidation_without_cached_payload(stand_in, tmp_path):
+    # The entry's payload is gone, so there is nothing to rebuild from a 304
+    session = get_session(retries=0, backoff_factor=0)
+    entry = {'payload_file': 'missing.json', 'etag': ETAG}
+    fetched = fetch_payload(session, url(stand_in, '/ok'), entry, read_json, str(tmp_path / 'payload.json'),
+                            cache_dir=str(tmp_path))
+    assert fetched['status'] == 'fetched'
+
+def test_error_status_is_retried(stand_in, tmp_path):
+    session = get_session(retries=2, backoff_factor=0)
+    fetched = fetch_payload(session, url(stand_in, '/unavailable'), None, read_json, str(tmp_path / 'payload.json'),
+                            cache_dir=str(tmp_path))
+    assert fetched is None
+    assert stand_in.hits['/unavailable'] == 3
+
+def test_timeout_is_retried(stand_in, tmp_path):
+    session = get_session(retries=1, backoff_factor=0)
+    fetched = fetch_payload(session, url(stand_in, '/slow'), None, read_json, str(tmp_path / 'payload.json'),
+                            timeout=(1, 0.2), cache_dir=str(tmp_path))
+    assert fetched is None
+    assert stand_in.hits['/slow'] == 2
+
+def test_connection_error(tmp_path):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    closed_url = 'http://127.0.0.1:{}/ok'.format(server.server_address[1])
+    server.server_close()
+    session = get_session(retries=0, backoff_factor=0)
+    assert fetch_payload(session, closed_url, None, read_json, str(tmp_path / 'payload.json'),
+                         cache_dir=str(tmp_path)) is None
+
+def test_unknown_report_is_an_error(tmp_path):
+    # Reports without a definition are not skipped: the caller would get no result for them
+    with pytest.raises(ValueError, match='made-up'):
+        run_pipeline(['blood', 'made-up'], [1], 'http://127.0.0.1:9/reports', str(tmp_path), cache_dir=str(tmp_path))
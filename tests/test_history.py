@@ -0,0 +1,72 @@
+''' History points: one per report date, added also when the data didn't change'''
+from datetime import datetime
+
+import pytest
+
+from data_processing import read_blood_file, blood_visits_to_df, clean_blooddata
+from data_snapshots import make_snapshot
+from aggregate_history import (append_history, history_files, read_history_files, weekly_history,
+                               history_until, point_ids, write_history_file)
+from config_settings import ASSETS_PATH
+
+@pytest.fixture(scope='module')
+def report_df():
+    mcc_visits = read_blood_file(ASSETS_PATH, 'blood_dict.json', [1, 2])
+    return clean_blooddata(blood_visits_to_df(mcc_visits, [1, 2])[0])
+
+def changed(report_df):
+    changed_df = report_df.copy()
+    changed_df.loc[0, 'bscp_aliq_cnt'] = 1
+    return changed_df
+
+def read(history_dir):
+    return read_history_files(history_files('blood', history_dir))
+
+def points(history):
+    return sorted(set(zip(history['report_date'].astype(str), history['version'].astype(str))))
+
+def test_unchanged_weeks_have_points(tmp_path, report_df):
+    history_dir = str(tmp_path)
+    snapshot = make_snapshot(report_df, 'TACC files', loaded_at=datetime(2021, 10, 4, 8))
+    assert append_history(snapshot, 'blood', history_dir)
+    # The data didn't change for the next two weekly loads
+    for day in [11, 18]:
+        assert append_history(snapshot, 'blood', history_dir, report_date='2021-10-{}'.format(day),
+                              loaded_at=datetime(2021, 10, day, 8))
+    assert not append_history(snapshot, 'blood', history_dir, report_date='2021-10-18',
+                              loaded_at=datetime(2021, 10, 18, 9))
+
+    history = read(history_dir)
+    version = snapshot['version']
+    assert points(history) == [('2021-10-04', version), ('2021-10-11', version), ('2021-10-18', version)]
+    until = history_until(history, version, snapshot['report_date'])
+    assert until == '2021-10-18'
+    assert sorted(weekly_history(history, until)['Week'].unique()) == ['2021-10-04', '2021-10-11', '2021-10-18']
+    assert weekly_history(history, '2021-10-11')['Week'].nunique() == 2
+
+def test_one_point_per_report_date(tmp_path, report_df):
+    history_dir = str(tmp_path)
+    first = make_snapshot(report_df, 'TACC files', loaded_at=datetime(2021, 10, 4, 8))
+    second = make_snapshot(changed(report_df), 'TACC files', loaded_at=datetime(2021, 10, 4, 9))
+    assert append_history(first, 'blood', history_dir)
+    assert append_history(second, 'blood', history_dir)
+    # The last load of the day is the day's point
+    assert points(read(history_dir)) == [('2021-10-04', second['version'])]
+
+    # Merged files keep only the last point of each report date
+    assert append_history(first, 'blood', history_dir, compact_after=1, report_date='2021-10-05',
+                          loaded_at=datetime(2021, 10, 5, 8))
+    assert len(history_files('blood', history_dir)) == 1
+    assert points(read(history_dir)) == [('2021-10-04', second['version']), ('2021-10-05', first['version'])]
+
+def test_points_are_read_once_during_a_merge(tmp_path, report_df):
+    history_dir = str(tmp_path)
+    snapshot = make_snapshot(report_df, 'TACC files', loaded_at=datetime(2021, 10, 4, 8))
+    append_history(snapshot, 'blood', history_dir)
+    # A reader can list the merged file next to the segment it was merged from
+    segment = history_files('blood', history_dir)[0]
+    write_history_file(read_history_files([segment]), segment.replace('segment-', 'history-'))
+    history = read(history_dir)
+    assert len(history_files('blood', history_dir)) == 2
+    assert len(history) == len(read_history_files([segment]))
+    assert point_ids(history).nunique() == 1
@@ -0,0 +1,113 @@
+''' Incremental cleaning of a changed MCC file must give exactly the frame a full rebuild
+gives, and name the sites whose rows changed'''
+import copy
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_processing import read_blood_stream, blood_visits_to_df, clean_blooddata
+from report_pipeline import flatten_and_clean, report_definitions
+
+MCC = 1
+VISITS = ['Baseline Visit', '6-Wks Post-Op', '3-Mo Post-Op']
+
+def make_visit(i):
+    return {
+        'bscp_aliq_cnt': str(8 - i % 3),
+        'bscp_time_blood_draw': '2021-03-{:02d} 08:{:02d}'.format(1 + i % 28, i % 60),
+        'bscp_time_centrifuge': '2021-03-{:02d} 08:{:02d}'.format(1 + i % 28, (i + 20) % 60),
+        'bscp_aliquot_freezer_time': '2021-03-{:02d} 09:{:02d}'.format(1 + i % 28, (i + 10) % 60),
+        'bscp_deg_of_hemolysis': ['0', '.25', '.5', '1'][i % 4],
+        'bscp_protocol_dev': '1' if i % 7 == 0 else '0',
+        'bscp_protocol_dev_reason': str(1 + i % 3),
+    }
+
+def make_records():
+    ''' 30 records at three sites, with one to three visits each'''
+    records = {}
+    for i in range(30):
+        record = {'screening_site': ['Rush', 'UChicago', 'NorthShore'][i % 3]}
+        for v, visit in enumerate(VISITS[:1 + i % 3]):
+            record[visit] = make_visit(i + 10 * v)
+        records[str(10000 + i)] = record
+    return records
+
+def parse(records):
+    return read_blood_stream([json.dumps(records).encode('utf-8')])
+
+def full_rebuild(records):
+    ''' clean_blooddata of the whole flattened file, as flatten_and_clean prepares it'''
+    flat_df, _ = blood_visits_to_df({str(MCC): parse(records)}, [MCC])
+    for col in report_definitions['blood']['required_columns']:
+        if col not in flat_df.columns:
+            flat_df[col] = np.nan
+    return clean_blooddata(flat_df)
+
+def incremental(old_records, new_records):
+    old_df, old_hashes, old_columns, _ = flatten_and_clean('blood', MCC, parse(old_records))
+    known = {'row_hashes': old_hashes, 'flat_columns': old_columns, 'frame': lambda: old_df}
+    df, _, _, dirty_sites = flatten_and_clean('blood', MCC, parse(new_records), known)
+    return df, dirty_sites
+
+def site(name):
+    return 'MCC{}: {}'.format(MCC, name)
+
+def edit_field(records):
+    records['10000']['Baseline Visit']['bscp_deg_of_hemolysis'] = '2'
+    return {site('Rush')}
+
+def remove_record(records):
+    del records['10001']
+    return {site('UChicago')}
+
+def change_site(records):
+    records['10003']['screening_site'] = 'UChicago'
+    return {site('Rush'), site('UChicago')}
+
+def add_visit(records):
+    records['10004']['3-Mo Post-Op'] = make_visit(99)
+    return {site('UChicago')}
+
+def add_site(records):
+    records['10100'] = {'screening_site': 'UMichigan', 'Baseline Visit': make_visit(5)}
+    return {site('UMichigan')}
+
+def no_change(records):
+    return set()
+
+@pytest.mark.parametrize('change', [edit_field, remove_record, change_site, add_visit, add_site, no_change])
+def test_incremental_matches_full_rebuild(change):
+    old_records = make_records()
+    new_records = copy.deepcopy(old_records)
+    expected_dirty = change(new_records)
+
+    df, dirty_sites = incremental(old_records, new_records)
+    expected = full_rebuild(new_records)
+    # check_categorical compares the categories and their order too
+    pd.testing.assert_frame_equal(df, expected, check_categorical=True)
+    for col in expected.columns:
+        if pd.api.types.is_categorical_dtype(expected[col]):
+            assert list(df[col].cat.categories) == list(expected[col].cat.categories)
+    assert dirty_sites == expected_dirty
+
+def test_several_changes_at_once():
+    old_records = make_records()
+    new_records = copy.deepcopy(old_records)
+    expected_dirty = set()
+    for change in [edit_field, remove_record, change_site, add_visit, add_site]:
+        expected_dirty |= change(new_records)
+
+    df, dirty_sites = incremental(old_records, new_records)
+    pd.testing.assert_frame_equal(df, full_rebuild(new_records), check_categorical=True)
+    assert dirty_sites == expected_dirty
+
+def test_new_columns_fall_back_to_full_clean():
+    old_records = make_records()
+    new_records = copy.deepcopy(old_records)
+    new_records['10000']['Baseline Visit']['bscp_comments'] = 'New field'
+
+    df, dirty_sites = incremental(old_records, new_records)
+    pd.testing.assert_frame_equal(df, full_rebuild(new_records), check_categorical=True)
+    assert dirty_sites is None
@@ -0,0 +1,123 @@
+''' Saving snapshots from several workers at once, and the workers that load them'''
+import os
+import threading
+from datetime import datetime
+
+import pandas as pd
+
+import data_snapshots
+from data_snapshots import save_snapshot, read_manifest, get_snapshot, make_snapshot, load_newer_snapshot
+from data_cache import try_lock_file
+from data_processing import read_blood_file, blood_visits_to_df, clean_blooddata
+from config_settings import ASSETS_PATH
+
+def make_saved_snapshot(i):
+    report_df = pd.DataFrame({'MCC': [1, 1, 2], 'Site': ['A', 'B', 'C'], 'value': [i, i + 1, i + 2]})
+    return {'version': 'v{:03d}'.format(i), 'report_df': report_df, 'source': 'TACC files',
+            'loaded_at': datetime(2021, 10, 4, 0, 0, i % 60), 'report_date': '2021-10-04'}
+
+def test_concurrent_saves_keep_every_entry(tmp_path):
+    snapshot_dir = str(tmp_path)
+    n = 24
+    threads = [threading.Thread(target=save_snapshot, args=(make_saved_snapshot(i), snapshot_dir, 'blood', n))
+               for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    manifest = read_manifest(snapshot_dir)
+    assert sorted(m['version'] for m in manifest) == ['v{:03d}'.format(i) for i in range(n)]
+    for m in manifest:
+        assert os.path.exists(os.path.join(snapshot_dir, m['file']))
+
+def test_concurrent_saves_prune_to_keep(tmp_path):
+    snapshot_dir = str(tmp_path)
+    keep = 4
+    threads = [threading.Thread(target=save_snapshot, args=(make_saved_snapshot(i), snapshot_dir, 'blood', keep))
+               for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    manifest = read_manifest(snapshot_dir)
+    assert len(manifest) == keep
+    listed = {m['file'] for m in manifest}
+    on_disk = {name for name in os.listdir(snapshot_dir) if name.endswith('.feather')}
+    assert on_disk == listed
+
+def test_manifest_is_read_once_per_change(tmp_path, monkeypatch):
+    snapshot_dir = str(tmp_path)
+    save_snapshot(make_saved_snapshot(0), snapshot_dir, 'blood')
+    reads = []
+    load_manifest = data_snapshots._load_manifest
+    monkeypatch.setattr(data_snapshots, '_load_manifest', lambda path: reads.append(path) or load_manifest(path))
+    monkeypatch.setattr(data_snapshots, 'load_snapshot_file', lambda snapshot_dir, entry: {'version': entry['version']})
+
+    current = make_saved_snapshot(1)
+    data_snapshots._current['snapshot'] = current
+    for i in range(5):
+        assert get_snapshot('unknown-version', snapshot_dir) is current
+    assert get_snapshot('v000', snapshot_dir)['version'] == 'v000'
+    assert len(reads) == 1
+
+    save_snapshot(make_saved_snapshot(2), snapshot_dir, 'blood')
+    assert get_snapshot('v002', snapshot_dir)['version'] == 'v002'
+    assert get_snapshot('unknown-version', snapshot_dir) is current
+    assert len(reads) == 2
+
+def test_unreadable_snapshot_is_not_retried(tmp_path, monkeypatch):
+    snapshot_dir = str(tmp_path)
+    save_snapshot(make_saved_snapshot(3), snapshot_dir, 'blood')
+    os.remove(os.path.join(snapshot_dir, 'blood-v003.feather'))
+    loads = []
+    load_file = data_snapshots.load_snapshot_file
+    monkeypatch.setattr(data_snapshots, 'load_snapshot_file', lambda *args: loads.append(args) or load_file(*args))
+
+    current = make_saved_snapshot(1)
+    data_snapshots._current['snapshot'] = current
+    assert get_snapshot('v003', snapshot_dir) is current
+    assert get_snapshot('v003', snapshot_dir) is current
+    assert len(loads) == 1
+
+def test_one_worker_refreshes(tmp_path, monkeypatch):
+    lock_path = str(tmp_path / '.refresh.lock')
+    monkeypatch.setitem(data_snapshots._refresh, 'lock_path', lock_path)
+    monkeypatch.setitem(data_snapshots._refresh, 'lock_file', None)
+    # Another worker holds the lock: this one follows until that worker exits
+    other_worker = try_lock_file(lock_path)
+    assert other_worker is not None
+    assert not data_snapshots.is_refresher()
+    assert try_lock_file(lock_path) is None
+    other_worker.close()
+    assert data_snapshots.is_refresher()
+    assert data_snapshots.is_refresher()
+    assert try_lock_file(lock_path) is None
+    data_snapshots._refresh['lock_file'].close()
+
+def make_report_snapshot(report_df, loaded_at):
+    return make_snapshot(report_df, 'TACC files', loaded_at=loaded_at)
+
+def test_followers_load_newer_snapshots(tmp_path):
+    snapshot_dir = str(tmp_path)
+    mcc_visits = read_blood_file(ASSETS_PATH, 'blood_dict.json', [1, 2])
+    report_df = clean_blooddata(blood_visits_to_df(mcc_visits, [1, 2])[0])
+    first = make_report_snapshot(report_df, datetime(2021, 10, 4, 8))
+    save_snapshot(first, snapshot_dir, 'blood')
+    assert load_newer_snapshot(snapshot_dir, 'blood', first) is None
+
+    changed_df = report_df.copy()
+    changed_df.loc[0, 'bscp_aliq_cnt'] = 1
+    second = make_report_snapshot(changed_df, datetime(2021, 10, 4, 9))
+    second['base_version'] = first['version']
+    second['dirty_sites'] = {changed_df.loc[0, 'Site']}
+    save_snapshot(second, snapshot_dir, 'blood')
+    # An archive snapshot ingested later is not the refreshing worker's result
+    save_snapshot(dict(make_report_snapshot(report_df.iloc[:10], datetime(2021, 10, 5)), source='archive'),
+                  snapshot_dir, 'blood')
+
+    loaded = load_newer_snapshot(snapshot_dir, 'blood', first)
+    assert loaded['version'] == second['version']
+    assert loaded['base_version'] == first['version']
+    assert loaded['dirty_sites'] == second['dirty_sites']
+    assert 'file' in loaded
+    assert load_newer_snapshot(snapshot_dir, 'blood', loaded) is None
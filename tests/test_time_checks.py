@@ -0,0 +1,52 @@
+''' Time checks of blood draws, including times entered before the blood draw'''
+import numpy as np
+import pandas as pd
+
+from data_processing import (clean_blooddata, read_blood_file, blood_visits_to_df, missing_blood_draws,
+                             get_time_check_fail, build_aggregate_cube, cube_site_metrics, timing_metrics)
+from config_settings import ASSETS_PATH
+
+def flat_visits(times):
+    ''' Flattened rows of (centrifuge, freezer) times for draws at 08:00'''
+    return pd.DataFrame({
+        'index': [str(10000 + i) for i in range(len(times))],
+        'MCC': ['1'] * len(times),
+        'screening_site': ['Rush'] * len(times),
+        'Visit': ['Baseline Visit'] * len(times),
+        'bscp_time_blood_draw': ['2021-03-01 08:00'] * len(times),
+        'bscp_time_centrifuge': [centrifuge for centrifuge, freezer in times],
+        'bscp_aliquot_freezer_time': [freezer for centrifuge, freezer in times],
+        'bscp_aliq_cnt': ['8'] * len(times),
+        'bscp_protocol_dev': ['0'] * len(times),
+        'bscp_protocol_dev_reason': [np.nan] * len(times),
+        'bscp_deg_of_hemolysis': ['0'] * len(times),
+        'bscp_paxg_aliq_na': [np.nan] * len(times),
+        'bscp_buffycoat_na': [np.nan] * len(times),
+        'bscp_lav1_not_obt': [np.nan] * len(times),
+        'bscp_sample_obtained': [np.nan] * len(times),
+    })
+
+def test_inverted_times_fail():
+    df = clean_blooddata(flat_visits([
+        ('2021-03-01 08:20', '2021-03-01 08:50'),   # in time
+        ('2021-03-01 01:00', '2021-03-01 01:10'),   # centrifuge and freezer before the draw
+        ('2021-03-01 08:10', '2021-03-01 07:00'),   # freezer before the draw
+    ]))
+    assert list(df['time_to_centrifuge_minutes']) == [20, -420, 10]
+    assert list(df['time_values_check']) == [True, False, False]
+    assert list(get_time_check_fail(df)['ID']) == ['10001', '10002']
+
+    metrics_df = cube_site_metrics(build_aggregate_cube(df), timing_metrics).set_index('Metric')
+    assert metrics_df.loc['Centrifuge < 30 min', 'Fail'] == 1
+    assert metrics_df.loc['Freezer < 60 min', 'Fail'] == 2
+    assert (metrics_df['Count'] == 3).all()
+
+def test_bundled_record_with_inverted_times():
+    # Record 10036's 3-Mo Post-Op visit has its times entered before the draw
+    mcc_visits = read_blood_file(ASSETS_PATH, 'blood_dict.json', [1, 2])
+    df = clean_blooddata(blood_visits_to_df(mcc_visits, [1, 2])[0])
+    blood_drawn = missing_blood_draws(df)[0]
+    failed = get_time_check_fail(blood_drawn)
+    row = failed[(failed['ID'] == '10036') & (failed['Visit'] == '3-Mo Post-Op')]
+    assert len(row) == 1
+    assert row['time_to_centrifuge_minutes'].iloc[0] < 0